@@ -0,0 +1,232 @@
+'''
+Local JSON/HTTP API for one UPS engine.
+
+    GET  /state                  Latest state: {"seq": ..., "timestamp": ..., "values": {...}}
+    GET  /history?field=voltage_in&start=<unix time>&end=<unix time>&tier=raw|1s|1min
+                                 {"field": ..., "tier": ..., "times": [...], "values": [...]}
+    POST /command                {"parameter": "outlet_cmd", "option": "OFF"} as for the CLI
+                                 'set' command, or {"raw": "<hex message>"}; answers {"ok": true|false}
+    GET  /events                 Server-sent events: a "state" event with the complete state,
+                                 then a "delta" event {"seq", "timestamp", "msg_id", "changes"}
+                                 for every frame that changed values
+
+The serialized state is cached and only serialized again after values changed, and
+every delta is serialized once for all event stream clients, so clients cost the
+engine thread nothing but appending the delta to a buffer.
+The server binds to localhost by default, it has no authentication.
+'''
+import sys
+import json
+import math
+import time
+import datetime
+import threading
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from apccommand import make_set_msg
+
+API_PORT = 8042
+EVENT_BUFFER_SIZE = 1000#Deltas kept for event stream clients, a client that falls further behind gets the complete state again
+KEEPALIVE_INTERVAL = 15.0#Seconds between comments on an idle event stream
+COMMAND_TIMEOUT = 10.0#Seconds to wait for the UPS to accept a command
+
+def to_json(value):
+    ''' json.dumps default for the values of the UPS state '''
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    raise TypeError("Can not serialize " + repr(value))
+
+def dumps(data):
+    return json.dumps(data, default=to_json, separators=(',', ':')).encode()
+
+class ApiServer:
+    '''
+    comm      Engine (ApcComm or AsyncApcComm), commands are submitted with its send_apc_msg()
+    history   apchistory.History recording the engine, for /history
+    '''
+
+    def __init__(self, comm, history=None, host='127.0.0.1', port=API_PORT):
+        self.comm = comm
+        self.history = history
+        self.address = (host, port)
+        self.server = None
+
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.state_body = None#Serialized state, None when values changed since
+        self.events = deque(maxlen=EVENT_BUFFER_SIZE)#(event number, delta, serialized delta or None)
+        self.event_count = 0
+        comm.add_delta_listener(self.on_delta)
+
+    def on_delta(self, delta):
+        ''' Delta listener of the engine, only stores the delta '''
+        with self.lock:
+            self.state_body = None
+            self.event_count += 1
+            self.events.append([self.event_count, delta, None])
+            self.changed.notify_all()
+
+    def state(self):
+        ''' Serialized latest state, cached until a value changes '''
+        body = self.state_body
+        if body is None:
+            snapshot = self.comm.snapshot
+            body = dumps({'seq': snapshot.seq, 'timestamp': snapshot.timestamp, 'values': dict(snapshot.values)})
+            with self.lock:
+                if self.events and self.events[-1][1].seq > snapshot.seq:
+                    return body#Changed while serializing, do not cache
+                self.state_body = body
+        return body
+
+    def history_range(self, query):
+        field = query.get('field', [''])[0]
+        tier = query.get('tier', ['raw'])[0]
+        start = float(query['start'][0]) if 'start' in query else None
+        end = float(query['end'][0]) if 'end' in query else None
+        times, values = self.history.query(field, start, end, tier)
+        return dumps({'field': field, 'tier': tier, 'times': list(times),
+                      'values': [None if math.isnan(value) else value for value in values]})
+
+    def command(self, request):
+        if not isinstance(request, dict):
+            raise ValueError("Command must be a JSON object")
+        if 'raw' in request:
+            raw_msg = bytearray.fromhex(request['raw'])
+        else:
+            raw_msg = make_set_msg(request.get('parameter'), str(request.get('option')))
+        return dumps({'ok': self.comm.send_apc_msg(raw_msg, timeout=COMMAND_TIMEOUT)})
+
+    def next_events(self, next_event, timeout):
+        '''
+        Wait for the events from number next_event on.
+        Returns (events, next event number), events is None when the client fell behind.
+        '''
+        with self.lock:
+            if self.event_count < next_event:
+                self.changed.wait(timeout)
+            if not self.events or self.event_count < next_event:
+                return [], next_event
+            first = self.events[0][0]
+            if next_event < first:
+                return None, self.event_count + 1
+            events = list(self.events)[next_event - first:]
+            return events, self.event_count + 1
+
+    def stream_events(self, wfile):
+        ''' Write the event stream until the client disconnects '''
+        with self.lock:
+            next_event = self.event_count + 1
+        wfile.write(b'event: state\ndata: ' + self.state() + b'\n\n')
+        wfile.flush()
+        while self.server is not None:
+            events, next_event = self.next_events(next_event, KEEPALIVE_INTERVAL)
+            if events is None:
+                wfile.write(b'event: state\ndata: ' + self.state() + b'\n\n')
+            elif not events:
+                wfile.write(b': keepalive\n\n')
+            for event in events or ():
+                if event[2] is None:
+                    delta = event[1]
+                    event[2] = b'event: delta\ndata: ' + dumps(delta._asdict()) + b'\n\n'
+                wfile.write(event[2])
+            wfile.flush()
+
+    def start(self):
+        ''' Serve from a background thread '''
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def send_json(self, body, status=200):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_failure(self, status, message):
+                self.send_json(dumps({'error': message}), status)
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path == '/state':
+                    self.send_json(api.state())
+                elif url.path == '/history':
+                    if api.history is None:
+                        self.send_failure(404, "No history recorded")
+                        return
+                    try:
+                        self.send_json(api.history_range(parse_qs(url.query)))
+                    except (KeyError, ValueError, TypeError, OverflowError) as e:
+                        self.send_failure(400, "Invalid history query: " + str(e))
+                elif url.path == '/events':
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/event-stream')
+                    self.send_header('Cache-Control', 'no-cache')
+                    self.send_header('Connection', 'close')
+                    self.end_headers()
+                    self.close_connection = True
+                    try:
+                        api.stream_events(self.wfile)
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass
+                else:
+                    self.send_failure(404, "Unknown path")
+
+            def do_POST(self):
+                if urlsplit(self.path).path != '/command':
+                    self.send_failure(404, "Unknown path")
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    request = json.loads(self.rfile.read(length) or b'{}')
+                    self.send_json(api.command(request))
+                except (ValueError, TypeError, AttributeError, OverflowError) as e:
+                    self.send_failure(400, str(e))
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(self.address, Handler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        return self.server
+
+    def shutdown(self):
+        server = self.server
+        self.server = None
+        if server is not None:
+            with self.lock:
+                self.changed.notify_all()
+            server.shutdown()
+            server.server_close()
+        self.comm.remove_delta_listener(self.on_delta)
+
+if __name__ == '__main__':
+
+    if len(sys.argv) not in (2, 3):
+        print("APC UPS HTTP API\n\nUsage: " + sys.argv[0] + " <serial port> [<HTTP port, default " + str(API_PORT) + ">]")
+        sys.exit(0)
+
+    from apcserial import ApcComm
+    from apcport import open_port
+    from apcprotocol import APC_RCV_TIMEOUT
+    from apchistory import History
+
+    apccomm = ApcComm(open_port(sys.argv[1], timeout=APC_RCV_TIMEOUT))
+    history = History()
+    history.attach(apccomm)
+    api = ApiServer(apccomm, history, port=int(sys.argv[2]) if len(sys.argv) == 3 else API_PORT)
+    api.start()
+    apccomm.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    api.shutdown()
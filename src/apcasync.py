@@ -0,0 +1,151 @@
+'''
+asyncio transport for the Microlink protocol engine.
+
+AsyncApcComm runs the same state machine as the threaded ApcComm, but waits for data
+with loop.add_reader() on a non-blocking port instead of blocking reads. Many UPS
+links can therefore be driven from a single event loop, without a thread per port.
+
+The port must have fileno(), and read()/write() that do not block, e.g.
+apcport.FdPort(name, timeout=0) or apcport.open_port(name, timeout=0).
+'''
+import time
+import asyncio
+from apcprotocol import ApcProtocol, CommState, APC_RCV_TIMEOUT, APC_IDLE_TIMEOUT, APC_CMD_TIMEOUT, APC_RESET_DELAY
+
+READ_SIZE = 256#Maximum number of bytes taken from the port per read
+SUBSCRIBE_QUEUE_SIZE = 100#Snapshots kept for a slow subscriber, older ones are dropped
+
+class AsyncApcComm(ApcProtocol):
+
+    def __init__(self, port):
+        super(AsyncApcComm, self).__init__()
+        self.port = port
+        self.running = False
+        self.port_error = None#Exception raised by the port, ends run()
+        self.data_event = None
+        self.readers = []#Futures of read() calls waiting for the next state
+
+    async def run(self):
+        '''
+        Communicate with the UPS until stop() is called.
+        Raises the exception of the port when it fails, e.g. because the device was unplugged.
+        '''
+        loop = asyncio.get_running_loop()
+        self.data_event = asyncio.Event()
+        self.port_error = None
+        self.add_listener(self.wake_readers)
+        loop.add_reader(self.port.fileno(), self.on_readable)
+        self.running = True
+        try:
+            while self.running:
+                if self.state == CommState.INIT_RESET:
+                    await asyncio.sleep(APC_RESET_DELAY)
+                self.port.write(self.next_apc_cmd())
+                rcv_data = await self.receive_msg()
+                self.handle_reply(rcv_data, self.read_time)
+        finally:
+            self.running = False
+            if self.port_error is None:
+                loop.remove_reader(self.port.fileno())
+            self.remove_listener(self.wake_readers)
+            self.stopped()
+
+    def stop(self):
+        self.running = False
+        if self.data_event is not None:
+            self.data_event.set()
+
+    def on_readable(self):
+        ''' Called by the loop when the port has data '''
+        try:
+            data = self.port.read(READ_SIZE)
+        except OSError as e:
+            self.port_error = e
+            asyncio.get_running_loop().remove_reader(self.port.fileno())
+            self.data_event.set()
+            return
+        if data:
+            self.read_time = time.time()
+            self.framer.feed(data)
+            self.data_event.set()
+
+    async def receive_msg(self):
+        '''
+        Receive a message from the UPS.
+        Returns as soon as a complete, valid frame has arrived, APC_RCV_TIMEOUT is only an upper bound.
+        If no valid frame could be found, the leftover bytes are returned so the message gets requested again.
+        Once bytes of the reply arrived without forming a valid frame, the line only has to stay quiet
+        for APC_IDLE_TIMEOUT, a corrupted or truncated reply does not cost the whole APC_RCV_TIMEOUT.
+        The time the bytes were read is left in read_time.
+        '''
+        loop = asyncio.get_running_loop()
+        self.framer.frame_size = self.frame_size()
+        deadline = loop.time() + APC_RCV_TIMEOUT
+        start = self.framer.received
+        while self.running:
+            if self.port_error is not None:
+                raise self.port_error
+            for frame in self.framer.frames():
+                return frame
+            remaining = deadline - loop.time()
+            if self.framer.received > start:
+                #Inter-byte timeout, the UPS sends a reply in one go
+                remaining = min(remaining, self.read_time + APC_IDLE_TIMEOUT - time.time())
+            if remaining <= 0:
+                break
+            #A timer on the data event avoids creating a task per wait
+            self.data_event.clear()
+            timer = loop.call_later(remaining, self.data_event.set)
+            try:
+                await self.data_event.wait()
+            finally:
+                timer.cancel()
+        leftover = self.framer.flush()
+        if not leftover:
+            self.read_time = time.time()
+        return leftover
+
+    def wake_readers(self, snapshot):
+        readers = self.readers
+        self.readers = []
+        for future in readers:
+            if not future.done():
+                future.set_result(snapshot)
+
+    async def read(self, min_seq=None):
+        '''
+        Wait for a state snapshot with a sequence number of at least min_seq,
+        by default the next snapshot that gets published.
+        '''
+        if min_seq is None:
+            min_seq = self.snapshot.seq + 1
+        while self.snapshot.seq < min_seq:
+            future = asyncio.get_running_loop().create_future()
+            self.readers.append(future)
+            await future
+        return self.snapshot
+
+    async def write(self, raw_msg, timeout=APC_CMD_TIMEOUT):
+        '''
+        Write a message to the UPS in one of the next poll slots.
+        Returns True when the UPS echoed the message ID, False on failure or timeout.
+        '''
+        future = asyncio.wrap_future(self.submit_apc_msg(raw_msg))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+
+    async def subscribe(self, queue_size=SUBSCRIBE_QUEUE_SIZE):
+        ''' Asynchronous iterator over all published state snapshots '''
+        snapshots = asyncio.Queue(queue_size)
+        def put(snapshot):
+            if snapshots.full():
+                snapshots.get_nowait()#Drop the oldest, the latest state is what matters
+            snapshots.put_nowait(snapshot)
+        self.add_listener(put)
+        try:
+            while True:
+                yield await snapshots.get()
+        finally:
+            self.remove_listener(put)
@@ -0,0 +1,190 @@
+'''
+Binary capture log of the raw Microlink traffic, and replay of it.
+
+CaptureLog is given to an engine (apccomm.capture = CaptureLog(...)) and appends every
+message written to the UPS and every reply as received, before decoding, to a file of
+fixed-size records:
+
+    timestamp   8 bytes, double, time.time()
+    direction   1 byte, TX or RX
+    flags       1 byte, VALID when an RX record is a frame with a valid checksum,
+                TRUNCATED when the data did not fit the record
+    length      1 byte, number of data bytes used
+    data        37 bytes, zero padded
+
+The file starts with a 16-byte header (magic and record size). When a file reaches
+max_bytes the capture continues in a new file, and the oldest files beyond max_files
+are deleted. Files are named <base>.<number>, in the order they were written.
+Records are written unbuffered, one write per record, so a crash loses at most the
+record that was being written (which the reader ignores).
+
+Replay memory-maps capture files and feeds the valid frames through the decoder,
+publishing state snapshots with the recorded timestamps, at full or recorded speed.
+'''
+import os
+import sys
+import mmap
+import glob
+import time
+import struct
+from apcdecode import decode_msg, complete_frames
+from apcstate import make_snapshot
+from apcrecord import UpsState
+
+MAGIC = b'APCCAP01'
+HEADER = struct.Struct('<8sH6x')#Magic, record size
+RECORD = struct.Struct('<dBBB37s')
+DATA_SIZE = 37
+
+TX = 0
+RX = 1
+
+VALID = 1
+TRUNCATED = 2
+
+MAX_BYTES = 64 * 1024 * 1024#Size of a capture file before continuing in the next one
+MAX_FILES = 8#Number of capture files kept
+
+def capture_files(base):
+    ''' Capture files of a base path, oldest first '''
+    paths = [path for path in glob.glob(glob.escape(base) + '.*') if path[len(base) + 1:].isdigit()]
+    return sorted(paths, key=lambda path: int(path[len(base) + 1:]))
+
+class CaptureLog:
+    '''
+    base        Path of the capture files, without the number
+    max_bytes   Size at which a new file is started
+    max_files   Number of files kept including the current one, the oldest are deleted.
+                The current file is always kept, None keeps all files
+    '''
+
+    def __init__(self, base, max_bytes=MAX_BYTES, max_files=MAX_FILES):
+        self.base = base
+        self.max_bytes = max(max_bytes, HEADER.size + RECORD.size)
+        self.max_files = max_files
+        files = capture_files(base)
+        self.number = int(files[-1][len(base) + 1:]) if files else 0
+        self.file = None
+        self.size = 0
+        self.records = 0
+        self.rotate()
+
+    def rotate(self):
+        ''' Continue in a new file '''
+        if self.file is not None:
+            self.file.close()
+        self.number += 1
+        self.path = self.base + '.' + str(self.number)
+        self.file = open(self.path, 'ab', buffering=0)
+        self.file.write(HEADER.pack(MAGIC, RECORD.size))
+        self.size = HEADER.size
+        if self.max_files is not None:
+            files = capture_files(self.base)
+            for path in files[:max(len(files) - max(self.max_files, 1), 0)]:
+                os.remove(path)
+
+    def write(self, direction, data, valid=True, timestamp=None):
+        ''' Append a record '''
+        if self.size + RECORD.size > self.max_bytes:
+            self.rotate()
+        data = bytes(data)
+        flags = VALID if valid else 0
+        if len(data) > DATA_SIZE:
+            data = data[:DATA_SIZE]
+            flags |= TRUNCATED
+        self.file.write(RECORD.pack(time.time() if timestamp is None else timestamp, direction, flags, len(data), data))
+        self.size += RECORD.size
+        self.records += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def read_records(path):
+    ''' Yield (timestamp, direction, flags, data) for every record of a capture file '''
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, record_size = HEADER.unpack_from(mm, 0)
+            if magic != MAGIC or record_size != RECORD.size:
+                raise ValueError(path + " is not a capture file")
+            #A record that was being written when the program stopped is ignored
+            end = HEADER.size + (len(mm) - HEADER.size) // RECORD.size * RECORD.size
+            for pos in range(HEADER.size, end, RECORD.size):
+                timestamp, direction, flags, length, data = RECORD.unpack_from(mm, pos)
+                yield timestamp, direction, flags, data[:length]
+
+class Replay:
+    '''
+    Decode captured frames and publish the resulting states like an engine does.
+
+    paths   Capture files in the order to replay, see capture_files()
+    '''
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.snapshot = make_snapshot(UpsState())
+        self.listeners = ()
+        self.frames = 0
+        self.text_heads = {}#Held first frames of the texts, see apcdecode.complete_frames
+
+    @property
+    def ups_state(self):
+        return self.snapshot.values
+
+    def add_listener(self, callback):
+        ''' Call callback(snapshot) for every replayed frame '''
+        self.listeners = self.listeners + (callback,)
+
+    def remove_listener(self, callback):
+        self.listeners = tuple(cb for cb in self.listeners if cb is not callback)
+
+    def run(self, speed=None):
+        '''
+        Replay all valid received frames.
+        speed    None to replay as fast as possible, 1.0 for the recorded speed, 2.0 for twice as fast, ...
+        Returns the number of frames replayed.
+        '''
+        first = None
+        start = time.monotonic()
+        for path in self.paths:
+            for timestamp, direction, flags, data in read_records(path):
+                if direction != RX or not flags & VALID:
+                    continue
+                if speed is not None:
+                    if first is None:
+                        first = timestamp
+                    delay = (timestamp - first) / speed - (time.monotonic() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+                state = self.snapshot.values.copy()
+                for msg_id, msg_data in complete_frames(self.text_heads, data[0], data[1:-2]):
+                    decode_msg(msg_id, msg_data, state)
+                self.snapshot = make_snapshot(state, seq=self.snapshot.seq + 1, timestamp=timestamp)
+                self.frames += 1
+                for callback in self.listeners:
+                    callback(self.snapshot)
+        return self.frames
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print("Replay a capture of the UPS communication\n\nUsage: " + sys.argv[0] + " <capture base path> [speed]")
+        sys.exit(0)
+
+    replay = Replay(capture_files(sys.argv[1]))
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    if speed is not None:
+        replay.add_listener(lambda snapshot: print(time.strftime('%H:%M:%S', time.localtime(snapshot.timestamp)) + " " +
+                                                   str(snapshot.values.get('ups_status', ''))))
+    start = time.perf_counter()
+    frames = replay.run(speed)
+    elapsed = time.perf_counter() - start
+    print("%d frames in %.2f s (%.0f frames/s)" % (frames, elapsed, frames / elapsed if elapsed else 0))
+    for key in sorted(replay.ups_state.keys()):
+        print(str(key) + " = " + str(replay.ups_state[key]))
@@ -0,0 +1,78 @@
+'''
+Messages to configure the UPS or to give it commands, by parameter name and option,
+as used by the 'set' command of the CLI and by the HTTP API.
+'''
+from apcprotocol import create_msg_data
+from apcdecode import FIELDS
+
+OUTLET_CMDS = {
+    'CANCEL': 1 + 256,#Cancels pending actions to the targets selected. No modifiers are allowed. Target is Main outlet
+    'ON': 2 + 32 + 256 + 16384,#Turn ON, allow the output to turn on without AC input power conditions met, Main outlet, command from serial
+    'ON_DELAY': 2 + 32 + 64 + 256 + 16384,#Same as ON, but use the ON delay
+    'OFF': 4 + 256 + 16384,#Turn OFF, Main outlet, command from serial
+    'OFF_DELAY': 4 + 128 + 256 + 16384,#Turn OFF after the OFF delay
+    'SHUTDOWN': 8 + 256 + 16384,#Turn off outlet and wait for AC power returns, battery has charged enough, ...
+    'REBOOT': 16 + 256 + 16384,#Turn off outlet and turn on again
+}
+
+TEST_CMDS = {
+    'START': 0x0001,#Setting bit 0 will trigger the test. Note that there needs to be sufficient load connected for this test not to be refused.
+    'STOP': 0x0002,#Setting bit 1 will cancel the test
+}
+
+UPS_CMDS = {
+    'RESET': 0x0008,#Factory reset, to defaults
+}
+
+USER_INTERFACE_CMDS = {
+    'SHORT_TEST': 0x0001,#Perform the momentary local UI test, e.g., light all the LEDs and sound the beeper.
+    'CONT_TEST': 0x0002,#Perform the continuous local UI test, e.g., light all the LEDs and sound the beeper until canceled. To cancel, trigger the short test
+    'MUTE_ON': 0x0004,#Mute all the active alarms in the UPS
+    'MUTE_OFF': 0x0008,#Cancels any muting
+    'ACK_ALARM': 0x0020,#Acknowledges active battery alarms
+}
+
+TEST_INTERVAL_CHOICES = ["DISABLED", "STARTUP", "EACH 7 DAYS SINCE STARTUP", "EACH 14 DAYS SINCE STARTUP", "EACH 7 DAYS SINCE LAST", "EACH 14 DAYS SINCE LAST"]
+
+#Parameter -> (message ID, offset, {option: 16 bit value})
+COMMANDS = {
+    'outlet_cmd': (0x71, 0x08, OUTLET_CMDS),
+    'battery_replacetest_cmd': (0x6d, 4, TEST_CMDS),
+    'runtime_calibration_cmd': (0x6d, 8, TEST_CMDS),
+    'ups_cmd': (0x71, 0, UPS_CMDS),
+    'user_interface_cmd': (0x6f, 2, USER_INTERFACE_CMDS),
+}
+
+PARAMETERS = tuple(COMMANDS) + ('runtime_limit_outletoff', 'battery_test_interval')
+
+def test_interval_choice(option):
+    ''' Index in TEST_INTERVAL_CHOICES for a battery_test_interval option, invalid values disable the test '''
+    val = int(option)
+    return val if val >= 0 and val < len(TEST_INTERVAL_CHOICES) else 0
+
+def make_set_msg(parameter, option):
+    '''
+    Message that sets a parameter, or gives a command, with the given option.
+    Raises ValueError for an unknown parameter or option.
+    '''
+    if parameter in COMMANDS:
+        msg_id, offset, options = COMMANDS[parameter]
+        if option not in options:
+            raise ValueError("Unknown option")
+        value = options[option]
+    elif parameter == 'runtime_limit_outletoff':
+        msg_id, offset = 0x4c, 14
+        try:
+            value = int(option)
+        except ValueError:
+            raise ValueError("Unknown option")
+    elif parameter == 'battery_test_interval':
+        msg_id, field = FIELDS['battery_replacetest_interval']
+        offset = field.offset
+        try:
+            value = 1 << test_interval_choice(option)
+        except ValueError:
+            raise ValueError("Unknown option")
+    else:
+        raise ValueError("Unrecognized parameter \'" + str(parameter) + "\'")
+    return create_msg_data(msg_id=msg_id, offset=offset, msg_data=value.to_bytes(length=2, byteorder='big', signed=False))
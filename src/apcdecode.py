@@ -0,0 +1,597 @@
+'''
+Table-driven decoder for the Microlink message IDs.
+
+REGISTER_MAP describes, per message ID, where every field lives in the 16 data bytes
+of a frame and how it should be interpreted. At import it is compiled into DECODERS,
+a dict of one decoder function per message ID, so decoding a frame is a single dict
+lookup plus one struct.unpack_from for all numeric fields of that message.
+'''
+import struct
+import datetime
+import functools
+from collections import namedtuple
+
+#Field kinds
+INT = 'int'#Plain integer
+BP = 'bp'#Binary point number, converted to float with bp fractional bits
+DATE = 'date'#Days since 1 Jan. 2000
+FLAGS = 'flags'#Bitfield, stored as <name>_raw and as a tuple of labels in <name>
+ENUM = 'enum'#Enumeration, stored as <name>_raw and as the mapped value in <name>
+STR = 'str'#Text
+STR_APPEND = 'str+'#Text that continues a STR field of a previous message ID
+BYTES = 'bytes'#Raw bytes
+
+NUMERIC_KINDS = (INT, BP, DATE, FLAGS, ENUM)
+
+FLAG_CACHE_SIZE = 1024#Number of (field, raw value) label tuples kept by flag_labels
+
+EPOCH = datetime.datetime(2000, 1, 1)
+
+Field = namedtuple('Field', 'name offset width kind signed bp table')
+Field.__new__.__defaults__ = (INT, False, 0, None)
+Field.__doc__ = '''
+name      Key in the UPS state
+offset    Byte offset in the message data
+width     Number of bytes, None for text/bytes running to the end of the message
+kind      One of the field kinds above
+signed    Two's complement number
+bp        Fractional bit position for BP fields
+table     Flag table ((bit, label), ...) for FLAGS, {raw: value} for ENUM
+'''
+
+BATTERY_REPLACETEST_INTERVAL_FLAGS = (
+    (1, "DISABLED"),#Testing is disabled
+    (2, "STARTUP"),#Testing is done only at every startup of UPS
+    (4, "EACH 7 DAYS SINCE STARTUP"),#Test every 7 days since startup
+    (8, "EACH 14 DAYS SINCE STARTUP"),#Test every 14 days since startup
+    (16, "EACH 7 DAYS SINCE LAST"),#Test every 7 days since last test
+    (32, "EACH 14 DAYS SINCE LAST"),#Test every 14 days since last test
+)
+
+VOLTAGE_SENSITIVITY = {1: "HIGH", 2: "MEDIUM", 4: "LOW"}
+
+VOLTAGE_CONFIG = {1: 100, 2: 120, 4: 200, 8: 208, 16: 220, 32: 230, 64: 240, 2048: 115}#Input voltage setting
+
+LOADSHED_CONFIG_FLAGS = (
+    (1, "USE_OFF_DELAY"),
+    #UseOffDelay- Modifier: When set, the load shed conditions that have this as a valid modifier will use the TurnOffCountdownSetting to shut the outlet off.
+    (2, "MANUAL_RESTART_REQUIRED"),
+    #ManualRestartRequired - Modifier - When set, the load shed conditions that have this as a valid modifier will use a turn off command instead of shutdown.
+    #This results in a manual intervention to restart the outlet.
+    (4, "RESERVED_BIT"),
+    (8, "TIME_ON_BATTERY"),
+    #TimeOnBattery: The outlet group will shed based on the LoadShedTimeOnBatterySetting usage. When operating on battery greater than this time, the outlet will turn off.
+    #The modifier bits UseOffDelay and ManualRestartRequired are valid with this bit
+    (16, "RUNTIME_REMAINING"),
+    #RunTimeRemaining: The outlet group will shed based on the LoadShedRuntimeRemainingSetting usage. When operating on battery and the runtime remaining is
+    #less than or equal to this value, the outlet will turn off. The modifier bits UseOffDelay and ManualRestartRequired are valid with this bit.
+    (32, "ON_OVERLOAD"),
+    #UPSOverload - When set, the outlet will turn off immediately (no off delay possible) when the UPS is in overload. The outlet will require a manual command
+    #to restart. Not applicable for the Main Outlet Group (MOG)
+)
+
+BATTERY_LIFETIME_STATUS_FLAGS = (
+    (1, "OK"),#Battery life still OK
+    (2, "NEAR EOL"),#Near end-of-life
+    (4, "OVER EOL"),#Over end-of-life
+    (8, "NEAR EOL ACK"),#Near end of life was confirmed by user
+    (16, "OVER EOL ACK"),#Over end of life was confirmed by user
+)
+
+BATTERY_REPLACETEST_STATUS_FLAGS = (
+    (0, "UNKNOWN"),#Empty data
+    (1, 'PENDING'),#Test will start soon
+    (2, 'IN PROGRESS'),#Test is running
+    (4, 'PASSED'),#Battery passed replacement test
+    (8, 'FAILED'),#Battery failed replacement test
+    (16, 'REFUSED'),#UPS cannot test now, refused
+    (32, 'ABORTED'),#Test aborted
+    (64, 'SOURCE PROTOCOL'),#Start or stopping of test was triggered from protocol
+    (128, 'SOURCE UI'),#Start or stopping of test was triggered from user interface (UPS front panel)
+    (256, 'SOURCE INTERNAL'),#Start or stopping of test was triggered internally
+    (512, 'INVALID STATE'),#Invalid UPS Operating state to perform the test
+    (1024, 'INTERNAL FAULT'),#Internal fault such as battery missing, inverter failure, overload, ...
+    (2048, 'SOC UNACCEPTABLE'),#SOC is too low to do the test
+)
+
+RUNTIME_CALIBRATION_STATUS_FLAGS = (
+    (1, 'PENDING'),#Test will start soon
+    (2, 'IN PROGRESS'),#Test is running
+    (4, 'PASSED'),#Calibration completed
+    (8, 'FAILED'),#Calibration failed
+    (16, 'REFUSED'),#Test refused (too small load connected?)
+    (32, 'ABORTED'),#Test aborted
+    (64, 'SOURCE PROTOCOL'),#Start or stopping of test was triggered from protocol
+    (128, 'SOURCE UI'),#Start or stopping of test was triggered from user interface (UPS front panel)
+    (256, 'SOURCE INTERNAL'),#Start or stopping of test was triggered internally
+    (512, 'INVALID STATE'),#Invalid UPS Operating state to perform the test
+    (1024, 'INTERNAL FAULT'),#Internal fault such as battery missing, inverter failure, overload, ...
+    (2048, 'SOC UNACCEPTABLE'),#SOC is too low to do the test
+    (4096, 'LOAD CHANGED'),#The connected load varied too much to be able to calibrate
+    (8192, 'AC INPUT NOT ACCEPTABLE'),#AC Input not acceptable so test was aborted
+    (16384, 'LOAD TOO LOW'),#Connected load is too small to perform the calibration
+    (32768, 'OVERCHARGE IN PROGRESS'),#A battery overcharge is in progress so calibration would be inaccurate
+)
+
+USER_INTERFACE_STATUS_FLAGS = (
+    (1, "CONT. TEST IN PROGRESS"),
+    (2, "AUDIBLE ALARM IN PROGRESS"),
+    (4, "AUDIBLE ALARM MUTED"),
+)
+
+INPUT_STATUS_FLAGS = (
+    (1, "ACCEPTABLE"),
+    (2, "PENDING ACCEPTABLE"),
+    (4, "LOW VOLTAGE"),
+    (8, "HIGH VOLTAGE"),
+    (16, "DISTORTED"),
+    (32, "BOOST"),
+    (64, "TRIM"),
+    (128, "LOW FREQUENCY"),
+    (256, "HIGH FREQUENCY"),
+    (512, "PHASE NOT LOCKED"),
+    (1024, "DELTA PHASE OUT OF RANGE"),
+    (2048, "NEUTRAL NOT CONNECTED"),
+    (4096, "NOT ACCEPTABLE"),
+    (8192, "PLUG RATING EXCEEDED"),
+)
+
+POWSYS_ERROR_FLAGS = (
+    (1, "OUTPUT OVERLOAD"),
+    (2, "OUTPUT SHORT CIRCUIT"),
+    (4, "OUTPUT OVERVOLTAGE"),
+    (8, "TRANSFORMER DC IMBALANCE"),
+    (16, "OVERTEMPERATURE"),
+    (32, "BACKFEEDING"),
+    (64, "AVR RELAY FAULT"),
+    (128, "PFC INPUT RELAY FAULT"),
+    (256, "OUTPUT RELAY FAULT"),
+    (512, "BYPASS RELAY FAULT"),
+    (1024, "FAN FAULT"),
+    (2048, "PFC FAULT"),
+    (4096, "DC BUS OVERVOLTAGE"),
+    (8192, "INVERTER FAULT"),
+)
+
+GENERAL_ERROR_FLAGS = (
+    (1, "SITE WIRING FAULT"),
+    (2, "EEPROM ERROR"),
+    (4, "AD CONVERTER ERROR"),
+    (8, "LOGIC PSU FAULT"),
+    (16, "INTERNAL COMM FAULT"),
+    (32, "UI BUTTON FAULT"),
+    (128, "EPO ACTIVE"),
+)
+
+BATTERY_ERROR_FLAGS = (
+    (1, "DISCONNECTED"),
+    (2, "OVERVOLTAGE"),
+    (4, "NEEDS REPLACEMENT"),
+    (8, "OVERTEMPERATURE"),
+    (16, "CHARGER FAULT"),
+    (32, "TEMP SENSOR FAULT"),
+    (64, "BATTERY BUS SOFT START FAULT"),
+    (128, "HIGH TEMPERATURE"),
+    (256, "GENERAL ERROR"),
+    (512, "COMM ERROR"),
+)
+
+OUTLET_STATUS_FLAGS = (
+    (1, "OUTLET ON"),
+    (2, "OUTLET OFF"),
+    (4, "REBOOTING"),
+    (8, "SHUTTING DOWN"),
+    (16, "SLEEPING"),
+    #From here on unsure because different sources give different values/explanations
+    (128, "OUTLET OVERLOAD"),
+    (256, "PENDING OUTLET ON"),#Waiting to turn outlet on
+    (512, "PENDING OUTLET OFF"),#Waiting to turn outlet off
+    (1024, "WAIT ON AC"),#Wait for grid AC to turn on outlet
+    (2048, "WAIT ON MIN RUNTIME"),#Waiting on enough charge to reach minimum runtime, before turning on outlet
+    (4096, "LOW RUNTIME"),#indicates the run time is below the setting for the outlet group
+)
+
+UPS_STATUS_FLAGS = (
+    (1, "RESERVED BIT"),
+    (2, "ONLINE"),
+    (4, "ON BATTERY"),
+    (8, "BYPASS ON"),
+    (16, "OUTPUT OFF"),
+    (32, "FAULT"),
+    (64, "INPUT BAD"),#Missing or bad AC power input
+    (128, "TESTING"),#A test is in progress
+    (256, "PENDING OUTPUT ON"),
+    (512, "PENDING OUTPUT OFF"),
+    (8192, "GREEN MODE"),
+    (16384, "InformationalAlert"),
+)
+
+#These are documented in the APC Modbus documentation
+STATUS_CHG_CAUSE = {
+    0: "SystemInitialization",
+    1: "HighInputVoltage",
+    2: "LowInputVoltage",
+    3: "DistortedInput",
+    4: "RapidChangeOfInputVoltage",
+    5: "HighInputFrequency",
+    6: "LowInputFrequency",
+    7: "FreqAndOrPhaseDifference",
+    8: "AcceptableInput",
+    9: "AutomaticTest",
+    10: "TestEnded",
+    11: "LocalUICommand",
+    12: "ProtocolCommand",
+    13: "LowBatteryVoltage",
+    14: "GeneralError",
+    15: "PowerSystemError",
+    16: "BatterySystemError",
+    17: "ErrorCleared",
+    18: "AutomaticRestart",
+    19: "DistortedInverterOutput",
+    20: "InverterOutputAcceptable",
+    21: "EPOInterface",
+    22: "InputPhaseDeltaOutOfRange",
+    23: "InputNeutralNotConnected",
+    24: "ATSTransfer",
+    25: "ConfigurationChange",
+    26: "AlertAsserted",
+    27: "AlertCleared",
+    28: "PlugRatingExceeded",
+    29: "OutletGroupStateChange",
+    30: "FailureBypassExpired",
+}
+
+REGISTER_MAP = {
+    0x00: (
+        Field('protocol_version', 0, 1),
+        Field('msg_size', 1, 1),
+        Field('num_ids', 2, 1),
+        Field('series_id', 3, 2),
+        Field('series_id_raw', 3, 2, BYTES),
+        Field('series_data_version', 5, 1),
+        Field('unknown_3', 6, 1),
+        Field('unknown_4', 7, 1),
+        Field('header_raw', 0, 8, BYTES),#Needed for challenge calculation
+    ),
+    0x40: (
+        Field('serial_nb', 0, 14, STR),
+        Field('serial_nb_raw', 0, 14, BYTES),#0x33 0x53 0x31 0x36 0x30 0x37 0x58 0x30 0x30 0x35 0x38 0x38 0x20 0x20
+        Field('production_date', 14, 2, DATE),
+    ),
+    0x41: (
+        Field('ups_type', 0, None, STR),#First 16 bytes of ups name
+    ),
+    0x42: (
+        Field('ups_type', 0, None, STR_APPEND),#Last 16 bytes of ups name
+    ),
+    0x43: (
+        Field('ups_sku', 0, None, STR),#First 16 bytes of SKU
+    ),
+    0x44: (
+        Field('ups_sku', 0, 4, STR_APPEND),#Last 4 bytes of SKU
+    ),
+    0x45: (
+        Field('fw_version_1', 0, 8, STR),
+        Field('fw_version_2', 8, None, STR),
+    ),
+    0x46: (
+        Field('fw_version_3', 0, 8, STR),
+        Field('fw_version_4', 8, None, STR),
+    ),
+    0x47: (
+        Field('battery_install_date', 0, 2, DATE),
+        Field('battery_lifetime', 2, 2),#Battery expected lifetime in number of days
+        Field('battery_near_eol_alarm_notification', 4, 2),#Alarm triggers this number of days before estimated battery replacement. Default: 183 days
+        Field('battery_near_eol_alarm_reminder', 6, 2),#Near-EOL alarm is repeated every x days. Default: 14 days
+    ),
+    0x48: (
+        Field('battery_sku', 0, None, STR),
+    ),
+    0x49: (
+        Field('ups_name', 0, None, STR),
+    ),
+    0x4a: (
+        Field('allowed_operating_mode', 0, 2),#Bitfield
+        Field('power_quality_config', 2, 2),#Bitfield
+        Field('battery_replacetest_interval', 4, 2, FLAGS, table=BATTERY_REPLACETEST_INTERVAL_FLAGS),
+        Field('battery_replacement_due', 6, 2, DATE),
+        Field('low_runtime_alarm_config', 8, 2),#Amount of seconds remaining when low-runtime-alarm will trigger
+        Field('voltage_accept_max', 10, 2),
+        Field('voltage_accept_min', 12, 2),
+        Field('voltage_sensitivity', 15, 1, ENUM, table=VOLTAGE_SENSITIVITY),
+    ),
+    0x4b: (
+        Field('apparent_power_rating', 0, 2),
+        Field('real_power_rating', 2, 2),
+        Field('voltage_config', 4, 2, ENUM, table=VOLTAGE_CONFIG),
+    ),
+    0x4c: (
+        Field('power_on_delay', 0, 2),#TurnOnCountdownSetting: Amount of seconds between outlet ON command and switching on
+        Field('power_off_delay', 2, 2),#TurnOffCountdownSetting: Amount of seconds between outlet OFF command and switching off
+        Field('reboot_delay', 4, 4),#StayOffCountdownSetting: Amount of seconds to stay off during reboot sequence
+        Field('runtime_minimum_return', 8, 2, BP, bp=0),#Minimum runtime to have before switching outlets back on after outage, in seconds
+        Field('loadshed_config', 10, 2, FLAGS, table=LOADSHED_CONFIG_FLAGS),#Main outlet group (MOG) load shedding behaviour options. Not all options are necessarily supported.
+        Field('loadshed_runtime_remaining', 12, 2, BP, bp=0),#Outlet switches off (load shedding) when runtime drops to this value, in second
+        Field('loadshed_runtime_limit', 14, 2, BP, bp=0),#Outlet switches off (load shedding) after maximum time on battery, in seconds
+    ),
+    0x4d: (
+        Field('outlet_name', 0, None, STR),
+    ),
+    0x4e: (
+        #Alarm ON/OFF = 0x0005 / 0x0006 (Bit
+        #LCD Read-only = 0x1000 / 0x0000 (Bit 16)
+        Field('InterfaceDisable_BF', 4, 2),
+    ),
+    0x5c: (
+        Field('CommunicationMethod_EN', 8, 2),#No idea
+    ),
+    0x6c: (
+        Field('battery_lifetime_status', 6, 2, FLAGS, table=BATTERY_LIFETIME_STATUS_FLAGS),#Another bitfield, 1=OK?
+    ),
+    0x6d: (
+        Field('battery_voltage', 0, 2, BP, signed=True, bp=5),
+        Field('battery_soc', 2, 2, BP, bp=9),
+        Field('battery_replacetest_cmd', 4, 2),#Simple self-test
+        Field('battery_replacetest_status', 6, 2, FLAGS, table=BATTERY_REPLACETEST_STATUS_FLAGS),#Simple self-test
+        Field('runtime_calibration_status', 10, 2, FLAGS, table=RUNTIME_CALIBRATION_STATUS_FLAGS),
+        Field('runtime_remaining', 14, 2),#In seconds
+    ),
+    0x6e: (
+        Field('runtime_remaining_2', 0, 4),#In seconds
+    ),
+    0x6f: (
+        Field('temperature', 0, 2, BP, signed=True, bp=7),
+        Field('user_interface_cmd', 2, 2),
+        Field('user_interface_status', 4, 2, FLAGS, table=USER_INTERFACE_STATUS_FLAGS),
+        Field('voltage_out', 6, 2, BP, bp=6),
+        Field('current_out', 8, 2, BP, bp=5),
+        Field('frequency_out', 10, 2, BP, bp=7),
+        Field('apparent_power_pctused', 12, 2, BP, bp=8),
+        Field('real_power_pctused', 14, 2, BP, bp=8),
+    ),
+    0x70: (
+        Field('input_status', 2, 2, FLAGS, table=INPUT_STATUS_FLAGS),
+        Field('voltage_in', 4, 2, BP, bp=6),
+        Field('frequency_in', 6, 2, BP, bp=7),
+        Field('green_mode', 8, 2, signed=True),
+        Field('powsys_error', 10, 2, FLAGS, table=POWSYS_ERROR_FLAGS),
+        Field('general_error', 12, 2, FLAGS, table=GENERAL_ERROR_FLAGS),
+        Field('battery_error', 14, 2, FLAGS, table=BATTERY_ERROR_FLAGS),
+    ),
+    0x71: (
+        Field('ups_cmd', 0, 2),#Bitfield
+        #This ID is actually used to send commands to the outlet. No idea what the read values say, probably not relevant
+        Field('outlet_cmd', 8, 2),
+    ),
+    0x72: (
+        Field('outlet_status', 0, 2, FLAGS, table=OUTLET_STATUS_FLAGS),
+    ),
+    0x76: (
+        Field('ups_status', 8, 2, FLAGS, table=UPS_STATUS_FLAGS),
+        Field('status_chg_cause', 10, 2, ENUM, table=STATUS_CHG_CAUSE),
+    ),
+    0x79: (
+        Field('temperature_2', 4, 2, BP, signed=True, bp=7),
+        Field('humidity_pct', 6, 2, BP, bp=9),
+        Field('temperature_3', 14, 2, BP, signed=True, bp=7),
+    ),
+    0x7a: (
+        Field('humidity_pct_2', 0, 2, BP, bp=9),
+    ),
+    0x7e: (
+        Field('password_1', 8, 4, BYTES),
+        Field('password_2', 12, 4, BYTES),
+    ),
+    0x7f: (
+        Field('challenge_status', 14, 2, BYTES),
+    ),
+}
+
+STRUCT_CODES = {(1, False): 'B', (1, True): 'b', (2, False): 'H', (2, True): 'h', (4, False): 'I', (4, True): 'i'}
+
+def decode_flags(table, raw):
+    ''' List the labels of all bits set in raw. A bit value of 0 labels an empty bitfield. '''
+    if raw == 0:
+        return [label for bit, label in table if bit == 0]
+    return [label for bit, label in table if raw & bit]
+
+@functools.lru_cache(maxsize=FLAG_CACHE_SIZE)
+def flag_labels(name, raw):
+    '''
+    Labels of a FLAGS field for a raw value, as a tuple.
+    The tuples are cached and shared, so they must not be modified.
+    '''
+    return tuple(decode_flags(FLAG_TABLES[name], raw))
+
+def _compile_numeric(field):
+    ''' Build a function (state, value) that stores an unpacked numeric field '''
+    name = field.name
+    if field.kind == INT:
+        def store(state, value):
+            state[name] = value
+    elif field.kind == BP:
+        scale = 2**field.bp
+        def store(state, value):
+            state[name] = value / scale
+    elif field.kind == DATE:
+        def store(state, value):
+            state[name] = EPOCH + datetime.timedelta(days=value)
+    elif field.kind == FLAGS:
+        raw_name = name + '_raw'
+        def store(state, value):
+            if state.get(raw_name) == value and name in state:
+                return#Bitfield did not change since the previous frame
+            state[raw_name] = value
+            state[name] = flag_labels(name, value)
+    elif field.kind == ENUM:
+        raw_name = name + '_raw'
+        table = field.table
+        def store(state, value):
+            state[raw_name] = value
+            mapped = table.get(value)
+            if mapped is not None:
+                state[name] = mapped
+    else:
+        raise ValueError("Not a numeric field kind: " + str(field.kind))
+    return store
+
+def _compile_slice(field):
+    ''' Build a function (state, msg_data) that stores a text or bytes field '''
+    name = field.name
+    start = field.offset
+    end = None if field.width is None else field.offset + field.width
+    if field.kind == STR:
+        def store(state, msg_data):
+            state[name] = msg_data[start:end].decode()
+    elif field.kind == STR_APPEND:
+        def store(state, msg_data):
+            state[name] = state.get(name, '') + msg_data[start:end].decode()
+    elif field.kind == BYTES:
+        def store(state, msg_data):
+            state[name] = msg_data[start:end]
+    else:
+        raise ValueError("Not a text/bytes field kind: " + str(field.kind))
+    return store
+
+def _struct_format(numeric):
+    ''' Struct format that reads the given numeric fields, sorted by offset, and its size '''
+    fmt = '>'
+    pos = 0
+    for field in numeric:
+        if field.offset < pos:
+            raise ValueError("Overlapping numeric field " + field.name)
+        if field.offset > pos:
+            fmt += str(field.offset - pos) + 'x'
+        fmt += STRUCT_CODES[(field.width, field.signed)]
+        pos = field.offset + field.width
+    return fmt, pos
+
+def compile_message(fields):
+    '''
+    Compile the fields of one message ID into a decoder function (msg_data, state).
+    All numeric fields are read with a single precompiled struct, and every field is
+    stored by the same function as in compile_field.
+    '''
+    numeric = sorted([f for f in fields if f.kind in NUMERIC_KINDS], key=lambda f: f.offset)
+    fmt, pos = _struct_format(numeric)
+    size = max([pos] + [f.offset + (f.width or 0) for f in fields])
+    unpack_from = struct.Struct(fmt).unpack_from
+    numeric_stores = tuple(_compile_numeric(f) for f in numeric)
+    slice_stores = tuple(_compile_slice(f) for f in fields if f.kind not in NUMERIC_KINDS)
+    def decode(msg_data, state):
+        if len(msg_data) < size:
+            return False
+        if numeric_stores:
+            for store, value in zip(numeric_stores, unpack_from(msg_data)):
+                store(state, value)
+        for store in slice_stores:
+            store(state, msg_data)
+        return True
+    return decode
+
+def compile_field(field):
+    ''' Compile a single field into a decoder function (msg_data, state), for lazy decoding '''
+    if field.kind in NUMERIC_KINDS:
+        unpack_from = struct.Struct('>' + STRUCT_CODES[(field.width, field.signed)]).unpack_from
+        store = _compile_numeric(field)
+        offset = field.offset
+        size = field.offset + field.width
+        def decode(msg_data, state):
+            if len(msg_data) >= size:
+                store(state, unpack_from(msg_data, offset)[0])
+    else:
+        store = _compile_slice(field)
+        size = field.offset + (field.width or 0)
+        def decode(msg_data, state):
+            if len(msg_data) >= size:
+                store(state, msg_data)
+    return decode
+
+def compile_register_map(register_map):
+    ''' Compile a register map into a dict of decoder functions per message ID '''
+    return {msg_id: compile_message(fields) for msg_id, fields in register_map.items()}
+
+def message_keys(fields):
+    ''' State keys written by the decoder of a message '''
+    keys = []
+    for field in fields:
+        if field.name not in keys:
+            keys.append(field.name)
+        if field.kind in (FLAGS, ENUM):
+            keys.append(field.name + '_raw')
+    return tuple(keys)
+
+MESSAGE_KEYS = {msg_id: message_keys(fields) for msg_id, fields in REGISTER_MAP.items()}
+
+FLAG_TABLES = {f.name: f.table for fields in REGISTER_MAP.values() for f in fields if f.kind == FLAGS}
+
+DECODERS = compile_register_map(REGISTER_MAP)
+
+def compile_key_decoders(register_map):
+    '''
+    Decoder functions per state key: {key: ((msg_id, decoder), ...)}, in message ID order.
+    A text that continues over several message IDs has a decoder for each of them.
+    '''
+    decoders = {}
+    for msg_id, fields in sorted(register_map.items()):
+        for field in fields:
+            decode = compile_field(field)
+            for key in message_keys([field]):
+                decoders[key] = decoders.get(key, ()) + ((msg_id, decode),)
+    return decoders
+
+KEY_DECODERS = compile_key_decoders(REGISTER_MAP)
+
+def decode_msg(msg_id, msg_data, state):
+    '''
+    Decode the data of a message into the state dict.
+    Returns False for unknown message IDs or messages that are too short.
+    '''
+    decoder = DECODERS.get(msg_id)
+    if decoder is None:
+        return False
+    return decoder(msg_data, state)
+
+FIELDS = {f.name: (msg_id, f) for msg_id, fields in REGISTER_MAP.items() for f in fields if f.kind != STR_APPEND}
+
+def text_continuations(register_map):
+    ''' {message ID: message ID of the frame that continues one of its texts}, for the texts split over two frames '''
+    heads = {(f.name, msg_id) for msg_id, fields in register_map.items() for f in fields if f.kind == STR}
+    return {head_id: msg_id for msg_id, fields in register_map.items() for f in fields if f.kind == STR_APPEND
+            for name, head_id in heads if name == f.name}
+
+TEXT_CONTINUATIONS = text_continuations(REGISTER_MAP)
+TEXT_HEADS = {msg_id: head_id for head_id, msg_id in TEXT_CONTINUATIONS.items()}
+
+def complete_frames(heads, msg_id, msg_data):
+    '''
+    Frames [(msg_id, msg_data), ...] to decode for a received frame. The first frame of a text
+    that continues in the next one (ups_type, ups_sku) is held back in the dict heads, and
+    returned with its continuation, so a published state never has half of the text.
+    '''
+    if msg_id in TEXT_CONTINUATIONS:
+        heads[msg_id] = bytes(msg_data)
+        return []
+    head_id = TEXT_HEADS.get(msg_id)
+    if head_id is not None:
+        head = heads.pop(head_id, None)
+        #Without its first frame, e.g. re-read after a BACK, the continuation would be appended to the complete text
+        return [] if head is None else [(head_id, head), (msg_id, msg_data)]
+    return [(msg_id, msg_data)]
+
+def encode_field(field, value):
+    '''
+    Encode a value to the bytes of a field, the inverse of decoding.
+    FLAGS and ENUM fields take the raw value, text is padded with spaces.
+    '''
+    if field.kind in NUMERIC_KINDS:
+        if field.kind == BP:
+            value = int(round(value * 2**field.bp))
+        elif field.kind == DATE:
+            value = (value - EPOCH).days
+        return struct.pack('>' + STRUCT_CODES[(field.width, field.signed)], value)
+    width = field.width if field.width is not None else 16 - field.offset
+    if field.kind in (STR, STR_APPEND):
+        value = value.encode()
+        return value[:width] + b' ' * (width - len(value))
+    return bytes(value[:width]) + bytes(width - len(value))
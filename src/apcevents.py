@@ -0,0 +1,181 @@
+'''
+Power events detected from the raw status bits of the UPS.
+
+EventDetector reads ups_status, status_chg_cause (0x76), input_status, battery_error
+(0x70) and outlet_status (0x72) straight from the data of every received frame, so it
+does not depend on the decoded state (nor force decoding with lazy_decode), and fires
+an event when one of the CONDITIONS starts or ends. Every event carries the time the
+transport read the frame that showed the change, so the reaction to e.g. a transfer to
+battery is delayed by one frame at most.
+
+The first time a condition is seen it only fires when it is active, so a detector
+that starts during an outage still gets ON_BATTERY.
+
+Enable it on an engine with:
+
+    apccomm.events = EventDetector()
+    apccomm.events.add_listener(print, kinds=(EventKind.ON_BATTERY, EventKind.LOW_RUNTIME))
+
+or take the events from a queue:
+
+    events = apccomm.events.subscribe()
+    event = events.get()
+'''
+import queue
+import struct
+from enum import Enum, auto
+from collections import namedtuple
+from apcdecode import FIELDS, STATUS_CHG_CAUSE, STRUCT_CODES
+
+class EventKind(Enum):
+    ON_BATTERY = auto()
+    OFF_BATTERY = auto()
+    INPUT_LOST = auto()
+    INPUT_RESTORED = auto()
+    LOW_RUNTIME = auto()
+    RUNTIME_RESTORED = auto()
+    FAULT = auto()
+    FAULT_CLEARED = auto()
+    BATTERY_ERROR = auto()
+    BATTERY_ERROR_CLEARED = auto()
+    OUTPUT_OFF = auto()
+    OUTPUT_ON = auto()
+    SHUTTING_DOWN = auto()
+    COMM_ESTABLISHED = auto()
+    COMM_LOST = auto()
+
+PowerEvent = namedtuple('PowerEvent', 'kind timestamp msg_id cause')
+PowerEvent.__doc__ = '''
+kind          EventKind
+timestamp     Receive time of the frame (time.time())
+msg_id        Message ID of the frame, None for changes of the communication state
+cause         Last status change cause reported by the UPS (STATUS_CHG_CAUSE label), None when unknown
+'''
+
+WATCHED_FIELDS = ('ups_status', 'status_chg_cause', 'input_status', 'battery_error', 'outlet_status')
+
+#(condition, test of the raw values, event when it starts, event when it ends)
+CONDITIONS = (
+    ('on_battery', lambda raw: raw.get('ups_status', 0) & 4, EventKind.ON_BATTERY, EventKind.OFF_BATTERY),
+    ('input_bad', lambda raw: raw.get('ups_status', 0) & 64 or raw.get('input_status', 0) & 4096, EventKind.INPUT_LOST, EventKind.INPUT_RESTORED),
+    ('low_runtime', lambda raw: raw.get('outlet_status', 0) & 4096, EventKind.LOW_RUNTIME, EventKind.RUNTIME_RESTORED),
+    ('fault', lambda raw: raw.get('ups_status', 0) & 32, EventKind.FAULT, EventKind.FAULT_CLEARED),
+    ('battery_error', lambda raw: raw.get('battery_error', 0), EventKind.BATTERY_ERROR, EventKind.BATTERY_ERROR_CLEARED),
+    ('output_off', lambda raw: raw.get('ups_status', 0) & 16, EventKind.OUTPUT_OFF, EventKind.OUTPUT_ON),
+    ('shutting_down', lambda raw: raw.get('outlet_status', 0) & 8, EventKind.SHUTTING_DOWN, None),
+)
+
+def compile_watch(names):
+    '''
+    Per message ID: (struct reading the watched fields, their names) in a dict.
+    All watched fields of a message are read with a single unpack.
+    '''
+    fields = {}
+    for name in names:
+        msg_id, field = FIELDS[name]
+        fields.setdefault(msg_id, []).append(field)
+    watch = {}
+    for msg_id, msg_fields in fields.items():
+        msg_fields.sort(key=lambda f: f.offset)
+        fmt = '>'
+        pos = 0
+        for field in msg_fields:
+            fmt += (str(field.offset - pos) + 'x' if field.offset > pos else '') + STRUCT_CODES[(field.width, field.signed)]
+            pos = field.offset + field.width
+        watch[msg_id] = (struct.Struct(fmt), tuple(field.name for field in msg_fields))
+    return watch
+
+WATCH = compile_watch(WATCHED_FIELDS)
+
+class EventDetector:
+
+    def __init__(self):
+        self.raw = {}#Watched field -> last raw value
+        self.frames = {}#Message ID -> last unpacked raw values, to skip unchanged frames
+        self.conditions = {}#Condition -> True/False, missing until seen
+        self.listeners = ()#(callback, kinds), replaced as a whole when changed
+        self.count = 0
+
+    def add_listener(self, callback, kinds=None):
+        '''
+        Call callback(event) from the communication thread/loop for every event.
+        kinds    Only these EventKinds, None for all
+        '''
+        self.listeners = self.listeners + ((callback, None if kinds is None else frozenset(kinds)),)
+
+    def remove_listener(self, callback):
+        self.listeners = tuple(listener for listener in self.listeners if listener[0] != callback)
+
+    def subscribe(self, kinds=None):
+        ''' Queue receiving the events, from any thread '''
+        events = queue.Queue()
+        self.add_listener(events.put, kinds)
+        return events
+
+    def unsubscribe(self, events):
+        self.remove_listener(events.put)
+
+    def frame(self, msg_id, msg_data, timestamp):
+        ''' Check a received frame for changed conditions, called by the engine '''
+        watch = WATCH.get(msg_id)
+        if watch is None:
+            return
+        unpacker, names = watch
+        if len(msg_data) < unpacker.size:
+            return
+        values = unpacker.unpack_from(msg_data)
+        if self.frames.get(msg_id) == values:
+            return
+        self.frames[msg_id] = values
+        raw = self.raw
+        for name, value in zip(names, values):
+            raw[name] = value
+        for name, test, started, ended in CONDITIONS:
+            active = bool(test(raw))
+            previous = self.conditions.get(name)
+            if active == previous:
+                continue
+            self.conditions[name] = active
+            kind = started if active else ended
+            if kind is not None and (active or previous is not None):
+                self.fire(kind, timestamp, msg_id)
+
+    def comm_changed(self, online, timestamp):
+        ''' Communication established or lost, called by the engine '''
+        self.fire(EventKind.COMM_ESTABLISHED if online else EventKind.COMM_LOST, timestamp, None)
+
+    def active(self, name):
+        ''' True while a condition is active, None when not seen yet '''
+        return self.conditions.get(name)
+
+    def fire(self, kind, timestamp, msg_id):
+        cause = self.raw.get('status_chg_cause')
+        event = PowerEvent(kind, timestamp, msg_id, None if cause is None else STATUS_CHG_CAUSE.get(cause, cause))
+        self.count += 1
+        for callback, kinds in self.listeners:
+            if kinds is None or kind in kinds:
+                callback(event)
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import datetime
+
+    if len(sys.argv) != 2:
+        print("APC UPS power events\n\nUsage: " + sys.argv[0] + " <serial port>")
+        sys.exit(0)
+
+    from apcserial import ApcComm
+    from apcport import open_port
+    from apcprotocol import APC_RCV_TIMEOUT
+
+    apccomm = ApcComm(open_port(sys.argv[1], timeout=APC_RCV_TIMEOUT))
+    apccomm.events = EventDetector()
+    apccomm.events.add_listener(lambda event: print(datetime.datetime.fromtimestamp(event.timestamp).strftime('%H:%M:%S.%f')[:-3] +
+                                                    ' ' + event.kind.name + ('' if event.cause is None else ' (' + str(event.cause) + ')')))
+    apccomm.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,265 @@
+'''
+Fleet manager: communicates with many UPS units from a single process.
+
+Every serial port gets its own AsyncApcComm engine on one asyncio loop, with an
+independent reconnect policy: when the port fails or can not be opened, it is retried
+with an exponential backoff. The combined state is indexed by UPS serial number.
+
+The ports are listed in a config file, one section per port:
+
+    [/dev/ttyUSB0]
+
+    [/dev/ttyUSB1]
+    backoff_max = 120
+
+The file is re-read when it changes (or on SIGHUP), ports are added and removed on the fly.
+Ports whose options changed are restarted. When the file can not be read, the ports of
+the last config are kept.
+'''
+import os
+import sys
+import signal
+import asyncio
+import logging
+import configparser
+from apcprotocol import CommState
+from apcasync import AsyncApcComm
+from apcport import open_port
+from apcidentity import IdentityCache
+
+BACKOFF_MIN = 1.0#Seconds before the first reconnect attempt
+BACKOFF_MAX = 60.0#Maximum seconds between reconnect attempts
+CONFIG_CHECK_INTERVAL = 5.0#Seconds between checks for changes of the config file
+
+log = logging.getLogger(__name__)
+
+def read_config(path):
+    '''
+    Read the config file, returns {port name: {option: value}}.
+    Raises OSError or configparser.Error when the file can not be read.
+    '''
+    config = configparser.ConfigParser()
+    with open(path) as f:
+        config.read_file(f)
+    ports = {}
+    for name in config.sections():
+        section = config[name]
+        ports[name] = {
+            'backoff_min': section.getfloat('backoff_min', BACKOFF_MIN),
+            'backoff_max': section.getfloat('backoff_max', BACKOFF_MAX),
+        }
+    return ports
+
+def open_nonblocking(name):
+    return open_port(name, timeout=0)
+
+class FleetLink:
+    ''' One serial port of the fleet and its reconnect state '''
+
+    def __init__(self, name, backoff_min=BACKOFF_MIN, backoff_max=BACKOFF_MAX):
+        self.name = name
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.backoff = backoff_min
+        self.options = {'backoff_min': backoff_min, 'backoff_max': backoff_max}#As configured, to detect changes on reload
+        self.comm = None#Engine of the current connection, None while disconnected
+        self.task = None
+        self.reconnects = 0
+        self.last_error = None
+
+    @property
+    def snapshot(self):
+        comm = self.comm
+        return None if comm is None else comm.snapshot
+
+class FleetManager:
+    '''
+    config_path    Config file listing the ports, optional when ports are added with add_port()
+    open_port      Function (name) returning a non-blocking port for AsyncApcComm
+    identity_cache apcidentity.IdentityCache shared by all ports, to publish the static values early on reconnect
+    '''
+
+    def __init__(self, config_path=None, open_port=open_nonblocking, identity_cache=None):
+        self.config_path = config_path
+        self.open_port = open_port
+        self.identity_cache = identity_cache
+        self.config_mtime = None
+        self.links = {}#Port name -> FleetLink, replaced as a whole when ports are added or removed
+        self.listeners = ()
+        self.delta_listeners = ()
+        self.remove_listeners = ()
+
+    def add_listener(self, callback):
+        ''' Call callback(link, snapshot) for every state published by any of the ports '''
+        self.listeners = self.listeners + (callback,)
+
+    def remove_listener(self, callback):
+        self.listeners = tuple(cb for cb in self.listeners if cb is not callback)
+
+    def add_delta_listener(self, callback):
+        ''' Call callback(link, delta) with the StateDelta of the changed values of any of the ports '''
+        self.delta_listeners = self.delta_listeners + (callback,)
+
+    def remove_delta_listener(self, callback):
+        self.delta_listeners = tuple(cb for cb in self.delta_listeners if cb is not callback)
+
+    def add_remove_listener(self, callback):
+        ''' Call callback(link) from the loop when a port is removed, e.g. to drop its data '''
+        self.remove_listeners = self.remove_listeners + (callback,)
+
+    def remove_remove_listener(self, callback):
+        self.remove_listeners = tuple(cb for cb in self.remove_listeners if cb is not callback)
+
+    def add_port(self, name, **options):
+        ''' Start communicating on a port, must be called from the loop '''
+        if name in self.links:
+            return self.links[name]
+        link = FleetLink(name, **options)
+        link.task = asyncio.get_running_loop().create_task(self.run_link(link))
+        links = dict(self.links)
+        links[name] = link
+        self.links = links
+        return link
+
+    def remove_port(self, name):
+        ''' Stop communicating on a port, must be called from the loop '''
+        links = dict(self.links)
+        link = links.pop(name, None)
+        self.links = links
+        if link is not None:
+            if link.comm is not None:
+                link.comm.stop()
+            link.task.cancel()
+            for callback in self.remove_listeners:
+                callback(link)
+
+    def reload(self):
+        ''' Re-read the config file and add/remove/restart ports accordingly, the ports are kept when it can not be read '''
+        try:
+            ports = read_config(self.config_path)
+        except (OSError, configparser.Error) as e:
+            log.warning("Can not read %s, keeping the last config: %s", self.config_path, e)
+            return
+        for name in set(self.links) - set(ports):
+            self.remove_port(name)
+        for name, options in ports.items():
+            link = self.links.get(name)
+            if link is not None and link.options != options:
+                log.info("Options of %s changed, restarting it", name)
+                self.remove_port(name)
+                link = None
+            if link is None:
+                self.add_port(name, **options)
+
+    def states(self):
+        '''
+        Latest state snapshot of every UPS that identified itself, indexed by serial number.
+        Safe to call from any thread.
+        '''
+        states = {}
+        for link in self.links.values():
+            snapshot = link.snapshot
+            if snapshot is not None and 'serial_nb' in snapshot.values:
+                states[snapshot.values['serial_nb'].strip()] = snapshot
+        return states
+
+    def get(self, serial_nb):
+        ''' Latest state snapshot of the UPS with the given serial number, or None '''
+        return self.states().get(serial_nb)
+
+    async def run_link(self, link):
+        ''' Keep a port connected, reconnecting with exponential backoff '''
+        def publish(snapshot):
+            if comm.state == CommState.MODE1:
+                link.backoff = link.backoff_min
+            for callback in self.listeners:
+                callback(link, snapshot)
+
+        def publish_delta(delta):
+            for callback in self.delta_listeners:
+                callback(link, delta)
+
+        while self.links.get(link.name) is link:
+            port = None
+            try:
+                port = self.open_port(link.name)
+                comm = AsyncApcComm(port)
+                comm.identity_cache = self.identity_cache
+                comm.add_listener(publish)
+                comm.add_delta_listener(publish_delta)
+                link.comm = comm
+                await comm.run()
+            except OSError as e:
+                link.last_error = e
+                log.warning("%s failed: %s", link.name, e)
+            except Exception as e:
+                #Keep the other ports running, whatever went wrong on this one
+                link.last_error = e
+                log.exception("%s failed", link.name)
+            finally:
+                link.comm = None
+                if port is not None:
+                    port.close()
+            link.reconnects += 1
+            await asyncio.sleep(link.backoff)
+            link.backoff = min(link.backoff * 2, link.backoff_max)
+
+    async def run(self):
+        ''' Run the fleet, re-reading the config file when it changes '''
+        loop = asyncio.get_running_loop()
+        if hasattr(signal, 'SIGHUP'):
+            loop.add_signal_handler(signal.SIGHUP, self.reload)
+        try:
+            while True:
+                if self.config_path is not None:
+                    try:
+                        mtime = os.stat(self.config_path).st_mtime
+                    except OSError as e:
+                        #E.g. replaced by an editor right now, keep the last config
+                        log.warning("Can not read %s, keeping the last config: %s", self.config_path, e)
+                        mtime = self.config_mtime
+                    if mtime != self.config_mtime:
+                        self.config_mtime = mtime
+                        self.reload()
+                await asyncio.sleep(CONFIG_CHECK_INTERVAL)
+        finally:
+            for name in list(self.links):
+                self.remove_port(name)
+
+async def print_fleet(fleet, interval=5.0):
+    ''' Print a status line per port at a fixed interval '''
+    while True:
+        await asyncio.sleep(interval)
+        for name, link in sorted(fleet.links.items()):
+            snapshot = link.snapshot
+            if snapshot is None:
+                print(name + ": disconnected (" + str(link.last_error) + ")")
+                continue
+            values = snapshot.values
+            print(name + ": " + str(values.get('serial_nb', '?')).strip() + " " + values['comm_state'] +
+                  " " + str(values.get('ups_status', '')) + " soc=" + str(values.get('battery_soc', '?')))
+
+if __name__ == '__main__':
+
+    if len(sys.argv) not in (2, 3):
+        print("APC UPS fleet manager\n\nUsage: " + sys.argv[0] + " <config file> [<Prometheus metrics HTTP port>]")
+        sys.exit(0)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    identity_cache = IdentityCache(os.path.splitext(sys.argv[1])[0] + '-identity.json')
+
+    async def main():
+        fleet = FleetManager(sys.argv[1], identity_cache=identity_cache)
+        if len(sys.argv) == 3:
+            from apcmetrics import MetricsExporter
+            exporter = MetricsExporter()
+            exporter.attach_fleet(fleet)
+            exporter.serve(int(sys.argv[2]))
+        await asyncio.gather(fleet.run(), print_fleet(fleet))
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    identity_cache.flush()#Written by a daemon thread, which would be killed on exit
@@ -0,0 +1,80 @@
+'''
+Frame synchronisation for the Microlink byte stream.
+
+The serial port does not preserve message boundaries: a read can return half a frame,
+or the tail of one frame followed by the start of the next. FrameSync buffers the
+incoming bytes and slides a frame-sized window over them until the Fletcher checksum
+at the end of the window matches, so a corrupted byte only costs the frame it was in.
+'''
+from checksum.fletcherNbit import Fletcher
+
+FRAME_SIZE = 19#Message ID + 16 data bytes + 2 checksum bytes
+BUFFER_SIZE = 256#Maximum number of bytes kept while looking for a frame
+
+def verify_frame(frame):
+    ''' Check the Fletcher checkbytes at the end of a frame '''
+    f8 = Fletcher()
+    f8.update(frame[0:-2])
+    return frame[-2] == f8.cb0 and frame[-1] == f8.cb1
+
+class FrameSync:
+    '''
+    Ring buffer of received bytes that yields every valid frame it contains.
+
+    frame_size    Size of a complete frame (ID + data + checksum)
+    verify        Callable that checks the checksum of a candidate frame
+    buffer_size   Oldest bytes are dropped when more than this is buffered
+    '''
+
+    def __init__(self, frame_size=FRAME_SIZE, verify=verify_frame, buffer_size=BUFFER_SIZE):
+        self.frame_size = frame_size
+        self.verify = verify
+        self.buffer_size = buffer_size
+
+        self.buf = bytearray()
+        self.pos = 0#Read position in buf, bytes before this are consumed
+        self.discarded = 0#Number of bytes dropped because they were not part of a valid frame
+        self.received = 0#Number of bytes fed
+        self.frame_count = 0
+
+    def __len__(self):
+        return len(self.buf) - self.pos
+
+    def needed(self):
+        ''' Number of bytes still missing for the next candidate frame '''
+        return max(self.frame_size - len(self), 1)
+
+    def feed(self, data):
+        ''' Add received bytes to the buffer '''
+        if self.pos > 0 and self.pos >= len(self.buf) // 2:
+            #Compact instead of shifting on every consumed frame
+            del self.buf[:self.pos]
+            self.pos = 0
+        self.buf += bytes(data)
+        self.received += len(data)
+        overflow = len(self) - self.buffer_size
+        if overflow > 0:
+            self.pos += overflow
+            self.discarded += overflow
+
+    def frames(self):
+        ''' Yield every valid frame in the buffer, dropping bytes that can not start one '''
+        while len(self) >= self.frame_size:
+            end = self.pos + self.frame_size
+            frame = self.buf[self.pos:end]
+            if self.verify(frame):
+                self.pos = end
+                self.frame_count += 1
+                yield frame
+            else:
+                #Slide the window by one byte
+                self.pos += 1
+                self.discarded += 1
+
+    def flush(self):
+        ''' Empty the buffer and return the bytes that did not form a frame '''
+        data = self.buf[self.pos:]
+        self.discarded += len(data)
+        self.buf = bytearray()
+        self.pos = 0
+        return data
@@ -0,0 +1,200 @@
+'''
+In-process history of the numeric UPS telemetry.
+
+History keeps the recent values of a few numeric fields in fixed-size ring buffers:
+one time column (array('d')) and one array('f') column per field, allocated once, so
+the memory use is bounded and known up front no matter how long the program runs.
+There are three tiers:
+
+    raw    Every change of one of the fields, as published by the engine
+    1s     Mean per second
+    1min   Mean per minute
+
+Attach History to the engine, it then decodes its fields from the data of the frames
+of their message IDs, without the decoded state (so also with lazy_decode):
+
+    history = History()
+    history.attach(apccomm)
+    times, values = history.query('voltage_in', start=time.time() - 600, tier='1s')
+
+History.record can be registered as a listener instead, to take the values from every
+published state.
+
+The query results are arrays, numpy.frombuffer() turns them into NumPy arrays without a copy.
+Missing values (field not received yet, or no sample in a bucket) are NaN.
+'''
+import math
+import threading
+from array import array
+from apcdecode import FIELDS, compile_field
+
+HISTORY_FIELDS = ('voltage_in', 'voltage_out', 'current_out', 'frequency_in', 'battery_voltage',
+                  'battery_soc', 'runtime_remaining_2', 'temperature')
+
+RAW_SIZE = 65536#Rows of the raw tier, a few hours at the usual rate of changes
+RETENTION_1S = 24 * 3600#Seconds kept in the 1s tier
+RETENTION_1MIN = 90 * 24 * 3600#Seconds kept in the 1min tier
+
+NAN = float('nan')
+
+def _bisect(ring, timestamp):
+    ''' First logical row of the ring with a time >= timestamp '''
+    lo, hi = 0, ring.count
+    times, start, size = ring.times, ring.start, ring.size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if times[(start + mid) % size] < timestamp:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+class Ring:
+    ''' Fixed number of rows with a time column and a float column per field, the oldest rows are overwritten '''
+
+    def __init__(self, fields, size):
+        self.size = size
+        self.times = array('d', bytes(8 * size))
+        self.columns = tuple(array('f', bytes(4 * size)) for _ in fields)
+        self.index = {field: column for field, column in zip(fields, self.columns)}
+        self.start = 0#Physical position of the oldest row
+        self.count = 0
+
+    def append(self, timestamp, row):
+        pos = self.start + self.count
+        if pos >= self.size:
+            pos -= self.size
+        if self.count == self.size:
+            self.start = self.start + 1 if self.start + 1 < self.size else 0
+        else:
+            self.count += 1
+        self.times[pos] = timestamp
+        for column, value in zip(self.columns, row):
+            column[pos] = value
+
+    def copy(self, column, lo, hi):
+        ''' Copy of the logical rows lo..hi-1 of a column '''
+        begin = self.start + lo
+        end = self.start + hi
+        if end <= self.size:
+            return column[begin:end]
+        if begin >= self.size:
+            return column[begin - self.size:end - self.size]
+        return column[begin:] + column[:end - self.size]
+
+    def query(self, field, start=None, end=None):
+        lo = 0 if start is None else _bisect(self, start)
+        hi = self.count if end is None else _bisect(self, end)
+        return self.copy(self.times, lo, hi), self.copy(self.index[field], lo, hi)
+
+    def memory(self):
+        return self.times.itemsize * self.size + sum(column.itemsize * self.size for column in self.columns)
+
+class Tier:
+    ''' Ring of mean values per interval '''
+
+    def __init__(self, fields, interval, retention):
+        self.interval = interval
+        self.ring = Ring(fields, int(retention // interval))
+        self.bucket = None
+        self.sums = [0.0] * len(fields)
+        self.counts = [0] * len(fields)
+
+    def add(self, timestamp, row):
+        bucket = int(timestamp // self.interval)
+        if bucket != self.bucket:
+            self.flush()
+            self.bucket = bucket
+        sums, counts = self.sums, self.counts
+        for i, value in enumerate(row):
+            if value == value:#Not NaN
+                sums[i] += value
+                counts[i] += 1
+
+    def flush(self):
+        if self.bucket is None:
+            return
+        self.ring.append(self.bucket * self.interval,
+                         [total / count if count else NAN for total, count in zip(self.sums, self.counts)])
+        self.sums = [0.0] * len(self.sums)
+        self.counts = [0] * len(self.counts)
+
+class History:
+    '''
+    fields           Numeric state keys to keep
+    raw_size         Number of rows of the raw tier
+    retention_1s     Seconds kept in the 1s tier
+    retention_1min   Seconds kept in the 1min tier
+    '''
+
+    def __init__(self, fields=HISTORY_FIELDS, raw_size=RAW_SIZE, retention_1s=RETENTION_1S, retention_1min=RETENTION_1MIN):
+        self.fields = tuple(fields)
+        self.raw = Ring(self.fields, raw_size)
+        self.tiers = {'1s': Tier(self.fields, 1, retention_1s), '1min': Tier(self.fields, 60, retention_1min)}
+        self.last = None#Last raw row, to only store changes
+        self.lock = threading.Lock()
+        self.decoders = {}#Message ID -> decoders of the fields in it, for frame()
+        for field in self.fields:
+            msg_id, decoder_field = FIELDS[field]
+            self.decoders[msg_id] = self.decoders.get(msg_id, ()) + (compile_field(decoder_field),)
+        self.values = {}#Fields decoded by frame()
+
+    def attach(self, comm):
+        ''' Record from the frames of an engine (ApcComm or AsyncApcComm) '''
+        comm.add_frame_listener(self.frame, msg_ids=self.decoders)
+
+    def frame(self, msg_id, msg_data, timestamp):
+        ''' Decode the fields in the data of a received frame and add them, use as a frame listener of the engine '''
+        decoders = self.decoders.get(msg_id)
+        if decoders is None:
+            return
+        values = self.values
+        for decode in decoders:
+            decode(msg_data, values)
+        self.add(timestamp, values)
+
+    def record(self, snapshot):
+        ''' Add the fields of a published state, use as a listener of the engine '''
+        self.add(snapshot.timestamp, snapshot.values)
+
+    def add(self, timestamp, values):
+        row = tuple(values.get(field) for field in self.fields)
+        row = [NAN if value is None else value for value in row] if None in row else row
+        with self.lock:
+            if row != self.last:
+                self.raw.append(timestamp, row)
+                self.last = row
+            for tier in self.tiers.values():
+                tier.add(timestamp, row)
+
+    def ring(self, tier):
+        if tier == 'raw':
+            return self.raw
+        try:
+            return self.tiers[tier].ring
+        except KeyError:
+            raise ValueError("Unknown history tier " + repr(tier))
+
+    def query(self, field, start=None, end=None, tier='raw'):
+        '''
+        Values of a field from start (inclusive) to end (exclusive), as (times, values) arrays.
+        The times of the 1s and 1min tiers are the start of each interval, the interval that
+        is still being collected is not included.
+        '''
+        ring = self.ring(tier)
+        if field not in ring.index:
+            raise KeyError(field)
+        with self.lock:
+            return ring.query(field, start, end)
+
+    def summary(self, field, start=None, end=None, tier='raw'):
+        ''' (min, mean, max) of the values of a field in a time range, None when there are none '''
+        _, values = self.query(field, start, end, tier)
+        values = [value for value in values if not math.isnan(value)]
+        if not values:
+            return None
+        return min(values), sum(values) / len(values), max(values)
+
+    def memory(self):
+        ''' Bytes allocated for all tiers '''
+        return self.raw.memory() + sum(tier.ring.memory() for tier in self.tiers.values())
@@ -0,0 +1,124 @@
+'''
+On-disk cache of the static identification data of UPS units.
+
+After a reconnect, MODE0 walks all message IDs once before the UPS sends the challenge
+with 0x7f, so the type, SKU, firmware and other identification values only come in
+one by one. IdentityCache keeps the data of the static message IDs and the challenge
+password (0x7e) per serial number, so as soon as 0x00 and 0x40 arrived the engine can
+publish all static values and answer the challenge, skipping the rest of the walk.
+
+An entry is only used when the header and the serial number received in this MODE0 are
+exactly the cached ones. The UPS validates the shortcut: when it does not echo the
+answer, e.g. because it issued a new password, the engine invalidates the entry and
+the next MODE0 walks all message IDs and stores the entry again.
+
+Enable it on an engine with:
+
+    apccomm.identity_cache = IdentityCache('/var/cache/apcups-identity.json')
+'''
+import os
+import json
+import time
+import threading
+
+STATIC_IDS = (0x00, 0x40, 0x41, 0x42, 0x43, 0x44, 0x45, 0x46, 0x48, 0x4b)#Message IDs that do not change
+REQUIRED_IDS = (0x00, 0x40)#Message IDs identifying the UPS
+CHALLENGE_ID = 0x7e#Message ID holding the challenge password
+CACHED_IDS = STATIC_IDS + (CHALLENGE_ID,)
+
+class IdentityCache:
+    ''' path    JSON file, created when the first entry is stored '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()#Engines on several threads can share a cache
+        self.writer = None#Thread writing the file, so store() does not block the engine
+        self.entries = {}#Serial number raw bytes as hex -> {'time': ..., 'frames': {hex message ID: hex data}}
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, header_data, serial_data):
+        '''
+        Cached static frames {message ID: data} of the UPS with this serial number (data of 0x40),
+        None when unknown or when the header (data of 0x00) does not match.
+        '''
+        with self.lock:
+            entry = self.entries.get(bytes(serial_data).hex())
+        if entry is None:
+            self.misses += 1
+            return None
+        frames = {int(msg_id, 16): bytearray.fromhex(data) for msg_id, data in entry['frames'].items()
+                  if int(msg_id, 16) in CACHED_IDS}
+        if frames.get(0x00) != header_data or frames.get(0x40) != serial_data:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return frames
+
+    def store(self, frames):
+        '''
+        Store the static and challenge frames {message ID: data} received in MODE0.
+        The file is written from a background thread, and only when the entry changed.
+        '''
+        if not all(msg_id in frames for msg_id in REQUIRED_IDS):
+            return
+        cached = {'%02x' % msg_id: bytes(frames[msg_id]).hex() for msg_id in CACHED_IDS if msg_id in frames}
+        key = bytes(frames[0x40]).hex()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['frames'] == cached:
+                return
+            self.entries[key] = {
+                'time': time.time(),
+                'serial_nb': bytes(frames[0x40][0:14]).decode(errors='replace').strip(),
+                'frames': cached,
+            }
+        self.save_later()
+
+    def invalidate(self, serial_data):
+        ''' Drop the entry of the UPS with this serial number (data of 0x40), e.g. when the UPS rejected the shortcut '''
+        with self.lock:
+            if self.entries.pop(bytes(serial_data).hex(), None) is None:
+                return
+        self.save_later()
+
+    def save_later(self):
+        ''' Write the file from a background thread, a running writer picks up later changes '''
+        with self.lock:
+            self.dirty = True
+            if self.writer is not None:
+                return
+            writer = self.writer = threading.Thread(target=self.write_changes, name='identity-cache', daemon=True)
+        writer.start()
+
+    def write_changes(self):
+        while True:
+            with self.lock:
+                if not self.dirty:
+                    self.writer = None
+                    return
+                self.dirty = False
+                entries = json.dumps(self.entries, indent=1)
+            try:
+                self.save(entries)
+            except OSError:
+                pass#The cache is only an optimisation, the entries are written with the next change
+
+    def flush(self):
+        ''' Wait until the file is written '''
+        writer = self.writer
+        if writer is not None:
+            writer.join()
+
+    def save(self, data):
+        ''' Write the file atomically '''
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
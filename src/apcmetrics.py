@@ -0,0 +1,245 @@
+'''
+Prometheus metrics endpoint for the decoded UPS state.
+
+MetricsExporter keeps the exposition text of every metric family rendered. It is fed
+with the changed values only (StateDelta, see ApcProtocol.add_delta_listener), and
+re-renders just the lines of those values. A scrape joins the cached family blocks,
+only the families that changed since the previous scrape are joined again.
+
+Exposed, labelled with the UPS serial number:
+- numeric fields as gauges apc_<field>
+- flag fields as one gauge per flag, apc_<field>{flag="..."} 0 or 1
+- enumerations by their raw value, dates as apc_<field>_timestamp_seconds
+- the texts (type, SKU, firmware, ...) as labels of apc_ups_info
+- apc_up, 1 while the communication is established
+
+Single engine:
+
+    exporter = MetricsExporter()
+    exporter.attach(apccomm)
+    exporter.serve(9101)
+
+For a ShardedCollector, whose listeners get the changes already:
+
+    collector.add_listener(lambda port, snapshot, changes: exporter.update(port, changes, snapshot.values))
+'''
+import sys
+import threading
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from apcdecode import REGISTER_MAP, INT, BP, DATE, FLAGS, ENUM
+
+METRICS_PORT = 9101
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+PREFIX = 'apc_'
+
+INFO_FIELDS = ('ups_type', 'ups_sku', 'fw_version_1', 'fw_version_2', 'fw_version_3', 'fw_version_4',
+               'battery_sku', 'ups_name', 'outlet_name')
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _gauge(family):
+    def render(serial, value):
+        return '%s{serial="%s"} %s\n' % (family, serial, value)
+    return render
+
+def _date_gauge(family):
+    def render(serial, value):
+        timestamp = value.replace(tzinfo=datetime.timezone.utc).timestamp()
+        return '%s{serial="%s"} %s\n' % (family, serial, timestamp)
+    return render
+
+def _flag_gauges(family, table):
+    flags = [(bit, escape(label)) for bit, label in table if bit != 0]
+    def render(serial, value):
+        return ''.join('%s{serial="%s",flag="%s"} %d\n' % (family, serial, label, 1 if value & bit else 0) for bit, label in flags)
+    return render
+
+def _up(serial, value):
+    return '%sup{serial="%s"} %d\n' % (PREFIX, serial, 1 if value == 'online' else 0)
+
+def build_renderers():
+    '''
+    Families {name: (type, help)} and renderers {state key: (family, function (serial, value) -> lines)}.
+    Flags and enumerations are rendered from their <name>_raw key.
+    '''
+    families = {PREFIX + 'up': ('gauge', "1 while the communication with the UPS is established"),
+                PREFIX + 'ups_info': ('gauge', "Identification of the UPS, in the labels")}
+    renderers = {'comm_state': (PREFIX + 'up', _up)}
+    for msg_id, fields in sorted(REGISTER_MAP.items()):
+        for field in fields:
+            family = PREFIX + field.name
+            source = "Message 0x%02x, offset %d" % (msg_id, field.offset)
+            if field.kind in (INT, BP):
+                families[family] = ('gauge', source)
+                renderers[field.name] = (family, _gauge(family))
+            elif field.kind == DATE:
+                family += '_timestamp_seconds'
+                families[family] = ('gauge', source + ", days since 2000 as Unix time")
+                renderers[field.name] = (family, _date_gauge(family))
+            elif field.kind == FLAGS:
+                families[family] = ('gauge', source + ", 1 for every flag that is set")
+                renderers[field.name + '_raw'] = (family, _flag_gauges(family, field.table))
+            elif field.kind == ENUM:
+                families[family] = ('gauge', source + ", raw value")
+                renderers[field.name + '_raw'] = (family, _gauge(family))
+    return families, renderers
+
+FAMILIES, RENDERERS = build_renderers()
+
+class Family:
+    ''' Rendered lines of one metric family per UPS, and the cached block of all of them '''
+
+    def __init__(self, name, kind, help_text):
+        self.header = '# HELP %s %s\n# TYPE %s %s\n' % (name, escape(help_text), name, kind)
+        self.lines = {}#Source -> rendered lines
+        self.block = b''
+
+    def render(self):
+        self.block = (self.header + ''.join(self.lines.values())).encode() if self.lines else b''
+
+class MetricsExporter:
+
+    def __init__(self):
+        self.families = {name: Family(name, kind, help_text) for name, (kind, help_text) in FAMILIES.items()}
+        self.serials = {}#Source -> serial number label
+        self.info = {}#Source -> {info field: value}
+        self.dirty = set()#Families changed since the last scrape
+        self.body = ()
+        self.length = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def update(self, source, changes, values):
+        '''
+        Re-render the lines of the changed values of a UPS.
+        source    Hashable identifying the UPS, e.g. its engine or port name
+        changes   {state key: new value}, None for a removed key, whose lines are removed
+        values    Complete current state, to label the lines and render them all when the serial number changes
+        '''
+        serial = values.get('serial_nb')
+        if serial is None:
+            return#Not identified yet
+        serial = escape(serial.strip())
+        with self.lock:
+            if self.serials.get(source) != serial:
+                self.serials[source] = serial
+                self.remove_lines(source)
+                changes = values
+            for key, value in changes.items():
+                renderer = RENDERERS.get(key)
+                if renderer is not None:
+                    family, render = renderer
+                    if value is None:
+                        if self.families[family].lines.pop(source, None) is not None:
+                            self.dirty.add(family)
+                        continue
+                    self.families[family].lines[source] = render(serial, value)
+                    self.dirty.add(family)
+                elif key in INFO_FIELDS:
+                    info = self.info.setdefault(source, {})
+                    if value is None:
+                        info.pop(key, None)
+                    else:
+                        info[key] = value
+                    labels = ''.join(',%s="%s"' % (name, escape(str(info[name]).strip())) for name in INFO_FIELDS if name in info)
+                    self.families[PREFIX + 'ups_info'].lines[source] = '%sups_info{serial="%s"%s} 1\n' % (PREFIX, serial, labels)
+                    self.dirty.add(PREFIX + 'ups_info')
+
+    def remove(self, source):
+        ''' Stop exporting a UPS '''
+        with self.lock:
+            self.remove_lines(source)
+            self.serials.pop(source, None)
+
+    def remove_lines(self, source):
+        self.info.pop(source, None)
+        for name, family in self.families.items():
+            if family.lines.pop(source, None) is not None:
+                self.dirty.add(name)
+
+    def attach(self, comm):
+        ''' Export the state of an engine (ApcComm or AsyncApcComm) '''
+        self.update(comm, comm.ups_state, comm.ups_state)
+        comm.add_delta_listener(lambda delta: self.update(comm, delta.changes, comm.ups_state))
+
+    def attach_fleet(self, fleet):
+        ''' Export the state of all ports of an apcfleet.FleetManager, the lines of removed ports are removed '''
+        def on_delta(link, delta):
+            snapshot = link.snapshot
+            if snapshot is not None and fleet.links.get(link.name) is link:
+                self.update(link.name, delta.changes, snapshot.values)
+        fleet.add_delta_listener(on_delta)
+        fleet.add_remove_listener(lambda link: self.remove(link.name))
+
+    def blocks(self):
+        '''
+        Exposition text as a tuple of cached blocks, and its total length.
+        Only the families that changed since the previous call are rendered again.
+        '''
+        with self.lock:
+            if self.dirty:
+                for name in self.dirty:
+                    self.families[name].render()
+                self.dirty.clear()
+                self.body = tuple(family.block for family in self.families.values() if family.block)
+                self.length = sum(len(block) for block in self.body)
+            return self.body, self.length
+
+    def render(self):
+        ''' Exposition text '''
+        return b''.join(self.blocks()[0])
+
+    def serve(self, port=METRICS_PORT, host=''):
+        ''' Serve the metrics over HTTP on /metrics, from a background thread '''
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                blocks, length = exporter.blocks()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(length))
+                self.end_headers()
+                self.wfile.writelines(blocks)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        return self.server
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+if __name__ == '__main__':
+
+    if len(sys.argv) not in (2, 3):
+        print("APC UPS Prometheus exporter\n\nUsage: " + sys.argv[0] + " <serial port> [<HTTP port, default " + str(METRICS_PORT) + ">]")
+        sys.exit(0)
+
+    import time
+    from apcserial import ApcComm
+    from apcport import open_port
+    from apcprotocol import APC_RCV_TIMEOUT
+
+    apccomm = ApcComm(open_port(sys.argv[1], timeout=APC_RCV_TIMEOUT))
+    exporter = MetricsExporter()
+    exporter.attach(apccomm)
+    exporter.serve(int(sys.argv[2]) if len(sys.argv) == 3 else METRICS_PORT)
+    apccomm.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,74 @@
+'''
+Serial port access for the transports.
+
+FdPort offers the part of the pyserial Serial interface the UPS communication uses
+(read, write, fileno, close) on a plain file descriptor, e.g. a pseudo-terminal.
+With timeout=0 it never blocks, so it can be driven from an asyncio loop.
+'''
+import os
+import select
+import termios
+import tty
+
+class FdPort:
+    '''
+    port       Device path, or an already opened file descriptor
+    timeout    Read timeout in seconds, 0 for non-blocking reads, None to block
+    baudrate   Line speed, only applied to real terminals
+    '''
+
+    def __init__(self, port, timeout=None, baudrate=9600):
+        if isinstance(port, int):
+            self.fd = port
+            self.name = 'fd ' + str(port)
+        else:
+            self.fd = os.open(port, os.O_RDWR | os.O_NOCTTY)
+            self.name = port
+        self.timeout = timeout
+
+        if os.isatty(self.fd):
+            tty.setraw(self.fd)
+            speed = getattr(termios, 'B' + str(baudrate))
+            attrs = termios.tcgetattr(self.fd)
+            attrs[4] = speed#ispeed
+            attrs[5] = speed#ospeed
+            termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+        os.set_blocking(self.fd, False)
+
+    def fileno(self):
+        return self.fd
+
+    def read(self, size=1):
+        ''' Read up to size bytes, returns an empty bytes object when nothing arrived within the timeout '''
+        if self.timeout != 0:
+            ready, _, _ = select.select([self.fd], [], [], self.timeout)
+            if not ready:
+                return b''
+        try:
+            return os.read(self.fd, size)
+        except BlockingIOError:
+            return b''
+
+    def write(self, data):
+        data = memoryview(bytes(data))
+        while len(data) > 0:
+            try:
+                written = os.write(self.fd, data)
+            except BlockingIOError:
+                select.select([], [self.fd], [])
+                continue
+            data = data[written:]
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def open_port(name, timeout=None):
+    ''' Open a serial port with the settings of the UPS (9600 baud, 8N1) '''
+    import serial
+    return serial.Serial(name, 9600, timeout=timeout, parity=serial.PARITY_NONE)
+
+def open_fd_port(name):
+    ''' Open a terminal or pseudo-terminal as a non-blocking FdPort, without pyserial '''
+    return FdPort(name, timeout=0)
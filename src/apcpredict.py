@@ -0,0 +1,146 @@
+'''
+Runtime prediction from the streaming battery and load values.
+
+The runtime_remaining_2 of the UPS follows a load step only slowly. RuntimePredictor
+makes its own estimate on every 0x6d/0x6f frame, with O(1) work per frame and no
+history:
+
+    power          real_power_pctused * real_power_rating, smoothed with a short
+                   time constant (POWER_TAU), so load steps show within seconds
+    capacity       Energy of a full battery. While on battery it is measured: the energy
+                   used divided by the SOC drop, every time the SOC dropped MIN_SOC_STEP.
+                   Until then it is derived from the UPS figure (runtime * power / SOC).
+                   Both are smoothed with CAPACITY_TAU
+    runtime        battery_soc * capacity / power
+
+The smoothing keeps the variance as well. The confidence band (low, high) is the runtime
+for power and capacity each BAND_SIGMAS standard deviations worse and better.
+
+battery_voltage is not used. Under load it depends on the discharge current, the
+temperature and the age of the battery. Turning it into remaining energy would need the
+discharge curve of the battery, which the UPS does not report. The UPS already uses it for
+battery_soc, and the energy measured per SOC drop corrects for a SOC that is off.
+The prediction only counts once measured is True, see apcshutdown.
+
+An update takes a few microseconds, see benchPredict.py.
+
+    predictor = RuntimePredictor()
+    predictor.attach(apccomm)
+    predictor.prediction.runtime, predictor.prediction.low, predictor.prediction.ups_runtime
+'''
+import math
+from collections import namedtuple
+
+POWER_TAU = 5.0#Time constant in seconds of the power smoothing
+CAPACITY_TAU = 300.0#Time constant in seconds of the capacity smoothing
+MIN_SOC_STEP = 0.1#SOC drop in % per capacity measurement, finer steps are dominated by the SOC resolution
+BAND_SIGMAS = 2.0#Width of the confidence band in standard deviations
+MIN_POWER = 1.0#Watts below which no runtime is predicted
+
+RuntimePrediction = namedtuple('RuntimePrediction', 'timestamp runtime low high ups_runtime power capacity')
+RuntimePrediction.__doc__ = '''
+timestamp     Time of the frame the prediction was made for (time.time())
+runtime       Predicted seconds until the battery is empty, None without load or data
+low, high     Confidence band of runtime in seconds
+ups_runtime   runtime_remaining_2 as reported by the UPS, for comparison
+power         Smoothed real power in W
+capacity      Estimated energy of a full battery in Ws
+'''
+
+class Ewma:
+    ''' Exponentially weighted mean and variance of irregularly timed samples '''
+    __slots__ = ('tau', 'mean', 'var', 'time')
+
+    def __init__(self, tau):
+        self.tau = tau
+        self.mean = None
+        self.var = 0.0
+        self.time = None
+
+    def update(self, value, timestamp):
+        if self.mean is None:
+            self.mean = value
+            self.time = timestamp
+            return
+        alpha = 1.0 - math.exp(-max(timestamp - self.time, 0.0) / self.tau)
+        diff = value - self.mean
+        self.mean += alpha * diff
+        self.var = (1.0 - alpha) * (self.var + alpha * diff * diff)
+        self.time = timestamp
+
+    @property
+    def std(self):
+        return math.sqrt(self.var)
+
+class RuntimePredictor:
+
+    def __init__(self, power_tau=POWER_TAU, capacity_tau=CAPACITY_TAU):
+        self.power = Ewma(power_tau)
+        self.capacity = Ewma(capacity_tau)
+        self.measured = False#True once the capacity was measured on battery
+        self.last_power = None#Last raw power in W, held until the next frame
+        self.last_time = None
+        self.energy = 0.0#Ws used since the SOC mark
+        self.soc_mark = None#SOC at the start of the current capacity measurement
+        self.prediction = RuntimePrediction(None, None, None, None, None, None, None)
+        self.listeners = ()
+
+    def add_listener(self, callback):
+        ''' Call callback(prediction) for every new prediction '''
+        self.listeners = self.listeners + (callback,)
+
+    def remove_listener(self, callback):
+        self.listeners = tuple(cb for cb in self.listeners if cb is not callback)
+
+    def attach(self, comm):
+        ''' Predict from the 0x6d/0x6f frames of an engine (ApcComm or AsyncApcComm) '''
+        comm.add_delta_listener(lambda delta: self.update(comm.ups_state, delta.timestamp), msg_ids=(0x6d, 0x6f))
+
+    def update(self, values, timestamp):
+        ''' Update with the current state, returns the new RuntimePrediction '''
+        pct = values.get('real_power_pctused')
+        rating = values.get('real_power_rating')
+        soc = values.get('battery_soc')
+        ups_runtime = values.get('runtime_remaining_2')
+        on_battery = bool(values.get('ups_status_raw', 0) & 4)
+        if self.last_power is not None and on_battery:
+            self.energy += self.last_power * (timestamp - self.last_time)
+        self.last_time = timestamp
+        if pct is None or not rating or soc is None:
+            return self.prediction
+        power = pct / 100.0 * rating
+        self.last_power = power
+        self.power.update(power, timestamp)
+
+        if not on_battery:
+            self.soc_mark = None
+            if not self.measured and ups_runtime and soc > 0 and power >= MIN_POWER:
+                self.capacity.update(ups_runtime * power / (soc / 100.0), timestamp)
+        elif self.soc_mark is None or soc > self.soc_mark:
+            self.soc_mark = soc
+            self.energy = 0.0
+        elif self.soc_mark - soc >= MIN_SOC_STEP:
+            if not self.measured:
+                self.measured = True
+                self.capacity.var = 0.0#Start the variance over with the measurements
+            self.capacity.update(self.energy / ((self.soc_mark - soc) / 100.0), timestamp)
+            self.soc_mark = soc
+            self.energy = 0.0
+
+        self.prediction = self.predict(timestamp, soc, ups_runtime)
+        for callback in self.listeners:
+            callback(self.prediction)
+        return self.prediction
+
+    def predict(self, timestamp, soc, ups_runtime):
+        power = self.power.mean
+        capacity = self.capacity.mean
+        if capacity is None or power < MIN_POWER:
+            return RuntimePrediction(timestamp, None, None, None, ups_runtime, power, capacity)
+        energy = soc / 100.0 * capacity
+        runtime = energy / power
+        capacity_band = BAND_SIGMAS * self.capacity.std
+        power_band = BAND_SIGMAS * self.power.std
+        low = max(energy - soc / 100.0 * capacity_band, 0.0) / (power + power_band)
+        high = (energy + soc / 100.0 * capacity_band) / max(power - power_band, MIN_POWER)
+        return RuntimePrediction(timestamp, runtime, low, high, ups_runtime, power, capacity)
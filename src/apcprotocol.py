@@ -0,0 +1,513 @@
+'''
+Microlink protocol engine, independent of how the bytes are transported.
+
+ApcProtocol holds the communication state machine (INIT -> INIT_RESET -> MODE0 -> MODE1),
+the decoded UPS state and the queue of messages to write. A transport only has to
+write next_apc_cmd() to the UPS, receive the reply and pass it to handle_reply(),
+see ApcComm (threaded, blocking serial port) and AsyncApcComm (asyncio).
+'''
+import time
+import queue
+import datetime
+import threading
+from enum import Enum, auto
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from checksum.fletcherNbit import Fletcher
+from apcframe import FrameSync
+from apcdecode import MESSAGE_KEYS, complete_frames
+from apcstate import make_snapshot, StateDelta
+from apcrecord import UpsState, LazyUpsState
+from apccapture import TX, RX
+from apcidentity import CACHED_IDS, CHALLENGE_ID
+
+APC_RCV_TIMEOUT = 0.25#Upper bound on the time to wait for a reply
+APC_RCV_SIZE = 19#Default frame size (ID + 16 data bytes + checksum), until the UPS reports msg_size
+# APC_RCV_TIMEOUT = 0.5
+APC_IDLE_TIMEOUT = 0.05#Quiet time after the last received byte that ends a reply without a valid frame
+APC_CMD_TIMEOUT = 5.0#Default time to wait for a command to be echoed by the UPS
+APC_CMD_READBACKS = 3#Times a written message is read back with BACK when its echo arrives corrupted
+APC_RESET_DELAY = 1.0#Time to wait before resetting the UPS communication
+
+APC_CMD_INIT = [0xF7, 0xFD]
+APC_CMD_BACK = [0xF7]
+APC_CMD_RESET = [0xFD]
+APC_CMD_NEXT = [0xFE]
+
+class CommState(Enum):
+    INIT = auto()
+    INIT_RESET = auto()
+    MODE0 = auto()
+    MODE1 = auto()
+
+def calculate_challenge(series_id_raw, header_raw, serial_nb_raw, password_1):
+    ''' Calculate the answer to the challenge of the UPS from its identification data '''
+    b0 = series_id_raw[1]
+    b1 = series_id_raw[0]
+    for header_byte in header_raw:
+        b0 = (b0 + header_byte) % 255
+        b1 = (b1 + b0) % 255
+    for serial_nb_byte in serial_nb_raw:
+        b0 = (b0 + serial_nb_byte) % 255
+        b1 = (b1 + b0) % 255
+    for pw1_byte in password_1[0:2]:
+        b0 = (b0 + pw1_byte) % 255
+        b1 = (b1 + b0) % 255
+         
+    challenge = bytearray([1, 1, b0, b1])
+    return challenge
+
+def create_msg_data(msg_id, offset, msg_data):
+    '''
+    Create a message to send to the UPS
+    
+    msg_id        Message ID
+    offset        Byte offset where to write to in the UPS
+    msg_data      Data to set as bytearray
+    '''
+    length = len(msg_data)
+    raw_msg = bytearray([msg_id, offset, length]) + msg_data
+    #Add checksum
+    f8 = Fletcher()
+    f8.update(raw_msg[0:15])
+    raw_msg += bytes([f8.cb0, f8.cb1])
+    return raw_msg
+
+class ApcProtocol:
+    
+    def __init__(self):
+        self.state = CommState.INIT
+        self.prev_state = CommState.INIT
+        self.next_apc_msg = APC_CMD_NEXT#Next message to be sent to the UPS, for internal use
+        self.challenge_msg = None#Answer to the challenge of the UPS, while waiting for it to be echoed
+        
+        self.snapshot = make_snapshot(UpsState({"comm_state": "offline"}))
+        self.listeners = ()#Callbacks for every published state, replaced as a whole when changed
+        self.delta_listeners = ()#(callback, keys, msg_ids) for the changed values, replaced as a whole when changed
+        self.frame_listeners = ()#(callback, msg_ids) for the data of the received frames, replaced as a whole when changed
+        self.msg_data = {}#Message ID -> data of the last frame, to skip the comparison of unchanged frames
+        self.text_heads = {}#First frames of the texts waiting for their continuation, see apcdecode.complete_frames
+        self.framer = FrameSync(frame_size=APC_RCV_SIZE, verify=self.verify_msg_checksum)
+        
+        self.cmd_queue = queue.Queue()#Messages (raw_msg, future) waiting to be written to the UPS
+        self.cmd_lock = threading.Lock()#Held to check the state and queue a message, and to fail the queued messages
+        self.pending_cmd = None#Message written in the current poll slot, waiting for the echo
+        self.readbacks = 0#Times the pending message was read back after a corrupted echo
+        self.capture = None#apccapture.CaptureLog receiving all raw traffic, when capturing
+        self.scheduler = None#apcschedule.PollScheduler choosing between NEXT and explicit reads in MODE1
+        self.scheduler_lock = threading.Lock()
+        self.new_scheduler = None#(scheduler,) handed over by set_scheduler(), until the next poll slot
+        self.identity_cache = None#apcidentity.IdentityCache to publish the static values and skip the MODE0 walk
+        self.identity_frames = {}#Static frames received since the last reset, for the identity cache
+        self.cached_serial = None#Data of 0x40 when the static values were taken from the identity cache
+        self.cached_challenge = False#True from answering the challenge with the cached password until MODE1
+        self.lazy_decode = False#Only store the frames and decode the values when they are read, see apcrecord.LazyUpsState
+        self.events = None#apcevents.EventDetector firing power events from the status bits of the frames
+        self.read_time = None#Time the transport read the bytes of the last frame from the port
+        self.rcv_time = None#Receive time of the frame being handled
+    
+    @property
+    def ups_state(self):
+        ''' Read-only view of the latest published UPS state '''
+        return self.snapshot.values
+    
+    def publish_state(self, state, msg_id=None, changes=None):
+        '''
+        Publish a new UPS state dict, which must not be modified afterwards.
+        changes      Dict of the values that changed, for the delta listeners
+        '''
+        self.snapshot = make_snapshot(state, seq=self.snapshot.seq + 1)
+        for callback in self.listeners:
+            callback(self.snapshot)
+        if changes:
+            self.publish_delta(StateDelta(self.snapshot.seq, self.snapshot.timestamp, msg_id, changes))
+    
+    def publish_delta(self, delta):
+        for callback, keys, msg_ids in self.delta_listeners:
+            if msg_ids is not None and delta.msg_id not in msg_ids:
+                continue
+            if keys is None:
+                callback(delta)
+            else:
+                changes = {key: value for key, value in delta.changes.items() if key in keys}
+                if changes:
+                    callback(delta._replace(changes=changes))
+    
+    def changed_values(self, msg_id, msg_data, previous, state):
+        ''' Values that a frame changed in the state, empty when the frame is the same as the last one of its ID '''
+        msg_data = bytes(msg_data)
+        if self.msg_data.get(msg_id) == msg_data:
+            return {}
+        self.msg_data[msg_id] = msg_data
+        missing = object()
+        return {key: state[key] for key in MESSAGE_KEYS.get(msg_id, ()) if key in state and previous.get(key, missing) != state[key]}
+    
+    def add_listener(self, callback):
+        ''' Call callback(snapshot) from the communication thread/loop for every published state '''
+        self.listeners = self.listeners + (callback,)
+    
+    def remove_listener(self, callback):
+        self.listeners = tuple(cb for cb in self.listeners if cb is not callback)
+    
+    def add_delta_listener(self, callback, keys=None, msg_ids=None):
+        '''
+        Call callback(delta) from the communication thread/loop with a StateDelta of the values that changed.
+        keys         Only these state keys, None for all
+        msg_ids      Only changes caused by these message IDs, None for all
+        '''
+        keys = None if keys is None else frozenset(keys)
+        msg_ids = None if msg_ids is None else frozenset(msg_ids)
+        self.msg_data = {}#Frames seen without delta listeners were not compared
+        self.delta_listeners = self.delta_listeners + ((callback, keys, msg_ids),)
+    
+    def remove_delta_listener(self, callback):
+        self.delta_listeners = tuple(listener for listener in self.delta_listeners if listener[0] is not callback)
+    
+    def wants_delta(self, msg_id):
+        ''' True when a delta listener takes the changes caused by this message ID, only those frames are compared '''
+        for _, _, msg_ids in self.delta_listeners:
+            if msg_ids is None or msg_id in msg_ids:
+                return True
+        return False
+    
+    def add_frame_listener(self, callback, msg_ids=None):
+        '''
+        Call callback(msg_id, msg_data, timestamp) from the communication thread/loop for every received frame,
+        with the receive time. The data is not decoded, so this does not defeat lazy_decode.
+        msg_ids      Only these message IDs, None for all
+        '''
+        msg_ids = None if msg_ids is None else frozenset(msg_ids)
+        self.frame_listeners = self.frame_listeners + ((callback, msg_ids),)
+    
+    def remove_frame_listener(self, callback):
+        self.frame_listeners = tuple(listener for listener in self.frame_listeners if listener[0] is not callback)
+    
+    def next_apc_cmd(self):
+        '''
+        Message to write to the UPS in the current poll slot.
+        In MODE1, queued messages take the place of APC_CMD_NEXT, one per poll slot.
+        '''
+        if self.new_scheduler is not None:
+            self.take_scheduler()
+        if self.state == CommState.INIT:
+            raw_msg = APC_CMD_INIT
+        elif self.state == CommState.INIT_RESET:
+            raw_msg = APC_CMD_RESET
+        else:
+            raw_msg = self.next_apc_msg
+            if self.state == CommState.MODE1 and raw_msg is APC_CMD_NEXT:
+                self.pending_cmd = self.next_queued_cmd()
+                if self.pending_cmd is not None:
+                    raw_msg = self.pending_cmd[0]
+                    if self.scheduler is not None:
+                        self.scheduler.command_slot()
+                elif self.scheduler is not None:
+                    read_id = self.scheduler.next_read()
+                    if read_id is not None:
+                        #Explicit read (experimental_reads only): a write of zero bytes, echoed with the current data
+                        raw_msg = self.create_msg_data(msg_id=read_id, offset=0, msg_data=bytearray())
+        if self.capture is not None:
+            self.capture.write(TX, raw_msg)
+        return raw_msg
+    
+    def set_scheduler(self, scheduler):
+        '''
+        Replace the scheduler (None to poll with NEXT only) from any thread.
+        The engine takes it over at the start of its next poll slot.
+        '''
+        with self.scheduler_lock:
+            self.new_scheduler = (scheduler,)
+    
+    def take_scheduler(self):
+        with self.scheduler_lock:
+            self.scheduler, = self.new_scheduler
+            self.new_scheduler = None
+    
+    def handle_reply(self, rcv_data, rcv_time=None):
+        '''
+        Handle the reply of the UPS to the message of next_apc_cmd() and advance the state machine.
+        rcv_time     Time the bytes were read from the port (time.time()), now when None
+        '''
+        self.rcv_time = time.time() if rcv_time is None else rcv_time
+        if self.capture is not None:
+            self.capture.write(RX, rcv_data, valid=len(rcv_data) == self.frame_size() and self.verify_msg_checksum(rcv_data),
+                               timestamp=self.rcv_time)
+        if self.state == CommState.INIT:
+            #Initialize the communication
+            if not self.handle_apc_msg(rcv_data):
+                self.state = CommState.INIT_RESET
+            else:
+                self.state = CommState.MODE0
+        
+        elif self.state == CommState.INIT_RESET:
+            #Reset the UPS communication
+            if not self.handle_apc_msg(rcv_data):
+                self.state = CommState.INIT
+            else:
+                self.state = CommState.MODE0
+        
+        elif self.state == CommState.MODE0:
+            #Normal communication flow with UPS according to MODE0
+            if not self.handle_apc_msg(rcv_data):
+                self.state = CommState.INIT
+        
+        elif self.state == CommState.MODE1:
+            #Normal communication flow with UPS according to MODE1
+            if self.pending_cmd is not None:
+                self.complete_pending_cmd(rcv_data)
+            self.next_apc_msg = APC_CMD_NEXT
+            
+            if not self.handle_apc_msg(rcv_data):
+                self.state = CommState.INIT
+        
+        if self.state is not self.prev_state:
+            if self.prev_state == CommState.MODE1:
+                self.fail_queued_cmds()
+                if self.scheduler is not None:
+                    self.scheduler.reset()
+            if self.state == CommState.INIT:
+                if self.cached_challenge:
+                    #The UPS did not accept the answer from the cache, e.g. it issued a new password
+                    self.identity_cache.invalidate(self.cached_serial)
+                    self.cached_challenge = False
+                self.challenge_msg = None
+                self.identity_frames = {}
+                self.cached_serial = None
+                self.text_heads = {}
+            state = self.ups_state.copy()
+            if self.state == CommState.MODE0 or self.state == CommState.MODE1:
+                state['comm_state'] = 'online'
+            else:
+                state['comm_state'] = 'offline'
+            changes = None
+            if state['comm_state'] != self.ups_state.get('comm_state'):
+                changes = {'comm_state': state['comm_state']}
+            self.publish_state(state, changes=changes)
+            if changes and self.events is not None:
+                self.events.comm_changed(state['comm_state'] == 'online', self.rcv_time)
+#             print(self.state)
+        self.prev_state = self.state
+    
+    def submit_apc_msg(self, raw_msg):
+        '''
+        Queue a message to be written to the UPS, one message is written per poll slot.
+        Returns a Future that results in True when the UPS echoed the message ID, False otherwise.
+        '''
+        future = Future()
+        with self.cmd_lock:
+            #The engine changes the state before it fails the queued messages, so a message
+            #queued here is either written or failed
+            if self.state is not CommState.MODE1:
+                future.set_result(False)
+            else:
+                self.cmd_queue.put((raw_msg, future))
+        return future
+    
+    def send_apc_msg(self, raw_msg, timeout=APC_CMD_TIMEOUT):
+        '''
+        Schedule a message to be sent.
+        Blocks until the message is succesfully sent, or the timeout (in seconds, None to wait forever) expires.
+        '''
+        future = self.submit_apc_msg(raw_msg)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            return False
+    
+    def next_queued_cmd(self):
+        ''' Take the next queued message that was not cancelled in the meantime '''
+        while True:
+            try:
+                raw_msg, future = self.cmd_queue.get_nowait()
+            except queue.Empty:
+                return None
+            if future.set_running_or_notify_cancel():
+                return (raw_msg, future)
+    
+    def complete_pending_cmd(self, rcv_data):
+        '''
+        Resolve the future of the message written in this poll slot.
+        A corrupted echo does not tell whether the UPS applied the write, so the message stays
+        pending while handle_apc_msg asks for the frame again with BACK. The future then results
+        in True when the frame holds the written data, so callers that retry on False do not
+        write the message twice.
+        '''
+        raw_msg, future = self.pending_cmd
+        valid = len(rcv_data) > 0 and self.verify_msg_checksum(rcv_data)
+        if len(rcv_data) > 0 and not valid and self.readbacks < APC_CMD_READBACKS:
+            self.readbacks += 1
+            return
+        echoed = valid and rcv_data[0] == raw_msg[0]
+        if echoed and self.readbacks > 0:
+            offset, length = raw_msg[1], raw_msg[2]
+            echoed = rcv_data[1 + offset:1 + offset + length] == raw_msg[3:3 + length]
+        self.pending_cmd = None
+        self.readbacks = 0
+        future.set_result(bool(echoed))
+    
+    def fail_queued_cmds(self):
+        ''' Resolve all queued messages as failed, e.g. when the communication is lost '''
+        with self.cmd_lock:
+            while True:
+                cmd = self.next_queued_cmd()
+                if cmd is None:
+                    break
+                cmd[1].set_result(False)
+    
+    def stopped(self):
+        ''' The transport stopped, fail the queued messages and refuse new ones '''
+        self.state = CommState.INIT
+        self.cached_challenge = False
+        if self.pending_cmd is not None:
+            self.pending_cmd[1].set_result(False)
+            self.pending_cmd = None
+            self.readbacks = 0
+        self.fail_queued_cmds()
+    
+    def frame_size(self):
+        ''' Size of a complete frame: message ID + msg_size data bytes (as reported in message 0x00) + checksum '''
+        msg_size = self.ups_state.get('msg_size')
+        if not msg_size:
+            return APC_RCV_SIZE
+        return msg_size + 3
+    
+    def verify_msg_checksum(self, raw_msg):
+        msg_chksum = int.from_bytes(raw_msg[-2:], byteorder='big', signed=False)
+        
+        f8 = Fletcher()
+        f8.update(raw_msg[0:-2])
+        checksum = (f8.cb0 << 8) + f8.cb1
+        checksum_result = True if msg_chksum == checksum else False
+        
+        return checksum_result
+    
+    def calc_checksum(self, raw_msg):
+        f8 = Fletcher()
+        f8.update(raw_msg[0:15])
+        checksum = (f8.cb0 << 8) + f8.cb1
+        return checksum
+        
+    def create_msg_data(self, msg_id, offset, msg_data):
+        '''
+        Create a message to send to the UPS
+        
+        msg_id        Message ID
+        offset        Byte offset where to write to in the UPS
+        msg_data      Data to set as bytearray
+        '''
+        return create_msg_data(msg_id, offset, msg_data)
+    
+    def handle_apc_msg(self, raw_msg):
+        if raw_msg is not None and len(raw_msg) > 0:
+            #Convert to bytes
+            raw_msg = bytearray(raw_msg)
+            #Extract message parts
+            msg_id = raw_msg[0]
+            msg_data = raw_msg[1:-2]     
+            
+#             print("Received message ID " + hex(msg_id))
+            
+            if not self.verify_msg_checksum(raw_msg):
+                self.next_apc_msg = APC_CMD_BACK
+                return True
+            
+            if self.challenge_msg is not None:
+                #Reply to our answer of the challenge, the UPS echoes it when accepted
+                self.challenge_msg = None
+                if msg_id != 0x7e:
+                    return False
+                self.state = CommState.MODE1
+                if self.cached_challenge:
+                    #The UPS accepted the cached entry, the walk was skipped
+                    self.cached_challenge = False
+                elif self.identity_cache is not None:
+                    self.identity_cache.store(self.identity_frames)
+            
+            #Identify data, the update is made on a copy and then published as a whole
+            previous = self.ups_state
+            state = previous.copy()
+            if isinstance(state, LazyUpsState) != self.lazy_decode:
+                state = LazyUpsState(state) if self.lazy_decode else UpsState(state)
+            frames = complete_frames(self.text_heads, msg_id, msg_data)
+            changes = {}
+            for frame_id, frame_data in frames:
+                state.set_frame(frame_id, frame_data)
+            for frame_id, frame_data in frames:
+                if self.wants_delta(frame_id):
+                    changes.update(self.changed_values(frame_id, frame_data, previous, state))
+            self.publish_state(state, msg_id, changes)
+            if self.events is not None:
+                self.events.frame(msg_id, msg_data, self.rcv_time)
+            for callback, msg_ids in self.frame_listeners:
+                if msg_ids is None or msg_id in msg_ids:
+                    callback(msg_id, msg_data, self.rcv_time)
+            if self.scheduler is not None and self.state == CommState.MODE1:
+                self.scheduler.frame_received(msg_id)
+            
+            #Default behavior is to request next data
+            self.next_apc_msg = APC_CMD_NEXT
+            
+            if self.state != CommState.MODE1 and self.identity_cache is not None and msg_id in CACHED_IDS:
+                self.identity_frames[msg_id] = bytes(msg_data)
+                if msg_id == 0x40 and 0x00 in self.identity_frames and self.cached_serial is None:
+                    cached = self.identity_cache.lookup(self.identity_frames[0x00], self.identity_frames[0x40])
+                    if cached is not None:
+                        #Known UPS: publish the other static data from the cache
+                        self.use_cached_identity(cached)
+                        if CHALLENGE_ID in cached and self.state == CommState.MODE0:
+                            #and skip the rest of the walk, the UPS checks the answer
+                            self.cached_challenge = True
+                            self.answer_challenge()
+            
+            if msg_id == 0x7f and self.state == CommState.MODE0:
+                #We have received all of the message IDs for the first time since reset.
+                #Now we need to answer the challenge string of the UPS, in the next poll slot.
+                self.answer_challenge()
+            return True
+        
+        else:
+            self.next_apc_msg = APC_CMD_RESET
+            return False
+        
+    def answer_challenge(self):
+        ''' Send the answer to the challenge of the UPS in the next poll slot '''
+        challenge = self.calculate_challenge()
+        self.challenge_msg = self.create_msg_data(msg_id=0x7e, offset=12, msg_data=challenge)
+        self.next_apc_msg = self.challenge_msg
+    
+    def use_cached_identity(self, frames):
+        '''
+        Decode the static frames of the identity cache that were not received yet.
+        The frames received later replace the cached ones.
+        '''
+        previous = self.ups_state
+        state = previous.copy()
+        msg_ids = [msg_id for msg_id in sorted(frames) if msg_id not in self.identity_frames]
+        for msg_id in msg_ids:
+            state.set_frame(msg_id, frames[msg_id])
+        changes = {}
+        for msg_id in msg_ids:
+            if self.wants_delta(msg_id):
+                changes.update(self.changed_values(msg_id, frames[msg_id], previous, state))
+        self.publish_state(state, changes=changes)
+        self.cached_serial = self.identity_frames[0x40]
+    
+    def calculate_challenge(self):
+        ''' Calculate challenge from actual known ups state '''
+        return calculate_challenge(self.ups_state['series_id_raw'], self.ups_state['header_raw'],
+                                   self.ups_state['serial_nb_raw'], self.ups_state['password_1'])
+    
+    def convert_from_bp(self, data, frac_pos, signed=False):
+        ''' Convert the binary point number in data to a float, given the fractional bit position '''
+        data = int.from_bytes(data, byteorder='big', signed=signed)
+        value = data / (2**frac_pos)
+        return value
+    
+    def convert_to_bp(self, value, frac_pos):   
+        ''' Convert the given data to binary point format, with the specified fractional bit position '''            
+        data = int(value * 2**frac_pos).to_bytes(2, byteorder='big')
+        return data
+    
+    def convert_to_datetime(self, value):
+        ''' Convert from days since 1 Jan. 2000 to datetime object '''
+        return datetime.datetime(2000,1,1) + datetime.timedelta(days=value)
@@ -0,0 +1,268 @@
+'''
+Compact record of the decoded UPS state.
+
+UpsState replaces the dict with one string key per value: it has __slots__ and keeps
+the values in a single list with a fixed position per state key (STATE_KEYS), so a
+copy for the next snapshot is one list copy and no hash table is stored per state.
+Flag fields only store the raw bitfield (<name>_raw), the label tuple <name> is
+derived when it is read, from the shared cache of apcdecode.flag_labels.
+
+It is a MutableMapping, so code written for the dict keeps working (state['voltage_in'],
+state.get(), keys(), items(), 'x in state'), and every key is also an attribute
+(state.voltage_in, None when not received yet). to_dict() returns a plain dict.
+A published record is frozen (see apcstate.make_snapshot): it raises TypeError on
+modification like the read-only view of a dict state, updates are made on copy().
+
+LazyUpsState only stores the data of every frame with set_frame(), and decodes a key
+when it is read. The value is cached until the next frame of its message ID, so the
+fields nobody reads are never decoded. ENUM fields are the exception: like UpsState, an
+unmapped value keeps the previous mapped one, so they are decoded with the frame.
+Delta listeners of the engine need the changed values, so a frame that differs from the
+previous one of its message ID is still decoded when a delta listener takes its message
+ID. Frame listeners (see ApcProtocol.add_frame_listener) get the data without decoding.
+'''
+from collections.abc import MutableMapping
+from apcdecode import REGISTER_MAP, FLAGS, ENUM, MESSAGE_KEYS, KEY_DECODERS, decode_msg, flag_labels, compile_field
+
+def state_layout():
+    ''' Stored state keys in a fixed order, and {label key: raw key} of the flag fields '''
+    keys = ['comm_state']
+    labels = {}
+    for msg_id, fields in sorted(REGISTER_MAP.items()):
+        for field in fields:
+            if field.kind == FLAGS:
+                labels[field.name] = field.name + '_raw'
+                names = [field.name + '_raw']
+            elif field.kind == ENUM:
+                names = [field.name, field.name + '_raw']
+            else:
+                names = [field.name]
+            for name in names:
+                if name not in keys:
+                    keys.append(name)
+    return tuple(keys), labels
+
+STATE_KEYS, FLAG_LABEL_KEYS = state_layout()
+KEY_INDEX = {key: index for index, key in enumerate(STATE_KEYS)}
+LABEL_INDEX = {label: KEY_INDEX[raw] for label, raw in FLAG_LABEL_KEYS.items()}
+#Decoders of the ENUM fields per message ID, and the indexes of the other keys, for LazyUpsState
+ENUM_DECODERS = {msg_id: tuple(compile_field(f) for f in fields if f.kind == ENUM) for msg_id, fields in REGISTER_MAP.items()}
+LAZY_INDEXES = {msg_id: tuple(KEY_INDEX[key] for key in MESSAGE_KEYS[msg_id] if key in KEY_INDEX and
+                              not any(f.kind == ENUM and key in (f.name, f.name + '_raw') for f in fields))
+                for msg_id, fields in REGISTER_MAP.items()}
+
+_MISSING = object()#Value of a key that was not received yet
+_EMPTY = (_MISSING,) * len(STATE_KEYS)
+
+class UpsState(MutableMapping):
+    '''
+    values    Optional mapping to initialize the record with
+    '''
+    __slots__ = ('_values', '_extra', '_frozen')
+
+    def __init__(self, values=None):
+        self._values = list(_EMPTY)
+        self._extra = None#Keys that are not part of the layout, normally None
+        self._frozen = False
+        if values:
+            self.update(values)
+
+    def copy(self):
+        ''' Modifiable copy '''
+        state = UpsState.__new__(UpsState)
+        state._values = self._values[:]
+        state._extra = None if self._extra is None else dict(self._extra)
+        state._frozen = False
+        return state
+
+    def set_frame(self, msg_id, msg_data):
+        ''' Decode the data of a frame into the record, see apcdecode.decode_msg '''
+        return decode_msg(msg_id, msg_data, self)
+
+    def freeze(self):
+        ''' Make the record read-only, when it is published '''
+        self._frozen = True
+        return self
+
+    def __getitem__(self, key):
+        index = KEY_INDEX.get(key)
+        if index is not None:
+            value = self._values[index]
+            if value is _MISSING:
+                raise KeyError(key)
+            return value
+        index = LABEL_INDEX.get(key)
+        if index is not None:
+            raw = self._values[index]
+            if raw is _MISSING:
+                raise KeyError(key)
+            return flag_labels(key, raw)
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        index = KEY_INDEX.get(key)
+        if index is not None:
+            value = self._values[index]
+            return default if value is _MISSING else value
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        index = KEY_INDEX.get(key)
+        if index is None:
+            index = LABEL_INDEX.get(key)
+            if index is None:
+                return self._extra is not None and key in self._extra
+        return self._values[index] is not _MISSING
+
+    def __setitem__(self, key, value):
+        if self._frozen:
+            raise TypeError("Published UpsState does not support item assignment")
+        index = KEY_INDEX.get(key)
+        if index is not None:
+            self._values[index] = value
+        elif key in LABEL_INDEX:
+            pass#Derived from <key>_raw, which the decoder sets as well
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if self._frozen:
+            raise TypeError("Published UpsState does not support item deletion")
+        if key not in self:
+            raise KeyError(key)
+        index = KEY_INDEX.get(key)
+        if index is not None:
+            self._values[index] = _MISSING
+        elif key in LABEL_INDEX:
+            self._values[LABEL_INDEX[key]] = _MISSING
+        else:
+            del self._extra[key]
+
+    def __iter__(self):
+        values = self._values
+        for key, index in KEY_INDEX.items():
+            if values[index] is not _MISSING:
+                yield key
+        for label, index in LABEL_INDEX.items():
+            if values[index] is not _MISSING:
+                yield label
+        if self._extra is not None:
+            yield from list(self._extra)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        if isinstance(other, UpsState):
+            return self._values == other._values and self._extra == other._extra
+        return MutableMapping.__eq__(self, other)
+
+    def to_dict(self):
+        ''' Plain dict with all keys, as the state used to be '''
+        return dict(self.items())
+
+    def __repr__(self):
+        return 'UpsState(' + repr(self.to_dict()) + ')'
+
+class LazyUpsState(UpsState):
+    '''
+    UpsState that keeps the data of the last frame per message ID, and decodes keys on access.
+    Readers on other threads may decode into a published record, a decoded value is
+    only stored as a whole and always equals the decoding of the stored frame.
+    '''
+    __slots__ = ('_frames',)
+
+    def __init__(self, values=None):
+        self._frames = {}#Message ID -> data of the last frame
+        UpsState.__init__(self, values)
+
+    def copy(self):
+        state = LazyUpsState.__new__(LazyUpsState)
+        state._frames = dict(self._frames)
+        state._values = self._values[:]
+        state._extra = None if self._extra is None else dict(self._extra)
+        state._frozen = False
+        return state
+
+    def set_frame(self, msg_id, msg_data):
+        ''' Store the data of a frame, the values of its message ID are decoded when read '''
+        if self._frozen:
+            raise TypeError("Published UpsState does not support item assignment")
+        indexes = LAZY_INDEXES.get(msg_id)
+        if indexes is None:
+            return False
+        values = self._values
+        for index in indexes:
+            values[index] = _MISSING
+        msg_data = bytes(msg_data)
+        self._frames[msg_id] = msg_data
+        for decode in ENUM_DECODERS[msg_id]:
+            decode(msg_data, self)
+        return True
+
+    def _lookup(self, index, key):
+        ''' Value at index, decoded from the stored frames when not cached '''
+        value = self._values[index]
+        if value is _MISSING:
+            decoded = {}
+            frames = self._frames
+            for msg_id, decode in KEY_DECODERS.get(key, ()):
+                msg_data = frames.get(msg_id)
+                if msg_data is not None:
+                    decode(msg_data, decoded)
+            values = self._values
+            for name, new in decoded.items():
+                decoded_index = KEY_INDEX.get(name)
+                if decoded_index is not None:
+                    values[decoded_index] = new
+            value = decoded.get(key, _MISSING)
+        return value
+
+    def __getitem__(self, key):
+        index = KEY_INDEX.get(key)
+        if index is not None:
+            value = self._lookup(index, key)
+            if value is _MISSING:
+                raise KeyError(key)
+            return value
+        index = LABEL_INDEX.get(key)
+        if index is not None:
+            raw = self._lookup(index, FLAG_LABEL_KEYS[key])
+            if raw is _MISSING:
+                raise KeyError(key)
+            return flag_labels(key, raw)
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __iter__(self):
+        for key, index in KEY_INDEX.items():
+            self._lookup(index, key)
+        return UpsState.__iter__(self)
+
+    def __eq__(self, other):
+        return MutableMapping.__eq__(self, other)
+
+def _attribute(key):
+    def get(self):
+        return self.get(key)
+    return property(get, doc="State value " + key + ", None when not received yet")
+
+for _key in STATE_KEYS + tuple(FLAG_LABEL_KEYS):
+    setattr(UpsState, _key, _attribute(_key))
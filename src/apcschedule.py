@@ -0,0 +1,123 @@
+'''
+Adaptive poll scheduler for MODE1.
+
+With APC_CMD_NEXT alone, every message ID is refreshed once per rotation, so the
+measurements and status get the same share of the link as the serial number or the
+firmware version. PollScheduler gives some IDs a target refresh interval. In every poll
+slot where the engine would send NEXT, the most overdue of these IDs is read explicitly
+instead (a write of zero bytes to the ID, which the UPS echoes with the current data),
+unless the learned rotation says NEXT will bring it anyway. To keep the rotation and
+thus the other IDs moving, at most max_reads_in_row reads are done between two NEXTs.
+
+If the UPS does not answer the reads, they are given up after MAX_READ_FAILURES and
+the scheduler falls back to plain NEXT polling.
+
+The explicit reads are EXPERIMENTAL: a zero length write is not part of the documented
+polling, and it was only tested against apcsim. They are off unless the scheduler is
+created with experimental_reads=True, without it the scheduler only learns the rotation
+and the engine keeps sending NEXT.
+
+Enable it on an engine with:
+
+    apccomm.set_scheduler(PollScheduler({0x6f: 0.2, 0x76: 0.2}, experimental_reads=True))
+'''
+import time
+
+DEFAULT_TARGETS = {
+    0x6d: 0.5,#Battery voltage, SOC, runtime
+    0x6f: 0.25,#Output voltage, current, frequency, load
+    0x70: 0.5,#Input status, voltage, frequency, errors
+    0x76: 0.25,#UPS status
+}#Target refresh interval in seconds per message ID
+MAX_READS_IN_ROW = 2#Explicit reads between two NEXTs at most
+MAX_READ_FAILURES = 3#Reads not answered with the requested ID before reads are given up
+
+COMMAND = -1#Value of PollScheduler.reading while a queued command is written instead
+
+class PollScheduler:
+    '''
+    targets            {message ID: target refresh interval in seconds}
+    max_reads_in_row   Explicit reads between two NEXTs at most
+    experimental_reads Send explicit reads to the UPS, not verified on real hardware
+    '''
+
+    def __init__(self, targets=DEFAULT_TARGETS, max_reads_in_row=MAX_READS_IN_ROW, clock=time.monotonic,
+                 experimental_reads=False):
+        self.targets = dict(targets)
+        self.experimental_reads = experimental_reads
+        self.max_reads_in_row = max_reads_in_row
+        self.clock = clock
+        self.last_seen = {}#Message ID -> time its last frame was received
+        self.rotation = {}#Message ID -> ID that followed it after NEXT, as learned
+        self.last_next_id = None#ID of the last frame received in reply to NEXT
+        self.reading = None#ID read in the current poll slot, None when NEXT was sent, COMMAND for a queued command
+        self.reads_in_row = 0
+        self.read_failures = 0
+        self.reads = 0
+        self.nexts = 0
+
+    @property
+    def reads_supported(self):
+        return self.read_failures < MAX_READ_FAILURES
+
+    def reset(self):
+        ''' The communication was reset, the position in the rotation is unknown '''
+        self.check_answered()
+        self.last_next_id = None
+        self.reading = None
+        self.reads_in_row = 0
+
+    def check_answered(self):
+        if self.reading is not None and self.reading != COMMAND:
+            self.read_failures += 1#No frame at all in reply to the read
+        self.reading = None
+
+    def command_slot(self):
+        ''' A queued command is written in this poll slot '''
+        self.check_answered()
+        self.reading = COMMAND
+
+    def next_read(self):
+        ''' ID to read explicitly in this poll slot, None to send NEXT '''
+        self.check_answered()
+        if not self.experimental_reads or self.reads_in_row >= self.max_reads_in_row or not self.reads_supported:
+            return self.send_next()
+        now = self.clock()
+        best = None
+        best_overdue = 0.0
+        for msg_id, interval in self.targets.items():
+            overdue = now - self.last_seen.get(msg_id, 0.0) - interval
+            if overdue > best_overdue:
+                best = msg_id
+                best_overdue = overdue
+        if best is None:
+            return self.send_next()
+        predicted = self.rotation.get(self.last_next_id)
+        if predicted == best or (predicted in self.targets and now - self.last_seen.get(predicted, 0.0) >= self.targets[predicted]):
+            #NEXT brings an overdue ID as well
+            return self.send_next()
+        self.reading = best
+        self.reads_in_row += 1
+        self.reads += 1
+        return best
+
+    def send_next(self):
+        self.reads_in_row = 0
+        self.nexts += 1
+        return None
+
+    def frame_received(self, msg_id):
+        ''' A frame was decoded in reply to the message of this poll slot '''
+        self.last_seen[msg_id] = self.clock()
+        reading = self.reading
+        self.reading = None
+        if reading is None:
+            if self.last_next_id is not None:
+                self.rotation[self.last_next_id] = msg_id
+            self.last_next_id = msg_id
+        elif reading == COMMAND:
+            pass
+        elif msg_id == reading:
+            self.read_failures = 0
+        else:
+            self.read_failures += 1
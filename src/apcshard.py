@@ -0,0 +1,353 @@
+'''
+Sharded collector for very large UPS fleets.
+
+The serial ports are partitioned over worker processes, each running a FleetManager
+with its own AsyncApcComm engines, so the per-frame decoding is spread over all cores
+instead of being limited by one interpreter. Workers only send what changed: the
+StateDelta of the engines goes to the parent over a pipe in a compact binary encoding
+(encode_delta), together with the removed fields when a port gets a new engine.
+The parent applies the deltas and publishes a snapshot per port. The sequence number
+of a port counts its deltas, so it keeps increasing when the worker reconnects the
+port with a new engine, or when a worker that died is started again.
+
+See benchShard.py for the throughput with one and with several workers.
+'''
+import os
+import sys
+import time
+import struct
+import asyncio
+import logging
+import datetime
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+from apcdecode import REGISTER_MAP, FLAGS, ENUM, EPOCH
+from apcstate import make_snapshot
+from apcrecord import UpsState
+
+log = logging.getLogger(__name__)
+
+def state_keys():
+    ''' All keys the decoder can produce, in a fixed order shared by workers and parent '''
+    keys = set(['comm_state'])
+    for fields in REGISTER_MAP.values():
+        for field in fields:
+            keys.add(field.name)
+            if field.kind in (FLAGS, ENUM):
+                keys.add(field.name + '_raw')
+    return tuple(sorted(keys))
+
+KEYS = state_keys()
+KEY_INDEX = {key: index for index, key in enumerate(KEYS)}
+KEY_UNKNOWN = 0xFFFF#Key index followed by the key name, for keys not in KEYS
+WORKER_RESTART_DELAY = 5.0#Seconds before a worker process that died is started again
+
+DELTA_HEADER = struct.Struct('>HQdHH')#Port index, sequence number, timestamp, number of changed and of removed fields
+U16 = struct.Struct('>H')
+I64 = struct.Struct('>q')
+F64 = struct.Struct('>d')
+
+def _encode_str(value, out):
+    data = value.encode()
+    out += U16.pack(len(data))
+    out += data
+
+def _decode_str(data, pos):
+    length, = U16.unpack_from(data, pos)
+    pos += 2
+    return bytes(data[pos:pos + length]).decode(), pos + length
+
+def encode_value(value, out):
+    ''' Append a tagged value to the bytearray out '''
+    if value is None:
+        out += b'N'
+    elif value is True or value is False:
+        out += b'T' if value else b'F'
+    elif isinstance(value, int):
+        out += b'i'
+        out += I64.pack(value)
+    elif isinstance(value, float):
+        out += b'f'
+        out += F64.pack(value)
+    elif isinstance(value, str):
+        out += b's'
+        _encode_str(value, out)
+    elif isinstance(value, (bytes, bytearray)):
+        out += b'b'
+        out += U16.pack(len(value))
+        out += value
+    elif isinstance(value, (tuple, list)):
+        out += b't'
+        out += U16.pack(len(value))
+        for label in value:
+            _encode_str(label, out)
+    elif isinstance(value, datetime.datetime):
+        out += b'D'
+        out += F64.pack((value - EPOCH).total_seconds())
+    else:
+        raise TypeError("Can not encode " + repr(value))
+
+def decode_value(data, pos):
+    ''' Decode a tagged value at pos, returns (value, new pos) '''
+    tag = data[pos:pos + 1]
+    pos += 1
+    if tag == b'N':
+        return None, pos
+    elif tag == b'T':
+        return True, pos
+    elif tag == b'F':
+        return False, pos
+    elif tag == b'i':
+        return I64.unpack_from(data, pos)[0], pos + 8
+    elif tag == b'f':
+        return F64.unpack_from(data, pos)[0], pos + 8
+    elif tag == b's':
+        return _decode_str(data, pos)
+    elif tag == b'b':
+        length, = U16.unpack_from(data, pos)
+        pos += 2
+        return bytearray(data[pos:pos + length]), pos + length
+    elif tag == b't':
+        count, = U16.unpack_from(data, pos)
+        pos += 2
+        labels = []
+        for _ in range(count):
+            label, pos = _decode_str(data, pos)
+            labels.append(label)
+        return tuple(labels), pos
+    elif tag == b'D':
+        return EPOCH + datetime.timedelta(seconds=F64.unpack_from(data, pos)[0]), pos + 8
+    raise ValueError("Unknown value tag " + repr(tag))
+
+def _encode_key(key, out):
+    index = KEY_INDEX.get(key)
+    if index is None:
+        out += U16.pack(KEY_UNKNOWN)
+        _encode_str(key, out)
+    else:
+        out += U16.pack(index)
+
+def _decode_key(data, pos):
+    index, = U16.unpack_from(data, pos)
+    pos += 2
+    if index == KEY_UNKNOWN:
+        return _decode_str(data, pos)
+    return KEYS[index], pos
+
+def encode_delta(port_index, seq, timestamp, changes, removed=()):
+    ''' Encode the changed fields {key: value} and the removed keys of a port's state '''
+    out = bytearray(DELTA_HEADER.pack(port_index, seq, timestamp, len(changes), len(removed)))
+    for key, value in changes.items():
+        _encode_key(key, out)
+        encode_value(value, out)
+    for key in removed:
+        _encode_key(key, out)
+    return bytes(out)
+
+def decode_delta(data):
+    ''' Decode an encoded delta, returns (port_index, seq, timestamp, {key: value}, (removed key, ...)) '''
+    port_index, seq, timestamp, count, removed_count = DELTA_HEADER.unpack_from(data, 0)
+    pos = DELTA_HEADER.size
+    changes = {}
+    for _ in range(count):
+        key, pos = _decode_key(data, pos)
+        changes[key], pos = decode_value(data, pos)
+    removed = []
+    for _ in range(removed_count):
+        key, pos = _decode_key(data, pos)
+        removed.append(key)
+    return port_index, seq, timestamp, changes, tuple(removed)
+
+def partition(ports, shards):
+    ''' Spread the ports round-robin over a number of shards '''
+    return [ports[i::shards] for i in range(shards)]
+
+def run_worker(conn, ports, open_port, seqs=None):
+    '''
+    Worker process: run the engines of a shard and send the state deltas to the parent.
+
+    conn        Pipe connection to the parent
+    ports       [(port index, port name), ...]
+    open_port   Function (name) returning a non-blocking port
+    seqs        {port name: sequence number of its last delta}, when the worker is started again
+    '''
+    from apcfleet import FleetManager
+
+    indexes = {name: index for index, name in ports}
+    seqs = dict(seqs or {})#Port name -> sequence number of the last delta, the seq of a new engine goes on
+    engines = {}#Port name -> engine whose deltas were sent last
+
+    def send_delta(link, delta):
+        comm = link.comm
+        changes = delta.changes
+        removed = ()
+        previous = engines.get(link.name)
+        if previous is not comm:
+            #New engine: send its whole state, and remove what only the previous one had
+            engines[link.name] = comm
+            changes = dict(comm.ups_state.items())
+            if previous is not None:
+                removed = [key for key in previous.ups_state if key not in changes]
+        seqs[link.name] = seq = seqs.get(link.name, 0) + 1
+        conn.send_bytes(encode_delta(indexes[link.name], seq, delta.timestamp, changes, removed))
+
+    async def main():
+        fleet = FleetManager(open_port=open_port)
+        fleet.add_delta_listener(send_delta)
+        for index, name in ports:
+            fleet.add_port(name)
+        await fleet.run()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+class ShardedCollector:
+    '''
+    ports       List of serial port names
+    workers     Number of worker processes, by default the number of cores
+    open_port   Module level function (name) returning a non-blocking port, passed to the workers
+    '''
+
+    def __init__(self, ports, workers=None, open_port=None):
+        if open_port is None:
+            from apcfleet import open_nonblocking as open_port
+        self.ports = list(ports)
+        self.workers = min(workers or os.cpu_count() or 1, max(len(self.ports), 1))
+        self.open_port = open_port
+        self.restart_delay = WORKER_RESTART_DELAY
+        self.shards = []#[(port index, port name), ...] per worker
+        self.processes = []#Worker process per shard
+        self.conns = []#Pipe connection per shard
+        self.restarts = 0#Number of times a worker that died was started again
+        self.values = [UpsState() for _ in self.ports]#Aggregated state per port index
+        self.snapshots = [None for _ in self.ports]
+        self.listeners = ()
+        self.deltas = 0
+        self.running = False
+        self.thread = None
+
+    def add_listener(self, callback):
+        '''
+        Call callback(port name, snapshot, changes) from the aggregator thread for every delta.
+        Removed keys are in changes with the value None, which MetricsExporter.update
+        takes as the removal of their lines. Exceptions of the callback are logged.
+        '''
+        self.listeners = self.listeners + (callback,)
+
+    def start(self):
+        self.shards = partition(list(enumerate(self.ports)), self.workers)
+        for shard in self.shards:
+            process, conn = self.start_worker(shard)
+            self.processes.append(process)
+            self.conns.append(conn)
+        self.running = True
+        self.thread = threading.Thread(target=self.aggregate, daemon=True)
+        self.thread.start()
+
+    def start_worker(self, shard):
+        ''' Start the worker process of a shard, returns (process, pipe connection) '''
+        seqs = {name: self.snapshots[index].seq for index, name in shard if self.snapshots[index] is not None}
+        ctx = multiprocessing.get_context('spawn')
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        process = ctx.Process(target=run_worker, args=(child_conn, shard, self.open_port, seqs), daemon=True)
+        process.start()
+        child_conn.close()
+        return process, parent_conn
+
+    def stop(self):
+        self.running = False
+        #The aggregator restarts workers, so it has to stop first
+        if self.thread is not None:
+            self.thread.join()
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+    def aggregate(self):
+        ''' Apply the deltas of all workers and start the workers that died again, runs in its own thread '''
+        restarts = {}#Shard index -> time to start its worker again
+        while self.running:
+            now = time.monotonic()
+            for index, restart_time in list(restarts.items()):
+                if restart_time <= now:
+                    del restarts[index]
+                    self.processes[index], self.conns[index] = self.start_worker(self.shards[index])
+                    self.restarts += 1
+            conns = {conn: index for index, conn in enumerate(self.conns) if index not in restarts}
+            for conn in wait(list(conns), timeout=0.5):
+                try:
+                    data = conn.recv_bytes()
+                except (EOFError, OSError):
+                    self.worker_died(conns[conn])
+                    restarts[conns[conn]] = time.monotonic() + self.restart_delay
+                    continue
+                try:
+                    self.apply(data)
+                except Exception:
+                    log.exception("Bad delta from a worker")
+
+    def worker_died(self, index):
+        ''' Take the ports of a worker that died offline, their values are removed '''
+        process = self.processes[index]
+        process.join(1)
+        self.conns[index].close()
+        shard = self.shards[index]
+        log.error("Worker of %s died with exit code %s, starting it again in %s s",
+                  ', '.join(name for _, name in shard), process.exitcode, self.restart_delay)
+        timestamp = time.time()
+        for port_index, _ in shard:
+            snapshot = self.snapshots[port_index]
+            if snapshot is None:
+                continue
+            removed = [key for key in self.values[port_index] if key != 'comm_state']
+            self.apply_delta(port_index, snapshot.seq + 1, timestamp, {'comm_state': 'offline'}, removed)
+
+    def apply(self, data):
+        ''' Apply an encoded delta of a worker '''
+        self.apply_delta(*decode_delta(data))
+
+    def apply_delta(self, port_index, seq, timestamp, changes, removed):
+        values = self.values[port_index].copy()
+        values.update(changes)
+        for key in removed:
+            values.pop(key, None)
+            changes[key] = None
+        self.values[port_index] = values
+        snapshot = make_snapshot(values, seq=seq, timestamp=timestamp)
+        self.snapshots[port_index] = snapshot
+        self.deltas += 1
+        for callback in self.listeners:
+            try:
+                callback(self.ports[port_index], snapshot, changes)
+            except Exception:
+                #One consumer must not stop the collection of the whole fleet
+                log.exception("Listener of " + self.ports[port_index] + " failed")
+
+    def states(self):
+        ''' Latest state snapshot of every UPS that identified itself, indexed by serial number '''
+        states = {}
+        for snapshot in self.snapshots:
+            if snapshot is not None and 'serial_nb' in snapshot.values:
+                states[snapshot.values['serial_nb'].strip()] = snapshot
+        return states
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print("APC UPS sharded collector\n\nUsage: " + sys.argv[0] + " <serial port> [<serial port> ...]")
+        sys.exit(0)
+
+    collector = ShardedCollector(sys.argv[1:])
+    collector.start()
+    try:
+        while True:
+            time.sleep(5)
+            for serial_nb, snapshot in sorted(collector.states().items()):
+                print(serial_nb + ": " + snapshot.values['comm_state'] + " " + str(snapshot.values.get('ups_status', '')))
+    except KeyboardInterrupt:
+        pass
+    collector.stop()
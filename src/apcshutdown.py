@@ -0,0 +1,356 @@
+'''
+Shutdown orchestrator: shuts down the hosts on the UPS before its battery runs out.
+
+ShutdownOrchestrator watches the decoded state of an engine. When the UPS runs on battery
+and runtime_remaining_2 drops below the threshold, or outlet_status shows LOW RUNTIME,
+or with an apcpredict.RuntimePredictor the low end of the predicted runtime stays below
+the threshold for PREDICTION_HOLD seconds (once the capacity was measured on battery), it
+runs the shutdown actions from a thread pool, every action as soon as the actions it
+comes after are finished. An action that does not finish within its timeout is given up
+and the actions after it start anyway, so one hanging host does not keep the others on
+battery. Once all actions are done the load is safe, and the outlet command (SHUTDOWN,
+the outlet comes back on with the grid, or OFF_DELAY) is sent to the UPS. The time from
+the trigger to the outlet reporting off is measured and reported.
+
+Once triggered, the shutdown is not cancelled when the grid returns.
+
+The actions are listed in a config file, one section per action, with a local command
+or the URL of a local agent that is POSTed to. The [shutdown] section is optional:
+
+    [shutdown]
+    runtime = 300
+    outlet = SHUTDOWN
+
+    [app1]
+    command = ssh app1 sudo poweroff
+    timeout = 30
+
+    [db1]
+    url = http://127.0.0.1:8200/shutdown/db1
+    after = app1
+'''
+import sys
+import time
+import shlex
+import threading
+import subprocess
+import configparser
+import urllib.request
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from apccommand import make_set_msg
+
+RUNTIME_THRESHOLD = 300#Seconds of runtime left on battery that trigger the shutdown
+ACTION_TIMEOUT = 60.0#Seconds an action may take by default
+WORKERS = 16#Actions running at the same time at most
+OUTLET_OPTION = 'SHUTDOWN'#Outlet command given when the load is safe
+OUTLET_ATTEMPTS = 3#Tries to get the outlet command accepted
+COMMAND_TIMEOUT = 5.0#Seconds to wait for the UPS to accept the outlet command
+OFF_WAIT = 30.0#Seconds to wait for the outlet to report off, on top of the OFF delay
+PREDICTION_HOLD = 15.0#Seconds the predicted runtime must stay below the threshold, against a single noisy prediction
+
+ShutdownAction = namedtuple('ShutdownAction', 'name run after timeout', defaults=((), ACTION_TIMEOUT))
+ShutdownAction.__doc__ = '''
+name          Unique name
+run           Callable without arguments, or a local command as string or argument list
+after         Names of the actions that must be finished before this one starts
+timeout       Seconds before the action is given up
+'''
+
+ActionResult = namedtuple('ActionResult', 'name status start duration detail')
+ActionResult.__doc__ = '''
+status        'ok', 'failed' or 'timeout'
+start         Seconds from the trigger until the action started
+duration      Seconds the action ran, until it was given up for a timeout
+detail        Error message, empty when ok
+'''
+
+ShutdownReport = namedtuple('ShutdownReport', 'reason triggered results outlet_accepted outlet_time off_time')
+ShutdownReport.__doc__ = '''
+reason            Why the shutdown was triggered
+triggered         Time of the frame that triggered it (time.time())
+results           ActionResult per action, in the order they ended
+outlet_accepted   True when the UPS accepted the outlet command
+outlet_time       Seconds from the trigger until the outlet command was accepted, None if not
+off_time          Seconds from the trigger until the outlet reported off, None if not seen
+'''
+
+def agent_call(url, timeout=ACTION_TIMEOUT):
+    ''' Action that POSTs to a local shutdown agent, failing on an HTTP error status '''
+    def run():
+        with urllib.request.urlopen(urllib.request.Request(url, data=b'', method='POST'), timeout=timeout) as response:
+            response.read()
+    return run
+
+def read_config(path):
+    ''' Read the config file, returns ({option: value} of [shutdown], [ShutdownAction]) '''
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        raise ValueError("Can not read " + path)
+    options = {}
+    actions = []
+    for name in config.sections():
+        section = config[name]
+        if name == 'shutdown':
+            options = {
+                'runtime': section.getint('runtime', RUNTIME_THRESHOLD),
+                'outlet_option': section.get('outlet', OUTLET_OPTION),
+                'workers': section.getint('workers', WORKERS),
+            }
+            continue
+        timeout = section.getfloat('timeout', ACTION_TIMEOUT)
+        if 'command' in section:
+            run = section['command']
+        elif 'url' in section:
+            run = agent_call(section['url'], timeout)
+        else:
+            raise ValueError("Action " + name + " has no command or url")
+        after = tuple(dep.strip() for dep in section.get('after', '').split(',') if dep.strip())
+        actions.append(ShutdownAction(name, run, after, timeout))
+    return options, actions
+
+def check_order(actions):
+    ''' Raise ValueError for duplicate names, unknown dependencies or dependency cycles '''
+    names = {}
+    for action in actions:
+        if action.name in names:
+            raise ValueError("Duplicate action " + action.name)
+        names[action.name] = action
+    for action in actions:
+        for dep in action.after:
+            if dep not in names:
+                raise ValueError("Action " + action.name + " comes after unknown action " + dep)
+    done = set()
+    remaining = list(actions)
+    while remaining:
+        ready = [action for action in remaining if all(dep in done for dep in action.after)]
+        if not ready:
+            raise ValueError("Dependency cycle between " + ", ".join(action.name for action in remaining))
+        done.update(action.name for action in ready)
+        remaining = [action for action in remaining if action.name not in done]
+
+def run_action(action):
+    ''' Run an action in a worker thread, raises on failure '''
+    if callable(action.run):
+        action.run()
+        return
+    command = shlex.split(action.run) if isinstance(action.run, str) else action.run
+    completed = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE, timeout=action.timeout)
+    if completed.returncode != 0:
+        raise RuntimeError("Exit status " + str(completed.returncode) + ": " + completed.stderr.decode(errors='replace').strip())
+
+class ShutdownOrchestrator:
+    '''
+    comm            Engine (ApcComm or AsyncApcComm) of the UPS
+    actions         ShutdownActions
+    runtime         Seconds of runtime_remaining_2 on battery below which the shutdown starts
+    outlet_option   outlet_cmd option given when the load is safe, SHUTDOWN or OFF_DELAY
+    predictor       apcpredict.RuntimePredictor of the engine, to trigger on the predicted runtime as well.
+                    Only once it measured the capacity on battery, and when the low end of the band
+                    stays below the threshold for prediction_hold seconds
+    dry_run         Run the actions, but do not switch off the outlet
+    '''
+
+    def __init__(self, comm, actions, runtime=RUNTIME_THRESHOLD, outlet_option=OUTLET_OPTION, workers=WORKERS,
+                 off_wait=OFF_WAIT, predictor=None, prediction_hold=PREDICTION_HOLD, dry_run=False):
+        check_order(actions)
+        self.outlet_msg = make_set_msg('outlet_cmd', outlet_option)
+        self.comm = comm
+        self.actions = list(actions)
+        self.runtime = runtime
+        self.outlet_option = outlet_option
+        self.workers = workers
+        self.off_wait = off_wait
+        self.predictor = predictor
+        self.prediction_hold = prediction_hold
+        self.dry_run = dry_run
+        self.low_since = None#Timestamp of the first prediction below the threshold, None while above
+
+        self.lock = threading.Lock()
+        self.thread = None#Runs the shutdown once triggered
+        self.triggered = None
+        self.triggered_monotonic = None#Trigger time on the clock of the action timing
+        self.outlet_sent = False
+        self.off_time = None
+        self.off = threading.Event()
+        self.done = threading.Event()
+        self.report = None
+        self.report_listeners = ()
+
+    def attach(self):
+        ''' Start watching the engine, triggers right away when the state already asks for it '''
+        self.comm.add_delta_listener(self.on_delta, keys=('runtime_remaining_2', 'outlet_status_raw', 'ups_status_raw'))
+        if self.predictor is not None:
+            self.predictor.add_listener(self.on_prediction)
+        reason = self.check(self.comm.ups_state)
+        if reason is not None:
+            self.trigger(reason)
+
+    def detach(self):
+        self.comm.remove_delta_listener(self.on_delta)
+        if self.predictor is not None:
+            self.predictor.remove_listener(self.on_prediction)
+
+    def add_report_listener(self, callback):
+        ''' Call callback(report) from the shutdown thread when the shutdown is finished '''
+        self.report_listeners = self.report_listeners + (callback,)
+
+    def check(self, values):
+        ''' Reason to shut down for a state, None when there is none '''
+        if not values.get('ups_status_raw', 0) & 4:#ON BATTERY
+            self.low_since = None
+            return None
+        runtime = values.get('runtime_remaining_2')
+        if runtime is not None and runtime < self.runtime:
+            return "Runtime %d s below %d s" % (runtime, self.runtime)
+        if values.get('outlet_status_raw', 0) & 4096:
+            return "Outlet reports LOW RUNTIME"
+        if self.predictor is not None:
+            return self.check_prediction(self.predictor.prediction)
+        return None
+
+    def check_prediction(self, prediction):
+        ''' Reason when the low end of the predicted runtime stayed below the threshold for prediction_hold '''
+        if not self.predictor.measured or prediction.low is None or prediction.low >= self.runtime:
+            self.low_since = None
+            return None
+        if self.low_since is None:
+            self.low_since = prediction.timestamp
+        if prediction.timestamp - self.low_since < self.prediction_hold:
+            return None
+        return "Predicted runtime %d s below %d s for %d s" % (prediction.low, self.runtime, prediction.timestamp - self.low_since)
+
+    def on_delta(self, delta):
+        ''' Delta listener of the engine, runs on the communication thread/loop '''
+        values = self.comm.ups_state
+        if self.thread is None:
+            reason = self.check(values)
+            if reason is not None:
+                self.trigger(reason, delta.timestamp)
+        elif self.outlet_sent and self.off_time is None and self.is_off(values):
+            self.off_time = delta.timestamp - self.triggered
+            self.off.set()
+
+    def on_prediction(self, prediction):
+        ''' Listener of the predictor, runs on the communication thread/loop '''
+        if self.thread is None:
+            reason = self.check(self.comm.ups_state)
+            if reason is not None:
+                self.trigger(reason, prediction.timestamp)
+
+    @staticmethod
+    def is_off(values):
+        return bool(values.get('ups_status_raw', 0) & 16 or values.get('outlet_status_raw', 0) & 2)#OUTPUT OFF, OUTLET OFF
+
+    def trigger(self, reason, timestamp=None):
+        ''' Start the shutdown, once '''
+        with self.lock:
+            if self.thread is not None:
+                return
+            now = time.time()
+            self.triggered = now if timestamp is None else timestamp
+            self.triggered_monotonic = time.monotonic() - (now - self.triggered)
+            self.thread = threading.Thread(target=self.run, args=(reason,), name='shutdown', daemon=True)
+        self.thread.start()
+
+    def wait(self, timeout=None):
+        ''' Wait for the shutdown to finish, returns the ShutdownReport or None '''
+        self.done.wait(timeout)
+        return self.report
+
+    def run(self, reason):
+        results = self.run_actions()
+        accepted = False
+        outlet_time = None
+        if not self.dry_run:
+            for _ in range(OUTLET_ATTEMPTS):
+                self.outlet_sent = True
+                if self.comm.send_apc_msg(self.outlet_msg, timeout=COMMAND_TIMEOUT):
+                    accepted = True
+                    outlet_time = time.time() - self.triggered
+                    break
+            if accepted:
+                if self.off_time is None and self.is_off(self.comm.ups_state):
+                    self.off_time = time.time() - self.triggered
+                off_wait = self.off_wait
+                if self.outlet_option == 'OFF_DELAY':
+                    off_wait += self.comm.ups_state.get('power_off_delay', 0)
+                self.off.wait(off_wait)
+        self.report = ShutdownReport(reason, self.triggered, tuple(results), accepted, outlet_time, self.off_time)
+        self.done.set()
+        for callback in self.report_listeners:
+            callback(self.report)
+
+    def run_actions(self):
+        ''' Run all actions in dependency order, returns their ActionResults '''
+        results = []
+        finished = set()
+        pending = list(self.actions)
+        running = {}#Future -> (action, start, deadline)
+        pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='shutdown-action')
+        try:
+            while pending or running:
+                ready = [action for action in pending if all(dep in finished for dep in action.after)]
+                for action in ready:
+                    pending.remove(action)
+                    start = time.monotonic()
+                    running[pool.submit(run_action, action)] = (action, start, start + action.timeout)
+                deadline = min(deadline for action, start, deadline in running.values())
+                done, _ = wait(running, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+                now = time.monotonic()
+                for future, (action, start, deadline) in list(running.items()):
+                    if future in done:
+                        error = future.exception()
+                        if error is None:
+                            status, detail = 'ok', ''
+                        elif isinstance(error, subprocess.TimeoutExpired):
+                            status, detail = 'timeout', ''
+                        else:
+                            status, detail = 'failed', str(error) or type(error).__name__
+                    elif deadline <= now:
+                        future.cancel()
+                        status, detail = 'timeout', ''
+                    else:
+                        continue
+                    del running[future]
+                    finished.add(action.name)
+                    results.append(ActionResult(action.name, status, start - self.triggered_monotonic, now - start, detail))
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)#Do not wait for actions that were given up
+        return results
+
+def print_report(report):
+    print("Shutdown: " + report.reason)
+    for result in report.results:
+        print("  %-20s %-8s started after %6.2f s, took %6.2f s %s" % (result.name, result.status, result.start, result.duration, result.detail))
+    if report.outlet_accepted:
+        print("Outlet command accepted after %.2f s" % report.outlet_time)
+    else:
+        print("Outlet command not sent or not accepted")
+    if report.off_time is not None:
+        print("Outlet off %.2f s after the trigger" % report.off_time)
+
+if __name__ == '__main__':
+
+    if len(sys.argv) not in (3, 4) or (len(sys.argv) == 4 and sys.argv[3] != 'dry'):
+        print("APC UPS shutdown orchestrator\n\nUsage: " + sys.argv[0] + " <serial port> <config file> [dry]")
+        sys.exit(0)
+
+    from apcserial import ApcComm
+    from apcport import open_port
+    from apcprotocol import APC_RCV_TIMEOUT
+    from apcpredict import RuntimePredictor
+
+    options, actions = read_config(sys.argv[2])
+    apccomm = ApcComm(open_port(sys.argv[1], timeout=APC_RCV_TIMEOUT))
+    predictor = RuntimePredictor()
+    predictor.attach(apccomm)
+    orchestrator = ShutdownOrchestrator(apccomm, actions, predictor=predictor, dry_run=len(sys.argv) == 4, **options)
+    orchestrator.add_report_listener(print_report)
+    apccomm.start()
+    orchestrator.attach()
+    try:
+        orchestrator.wait()
+    except KeyboardInterrupt:
+        pass
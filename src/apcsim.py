@@ -0,0 +1,429 @@
+'''
+Microlink UPS simulator on a pseudo-terminal.
+
+UpsSimulator opens a pty pair and plays the UPS side of the protocol on the master end,
+so the engines can be run and load-tested without hardware: open port_name like a
+serial port. It answers INIT/RESET/NEXT/BACK with frames from a register image of an
+SMC1000i, runs the 0x7f/0x7e challenge exchange and applies the writes of
+create_msg_data(), echoing the written message ID like the UPS does.
+
+For tests it can be scripted: line impairments (latency, jitter, noise, dropped bytes)
+can be changed at any time, power_event() switches between grid and battery and
+schedule() runs a function on the simulator thread after a delay.
+'''
+import os
+import sys
+import tty
+import time
+import heapq
+import random
+import select
+import datetime
+import threading
+from checksum.fletcherNbit import Fletcher
+from apcdecode import FIELDS, encode_field
+from apcprotocol import calculate_challenge
+
+MSG_IDS = (0x00,) + tuple(range(0x40, 0x4f)) + tuple(range(0x6c, 0x80))#Message IDs in the order they are sent
+MSG_SIZE = 16
+BACK_WAIT = 0.02#Time to wait for the 0xFD of an INIT after a 0xF7, before taking it as BACK
+TICK = 1.0#Seconds between updates of the battery model
+READ_SIZE = 256
+
+CMD_BACK = 0xF7
+CMD_RESET = 0xFD
+CMD_NEXT = 0xFE
+
+FULL_RUNTIME = 3600#Runtime in seconds on a full battery at the default load
+CHARGE_TIME = 4 * 3600#Seconds to charge an empty battery
+LOW_RUNTIME = 300#Runtime in seconds below which the outlet reports LOW RUNTIME
+
+POWER_EVENTS = ('outage', 'restore', 'low_runtime', 'fault', 'clear_fault')
+
+MODE0 = 'MODE0'#Sending the message IDs for the first time since reset, waiting for the challenge answer
+MODE1 = 'MODE1'#Challenge answered, writes are accepted
+
+#Register values of a fresh SMC1000i on the grid
+DEFAULTS = (
+    ('serial_nb', '3S1607X00588'),
+    ('production_date', datetime.datetime(2016, 2, 15)),
+    ('fw_version_1', 'UPS 09.3'),
+    ('fw_version_2', ' ID18'),
+    ('fw_version_3', 'ID 18'),
+    ('fw_version_4', ''),
+    ('battery_install_date', datetime.datetime(2019, 1, 7)),
+    ('battery_lifetime', 1095),
+    ('battery_near_eol_alarm_notification', 183),
+    ('battery_near_eol_alarm_reminder', 14),
+    ('battery_sku', 'RBC48'),
+    ('ups_name', 'apcUPS'),
+    ('battery_replacetest_interval', 16),
+    ('battery_replacement_due', datetime.datetime(2022, 1, 6)),
+    ('low_runtime_alarm_config', 150),
+    ('voltage_accept_max', 285),
+    ('voltage_accept_min', 151),
+    ('voltage_sensitivity', 1),
+    ('apparent_power_rating', 1000),
+    ('real_power_rating', 600),
+    ('voltage_config', 32),
+    ('power_on_delay', 0),
+    ('power_off_delay', 90),
+    ('reboot_delay', 8),
+    ('runtime_minimum_return', 0),
+    ('loadshed_config', 0),
+    ('outlet_name', 'Main Outlet'),
+    ('battery_lifetime_status', 1),
+    ('battery_voltage', 27.3),
+    ('battery_soc', 100.0),
+    ('runtime_remaining', FULL_RUNTIME),
+    ('runtime_remaining_2', FULL_RUNTIME),
+    ('temperature', 25.5),
+    ('voltage_out', 230.0),
+    ('current_out', 0.6),
+    ('frequency_out', 50.0),
+    ('apparent_power_pctused', 14.0),
+    ('real_power_pctused', 12.0),
+    ('input_status', 1),
+    ('voltage_in', 230.0),
+    ('frequency_in', 50.0),
+    ('outlet_status', 1),
+    ('ups_status', 2),
+    ('status_chg_cause', 8),
+    ('password_1', b'\x8a\x1d\x00\x00'),
+)
+
+def make_frame(msg_id, data):
+    ''' Frame as sent by the UPS: ID, data and Fletcher checksum '''
+    frame = bytearray([msg_id]) + data
+    f8 = Fletcher()
+    f8.update(frame)
+    frame.append(f8.cb0)
+    frame.append(f8.cb1)
+    return bytes(frame)
+
+def write_checksum_ok(write):
+    ''' Check a message of create_msg_data(), its checksum covers at most the first 15 bytes '''
+    f8 = Fletcher()
+    f8.update(write[0:-2][0:15])
+    return write[-2:] == bytes([f8.cb0, f8.cb1])
+
+class UpsSimulator(threading.Thread):
+    '''
+    latency      Seconds before every reply is sent
+    jitter       Maximum random extra latency in seconds
+    noise_rate   Probability that a sent byte gets a bit flipped
+    drop_rate    Probability that a sent byte is lost
+    seed         Seed for the random impairments, for reproducible runs
+    '''
+
+    def __init__(self, latency=0.0, jitter=0.0, noise_rate=0.0, drop_rate=0.0, seed=None):
+        super(UpsSimulator, self).__init__()
+        self.daemon = True
+        self.latency = latency
+        self.jitter = jitter
+        self.noise_rate = noise_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)#No echo or line editing before the client opens the port
+        self.port_name = os.ttyname(self.slave)
+
+        self.registers = {msg_id: bytearray(MSG_SIZE) for msg_id in MSG_IDS}
+        self.registers[0x00][0:8] = bytes([0x00, MSG_SIZE, len(MSG_IDS), 0x00, 0x07, 0x01, 0x00, 0x00])
+        self.set_text(0x41, 'Smart-UPS C 1000', 32)
+        self.set_text(0x43, 'SMC1000I', 20)
+        for name, value in DEFAULTS:
+            self.set_value(name, value)
+        self.on_battery = False
+        self.load = 1.0#Load relative to the default, scales the discharge rate
+
+        self.mode = MODE0
+        self.index = 0#Position in MSG_IDS of the last sent message
+        self.last_frame = None
+        self.timers = []#Heap of (time, sequence number, function, args)
+        self.timer_seq = 0
+        self.lock = threading.Lock()
+        self.running = False
+        self.stats = {'frames': 0, 'writes': 0, 'rejected': 0, 'resets': 0, 'challenges': 0,
+                      'bytes_dropped': 0, 'bytes_corrupted': 0}
+
+    def set_value(self, name, value):
+        ''' Set a decoder field in the register image '''
+        msg_id, field = FIELDS[name]
+        data = encode_field(field, value)
+        self.registers[msg_id][field.offset:field.offset + len(data)] = data
+
+    def set_text(self, msg_id, text, length):
+        ''' Set a text that may continue over the next message IDs '''
+        data = text.encode()[:length].ljust(length)
+        for pos in range(0, length, MSG_SIZE):
+            chunk = data[pos:pos + MSG_SIZE]
+            self.registers[msg_id + pos // MSG_SIZE][0:len(chunk)] = chunk
+
+    def get_raw(self, name):
+        ''' Raw unsigned value of a numeric field in the register image '''
+        msg_id, field = FIELDS[name]
+        return int.from_bytes(self.registers[msg_id][field.offset:field.offset + field.width], byteorder='big')
+
+    def schedule(self, delay, function, *args):
+        ''' Call function(*args) on the simulator thread after delay seconds '''
+        with self.lock:
+            self.timer_seq += 1
+            heapq.heappush(self.timers, (time.monotonic() + delay, self.timer_seq, function, args))
+
+    def power_event(self, event):
+        '''
+        Simulate a change of the power situation, from any thread.
+
+        outage        Grid lost, running on battery
+        restore       Grid back, charging
+        low_runtime   Battery nearly empty
+        fault         Inverter fault
+        clear_fault   Fault cleared
+        '''
+        if event not in POWER_EVENTS:
+            raise ValueError("Unknown power event " + repr(event))
+        self.schedule(0, self.apply_power_event, event)
+
+    def apply_power_event(self, event):
+        if event == 'outage':
+            self.on_battery = True
+            self.set_value('ups_status', self.get_raw('ups_status') & (16 | 32) | 4 | 64)#ON BATTERY, INPUT BAD, keep OUTPUT OFF and FAULT
+            self.set_value('input_status', 4 | 4096)#LOW VOLTAGE, NOT ACCEPTABLE
+            self.set_value('voltage_in', 0.0)
+            self.set_value('frequency_in', 0.0)
+            self.set_value('status_chg_cause', 2)#LowInputVoltage
+        elif event == 'restore':
+            self.on_battery = False
+            self.set_value('ups_status', self.get_raw('ups_status') & (16 | 32) | 2)#ONLINE, keep OUTPUT OFF and FAULT
+            self.set_value('input_status', 1)#ACCEPTABLE
+            self.set_value('voltage_in', 230.0)
+            self.set_value('frequency_in', 50.0)
+            self.set_value('status_chg_cause', 8)#AcceptableInput
+            if self.get_raw('outlet_status') & 1024:#WAIT ON AC after a shutdown
+                self.set_outlet(True)
+        elif event == 'low_runtime':
+            self.set_battery(5.0)
+            self.set_value('status_chg_cause', 13)#LowBatteryVoltage
+        elif event == 'fault':
+            self.set_value('ups_status', self.get_raw('ups_status') | 32)#FAULT
+            self.set_value('powsys_error', 8192)#INVERTER FAULT
+            self.set_value('status_chg_cause', 15)#PowerSystemError
+        elif event == 'clear_fault':
+            self.set_value('ups_status', self.get_raw('ups_status') & ~32)
+            self.set_value('powsys_error', 0)
+            self.set_value('status_chg_cause', 17)#ErrorCleared
+
+    def set_battery(self, soc):
+        ''' Set the state of charge and the values that follow from it '''
+        soc = min(max(soc, 0.0), 100.0)
+        runtime = int(FULL_RUNTIME * soc / 100 / self.load)
+        self.set_value('battery_soc', soc)
+        self.set_value('battery_voltage', 24.0 + 3.3 * soc / 100)
+        self.set_value('runtime_remaining', runtime)
+        self.set_value('runtime_remaining_2', runtime)
+        outlet = self.get_raw('outlet_status') & ~4096
+        self.set_value('outlet_status', outlet | 4096 if runtime < LOW_RUNTIME else outlet)#LOW RUNTIME
+
+    def update_battery(self):
+        ''' Battery model, called every TICK seconds '''
+        self.schedule(TICK, self.update_battery)
+        soc = self.get_raw('battery_soc') / 2**9
+        if self.on_battery:
+            self.set_battery(soc - 100.0 * TICK * self.load / FULL_RUNTIME)
+            if soc <= 0:
+                self.set_outlet(False)
+        elif soc < 100.0:
+            self.set_battery(soc + 100.0 * TICK / CHARGE_TIME)
+
+    def set_load(self, load):
+        ''' Change the load relative to the default, from any thread '''
+        self.schedule(0, self.apply_load, load)
+
+    def apply_load(self, load):
+        self.load = load
+        on = not self.get_raw('ups_status') & 16
+        self.set_value('current_out', 0.6 * load if on else 0.0)
+        self.set_value('real_power_pctused', 12.0 * load if on else 0.0)
+        self.set_value('apparent_power_pctused', 14.0 * load if on else 0.0)
+
+    def set_outlet(self, on):
+        self.set_value('outlet_status', 1 if on else 2)
+        status = self.get_raw('ups_status') & ~16
+        self.set_value('ups_status', status if on else status | 16)#OUTPUT OFF
+        self.set_value('voltage_out', 230.0 if on else 0.0)
+        self.set_value('current_out', 0.6 * self.load if on else 0.0)
+
+    def outlet_cmd(self, cmd):
+        ''' Act on a command written to outlet_cmd, see ApcCLI.do_set for the bits '''
+        if cmd & 1:#Cancel
+            with self.lock:
+                self.timers = [timer for timer in self.timers if timer[2] != self.set_outlet]
+                heapq.heapify(self.timers)
+        elif cmd & 2:#On
+            delay = self.get_raw('power_on_delay') if cmd & 64 else 0
+            self.schedule(delay, self.set_outlet, True)
+        elif cmd & 4:#Off
+            delay = self.get_raw('power_off_delay') if cmd & 128 else 0
+            self.schedule(delay, self.set_outlet, False)
+        elif cmd & 8:#Shutdown, back on when the grid returns
+            self.set_outlet(False)
+            self.set_value('outlet_status', 2 | 1024)#WAIT ON AC
+        elif cmd & 16:#Reboot
+            self.set_outlet(False)
+            self.set_value('outlet_status', 2 | 4)#REBOOTING
+            self.schedule(self.get_raw('reboot_delay'), self.set_outlet, True)
+
+    def run(self):
+        self.running = True
+        self.schedule(TICK, self.update_battery)
+        buf = bytearray()
+        while self.running:
+            with self.lock:
+                timeout = max(self.timers[0][0] - time.monotonic(), 0) if self.timers else TICK
+            ready, _, _ = select.select([self.master], [], [], min(timeout, TICK))
+            if ready:
+                try:
+                    buf += os.read(self.master, READ_SIZE)
+                except OSError:
+                    #No client has the port open
+                    time.sleep(BACK_WAIT)
+                    continue
+                self.handle_input(buf)
+            self.run_timers()
+
+    def run_timers(self):
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.timers or self.timers[0][0] > now:
+                    return
+                _, _, function, args = heapq.heappop(self.timers)
+            function(*args)
+
+    def handle_input(self, buf):
+        ''' Handle all complete commands and writes in buf, leftover bytes stay in it '''
+        while buf:
+            byte = buf[0]
+            if byte == CMD_BACK:
+                if len(buf) == 1:
+                    #Could be the start of INIT (0xF7 0xFD)
+                    ready, _, _ = select.select([self.master], [], [], BACK_WAIT)
+                    if ready:
+                        try:
+                            buf += os.read(self.master, READ_SIZE)
+                        except OSError:
+                            pass
+                if buf[1:2] == bytes([CMD_RESET]):
+                    del buf[0:2]
+                    self.reset()
+                else:
+                    del buf[0]
+                    if self.last_frame is not None:
+                        self.send(self.last_frame)
+            elif byte == CMD_RESET:
+                del buf[0]
+                self.reset()
+            elif byte == CMD_NEXT:
+                del buf[0]
+                self.index = (self.index + 1) % len(MSG_IDS)
+                self.send_msg(MSG_IDS[self.index])
+            elif byte in self.registers:
+                if len(buf) < 3:
+                    return
+                size = 3 + buf[2] + 2
+                if len(buf) < size:
+                    return
+                write = bytes(buf[0:size])
+                del buf[0:size]
+                self.handle_write(write)
+            else:
+                del buf[0]#Garbage
+
+    def reset(self):
+        self.stats['resets'] += 1
+        self.mode = MODE0
+        self.index = 0
+        self.send_msg(MSG_IDS[0])
+
+    def handle_write(self, write):
+        msg_id, offset, length = write[0], write[1], write[2]
+        data = write[3:3 + length]
+        if not write_checksum_ok(write) or offset + length > MSG_SIZE:
+            self.stats['rejected'] += 1
+            return
+        if self.mode == MODE0:
+            if msg_id != 0x7e or offset != 12:
+                self.stats['rejected'] += 1
+                return
+            #Answer to the challenge, sent after the first pass over all message IDs
+            registers = self.registers
+            expected = calculate_challenge(registers[0x00][3:5], registers[0x00][0:8], registers[0x40][0:14], registers[0x7e][8:12])
+            self.stats['challenges'] += 1
+            if data != expected:
+                self.stats['rejected'] += 1
+                self.reset()
+                return
+            self.mode = MODE1
+        self.stats['writes'] += 1
+        self.registers[msg_id][offset:offset + length] = data
+        if msg_id == 0x71 and offset <= 8 < offset + length:
+            self.outlet_cmd(self.get_raw('outlet_cmd'))
+        self.send_msg(msg_id)
+
+    def send_msg(self, msg_id):
+        self.send(make_frame(msg_id, self.registers[msg_id]))
+
+    def send(self, frame):
+        self.last_frame = frame
+        self.stats['frames'] += 1
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+        if self.noise_rate or self.drop_rate:
+            frame = self.impair(frame)
+        try:
+            os.write(self.master, frame)
+        except OSError:
+            pass
+
+    def impair(self, frame):
+        out = bytearray()
+        for byte in frame:
+            if self.random.random() < self.drop_rate:
+                self.stats['bytes_dropped'] += 1
+                continue
+            if self.random.random() < self.noise_rate:
+                byte ^= 1 << self.random.randrange(8)
+                self.stats['bytes_corrupted'] += 1
+            out.append(byte)
+        return out
+
+    def stop(self):
+        self.running = False
+        if self.is_alive():
+            self.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+if __name__ == '__main__':
+
+    sim = UpsSimulator()
+    sim.start()
+    print("Simulated UPS on " + sim.port_name + ", commands: outage, restore, low_runtime, fault, clear_fault, load <factor>, quit")
+    for line in sys.stdin:
+        event = line.strip()
+        if event == 'quit':
+            break
+        elif event.startswith('load '):
+            try:
+                sim.set_load(float(event[5:]))
+            except ValueError as e:
+                print(e)
+        elif event:
+            try:
+                sim.power_event(event)
+            except ValueError as e:
+                print(e)
+    sim.stop()
@@ -0,0 +1,36 @@
+'''
+Published UPS state.
+
+The serial thread never modifies a state that readers can see: every update is made
+on a copy, which is then published as a new StateSnapshot with a single reference
+assignment. Readers just take the current snapshot and get a consistent view without locking.
+
+Next to the snapshots, a StateDelta lists only the values that changed with a frame.
+'''
+import time
+from collections import namedtuple
+from types import MappingProxyType
+from apcrecord import UpsState
+
+StateSnapshot = namedtuple('StateSnapshot', 'seq timestamp values')
+StateSnapshot.__doc__ = '''
+seq           Sequence number, incremented on every publication
+timestamp     Time of publication (time.time())
+values        Read-only mapping of the UPS state, a frozen apcrecord.UpsState or a view of a dict
+'''
+
+StateDelta = namedtuple('StateDelta', 'seq timestamp msg_id changes')
+StateDelta.__doc__ = '''
+seq           Sequence number of the snapshot the changes were published with
+timestamp     Time of publication (time.time())
+msg_id        Message ID of the frame that caused the changes, None for changes of the communication state
+changes       Dict {key: new value} of the changed values
+'''
+
+def make_snapshot(values, seq=0, timestamp=None):
+    ''' Wrap a state (UpsState or dict), which must not be modified afterwards, in a snapshot '''
+    if timestamp is None:
+        timestamp = time.time()
+    if isinstance(values, UpsState):
+        return StateSnapshot(seq, timestamp, values.freeze())
+    return StateSnapshot(seq, timestamp, MappingProxyType(values))
@@ -0,0 +1,179 @@
+'''
+End-to-end benchmark of ApcComm against the simulated UPS of apcsim.
+
+Measures, over a pseudo-terminal:
+- the time from a cold start to MODE1 (INIT, first pass over all IDs and challenge)
+- frames per second and the duration of a full poll cycle over all message IDs in MODE1
+- CPU time of the communication thread per frame
+- the round trip latency of send_apc_msg (p50/p99/p999), using zero-length writes
+  that the UPS only echoes
+
+The results are written as JSON, together with the git commit, so runs can be compared:
+
+    python3 benchComm.py -o before.json
+    python3 benchComm.py -o after.json --compare before.json
+'''
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import threading
+import subprocess
+from apcprotocol import CommState, APC_RCV_TIMEOUT
+from apcport import FdPort
+from apcserial import ApcComm
+from apcsim import UpsSimulator, MSG_IDS
+
+MODE1_TIMEOUT = 30.0#Give up on a cold start after this many seconds
+
+def percentile(values, pct):
+    ''' Nearest-rank percentile of a sorted list '''
+    if not values:
+        return None
+    index = min(int(len(values) * pct / 100), len(values) - 1)
+    return values[index]
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Probe:
+    ''' State listener counting frames, runs on the communication thread '''
+
+    def __init__(self, comm):
+        self.comm = comm
+        self.frames = 0
+        self.thread_time = 0.0
+        self.mode1 = threading.Event()
+
+    def __call__(self, snapshot):
+        self.frames += 1
+        self.thread_time = time.thread_time()
+        if self.comm.state == CommState.MODE1:
+            self.mode1.set()
+
+def start(sim_options):
+    ''' Start a simulator and an ApcComm on it, returns (simulator, comm, probe, port) '''
+    sim = UpsSimulator(**sim_options)
+    sim.start()
+    port = FdPort(sim.port_name, timeout=APC_RCV_TIMEOUT)
+    comm = ApcComm(port)
+    probe = Probe(comm)
+    comm.add_listener(probe)
+    return sim, comm, probe, port
+
+def stop(sim, comm, port):
+    comm.running = False
+    comm.join()
+    port.close()
+    sim.stop()
+
+def bench_mode1(runs, sim_options):
+    ''' Seconds from a cold start to MODE1, per run '''
+    times = []
+    for _ in range(runs):
+        sim, comm, probe, port = start(sim_options)
+        begin = time.perf_counter()
+        comm.start()
+        if probe.mode1.wait(MODE1_TIMEOUT):
+            times.append(time.perf_counter() - begin)
+        stop(sim, comm, port)
+    return sorted(times)
+
+def bench_poll(duration, sim_options):
+    ''' Frames per second and CPU seconds per frame in MODE1 '''
+    sim, comm, probe, port = start(sim_options)
+    comm.start()
+    probe.mode1.wait(MODE1_TIMEOUT)
+    frames, thread_time = probe.frames, probe.thread_time
+    begin = time.perf_counter()
+    time.sleep(duration)
+    elapsed = time.perf_counter() - begin
+    frames, thread_time = probe.frames - frames, probe.thread_time - thread_time
+    stop(sim, comm, port)
+    return frames / elapsed, (thread_time / frames if frames else None)
+
+def bench_commands(count, sim_options):
+    ''' Sorted round trip times of send_apc_msg in seconds, and the number of failed commands '''
+    sim, comm, probe, port = start(sim_options)
+    comm.start()
+    probe.mode1.wait(MODE1_TIMEOUT)
+    times = []
+    failed = 0
+    for i in range(count):
+        raw_msg = comm.create_msg_data(msg_id=MSG_IDS[1 + i % (len(MSG_IDS) - 1)], offset=0, msg_data=bytearray())
+        begin = time.perf_counter()
+        if comm.send_apc_msg(raw_msg):
+            times.append(time.perf_counter() - begin)
+        else:
+            failed += 1
+    stop(sim, comm, port)
+    return sorted(times), failed
+
+def run(args):
+    sim_options = {'latency': args.latency, 'jitter': args.jitter, 'noise_rate': args.noise, 'drop_rate': args.drop, 'seed': 0}
+    mode1 = bench_mode1(args.runs, sim_options)
+    fps, cpu = bench_poll(args.duration, sim_options)
+    latencies, failed = bench_commands(args.commands, sim_options)
+    ms = lambda value: None if value is None else value * 1000
+    return {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': sim_options,
+        'results': {
+            'mode1_ms_p50': ms(percentile(mode1, 50)),
+            'mode1_ms_max': ms(mode1[-1] if mode1 else None),
+            'mode1_failed': args.runs - len(mode1),
+            'frames_per_s': fps,
+            'poll_cycle_ms': ms(len(MSG_IDS) / fps) if fps else None,
+            'cpu_us_per_frame': None if cpu is None else cpu * 1e6,
+            'cmd_ms_p50': ms(percentile(latencies, 50)),
+            'cmd_ms_p99': ms(percentile(latencies, 99)),
+            'cmd_ms_p999': ms(percentile(latencies, 99.9)),
+            'cmd_failed': failed,
+        },
+    }
+
+def compare(results, baseline):
+    ''' Print the results next to a baseline '''
+    print("%-18s %12s %12s" % ('', 'this run', 'baseline'))
+    for key, value in results['results'].items():
+        old = baseline['results'].get(key)
+        line = "%-18s %12s" % (key, "-" if value is None else "%.3f" % value)
+        if old is not None and value is not None:
+            line += " %12.3f" % old
+            if old:
+                line += " %+8.1f%%" % ((value - old) / old * 100)
+        print(line)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of ApcComm against a simulated UPS")
+    parser.add_argument('-o', '--output', help="Write the results as JSON to this file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare with")
+    parser.add_argument('--runs', type=int, default=10, help="Number of cold starts to MODE1")
+    parser.add_argument('--duration', type=float, default=5.0, help="Seconds to poll for the frame rate")
+    parser.add_argument('--commands', type=int, default=2000, help="Number of commands for the latency")
+    parser.add_argument('--latency', type=float, default=0.0, help="Simulated reply latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Simulated random extra latency in seconds")
+    parser.add_argument('--noise', type=float, default=0.0, help="Probability of a corrupted byte")
+    parser.add_argument('--drop', type=float, default=0.0, help="Probability of a dropped byte")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
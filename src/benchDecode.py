@@ -0,0 +1,112 @@
+'''
+Benchmark of the table-driven message decoder.
+
+Compares the frames decoded per second by the compiled decoders in apcdecode, into
+the UpsState record the engine uses, against the if/elif chain of handle_apc_msg
+before the decoder was table driven, into the plain dict the engine used then.
+The chain is taken from the git history (BASELINE), so this needs a git checkout.
+
+Usage: python3 benchDecode.py [number of frames]
+'''
+import os
+import sys
+import time
+import random
+import datetime
+import subprocess
+from apcdecode import REGISTER_MAP, STR, STR_APPEND, decode_msg
+from apcprotocol import CommState
+from apcrecord import UpsState
+
+BASELINE = '090e74a^'#Last revision with the if/elif chain in apcserial.ApcComm.handle_apc_msg
+
+class ChainEngine:
+    ''' The part of the former ApcComm that the if/elif chain uses '''
+
+    def __init__(self):
+        self.state = CommState.MODE1#The 0x7f branch only answers the challenge in MODE0
+        self.ups_state = {}
+
+    def convert_from_bp(self, data, frac_pos, signed=False):
+        ''' Convert the binary point number in data to a float, given the fractional bit position '''
+        data = int.from_bytes(data, byteorder='big', signed=signed)
+        value = data / (2**frac_pos)
+        return value
+
+    def convert_to_datetime(self, value):
+        ''' Convert from days since 1 Jan. 2000 to datetime object '''
+        return datetime.datetime(2000,1,1) + datetime.timedelta(days=value)
+
+def load_chain(revision=BASELINE):
+    '''
+    Compile the if/elif chain of handle_apc_msg at revision into a function (msg_id, msg_data, state),
+    None when the git history is not available
+    '''
+    try:
+        source = subprocess.run(['git', 'show', revision + ':src/apcserial.py'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout
+        start = source.index('            #Identify data\n')
+        end = source.index('            #Default behavior is to request next data')
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+    namespace = {'CommState': CommState}
+    exec('def chain(self, msg_id, msg_data):\n' + source[start:end], namespace)
+    chain = namespace['chain']
+    engine = ChainEngine()
+
+    def chain_decode(msg_id, msg_data, state):
+        engine.ups_state = state
+        chain(engine, msg_id, msg_data)
+
+    return chain_decode
+
+def chain_state():
+    ''' Empty state for the chain, which appends to the texts that continue over two message IDs '''
+    return {f.name: '' for fields in REGISTER_MAP.values() for f in fields if f.kind == STR_APPEND}
+
+def record_decode(msg_id, msg_data, state):
+    ''' Decode a message with the table decoder into an UpsState, like the engine '''
+    state.set_frame(msg_id, msg_data)
+
+def make_frames(count):
+    ''' Random message data for the known message IDs, text IDs get printable data '''
+    random.seed(0)
+    text_ids = set(msg_id for msg_id, fields in REGISTER_MAP.items() if any(f.kind in (STR, STR_APPEND) for f in fields))
+    msg_ids = list(REGISTER_MAP.keys())
+    frames = []
+    for _ in range(count):
+        msg_id = random.choice(msg_ids)
+        if msg_id in text_ids:
+            data = bytearray(random.randrange(0x20, 0x7f) for _ in range(16))
+        else:
+            data = bytearray(random.randrange(256) for _ in range(16))
+        frames.append((msg_id, data))
+    return frames
+
+def run(decode, frames, make_state, repeat=3):
+    ''' Frames decoded per second into the state made by make_state(), the best of a few runs '''
+    best = 0.0
+    for _ in range(repeat):
+        state = make_state()
+        start = time.perf_counter()
+        for msg_id, msg_data in frames:
+            decode(msg_id, msg_data, state)
+        best = max(best, len(frames) / (time.perf_counter() - start))
+    return best
+
+if __name__ == '__main__':
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    frames = make_frames(count)
+
+    chain_decode = load_chain()
+    if chain_decode is None:
+        print("Can not load the if/elif chain from revision " + BASELINE + " of the git history")
+        sys.exit(1)
+    chain_rate = run(chain_decode, frames, chain_state)
+    dict_rate = run(decode_msg, frames, dict)
+    record_rate = run(record_decode, frames, UpsState)
+    print("if/elif chain into dict:      %10.0f frames/s" % chain_rate)
+    print("table decoder into dict:      %10.0f frames/s" % dict_rate)
+    print("table decoder into UpsState:  %10.0f frames/s" % record_rate)
+    print("speedup of the engine:        %10.2fx" % (record_rate / chain_rate))
@@ -0,0 +1,39 @@
+'''
+Benchmark of RuntimePredictor.update.
+
+Feeds a simulated discharge (SOC falling, load with noise) to a predictor, with the
+values in a UpsState as published by the engine, and prints the time per update.
+
+Usage: python3 benchPredict.py [number of updates]
+'''
+import sys
+import time
+import random
+from apcrecord import UpsState
+from apcpredict import RuntimePredictor
+
+def make_states(count):
+    ''' States of a UPS on battery, one every 0.25 s '''
+    random.seed(0)
+    states = []
+    soc = 100.0
+    for _ in range(count):
+        soc = max(soc - 0.005, 0.0)
+        states.append(UpsState({'real_power_pctused': 20.0 + random.gauss(0.0, 1.0), 'real_power_rating': 600,
+                                'battery_soc': round(soc, 1), 'runtime_remaining_2': int(soc * 30),
+                                'ups_status_raw': 4}).freeze())
+    return states
+
+def run(states):
+    predictor = RuntimePredictor()
+    start = time.perf_counter()
+    for index, state in enumerate(states):
+        predictor.update(state, index * 0.25)
+    return (time.perf_counter() - start) / len(states), predictor
+
+if __name__ == '__main__':
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    duration, predictor = run(make_states(count))
+    print("update:   %6.2f us" % (duration * 1e6))
+    print("measured: %s, prediction %s" % (predictor.measured, predictor.prediction))
@@ -0,0 +1,76 @@
+'''
+Throughput benchmark of the sharded collector against simulated UPS units.
+
+The simulators of apcsim run in their own processes (SIM_PORTS per process), with no
+latency, so the collector is the bottleneck. The throughput is the number of frames
+all simulators answered per second, each one polled and decoded by an engine, for a
+single worker and for one worker per core:
+
+    python3 benchShard.py [number of ports] [seconds]
+
+The speedup can only show on a machine with several cores.
+'''
+import os
+import sys
+import time
+import multiprocessing
+from apcsim import UpsSimulator
+from apcport import open_fd_port
+from apcshard import ShardedCollector
+
+SIM_PORTS = 4#Simulated UPS units per simulator process
+
+def run_simulators(conn, count):
+    ''' Simulator process: report the port names, then the frames sent between two messages of the parent '''
+    sims = [UpsSimulator() for _ in range(count)]
+    for sim in sims:
+        sim.set_value('serial_nb', 'SIM' + str(sim.port_name.split('/')[-1]))
+        sim.start()
+    conn.send([sim.port_name for sim in sims])
+    while True:
+        conn.recv()
+        conn.send(sum(sim.stats['frames'] for sim in sims))
+
+def frames(conns):
+    for conn in conns:
+        conn.send(None)
+    return sum(conn.recv() for conn in conns)
+
+def measure(names, conns, workers, duration):
+    collector = ShardedCollector(names, workers=workers, open_port=open_fd_port)
+    collector.start()
+    try:
+        deadline = time.monotonic() + 30.0
+        while len(collector.states()) < len(names) and time.monotonic() < deadline:
+            time.sleep(0.1)#Until every port is in MODE1 and identified
+        start = frames(conns)
+        begin = time.perf_counter()
+        time.sleep(duration)
+        count = frames(conns) - start
+        return count / (time.perf_counter() - begin), collector.workers
+    finally:
+        collector.stop()
+
+if __name__ == '__main__':
+
+    ports = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+
+    ctx = multiprocessing.get_context('spawn')
+    conns = []
+    processes = []
+    names = []
+    for first in range(0, ports, SIM_PORTS):
+        parent_conn, child_conn = ctx.Pipe()
+        process = ctx.Process(target=run_simulators, args=(child_conn, min(SIM_PORTS, ports - first)), daemon=True)
+        process.start()
+        names += parent_conn.recv()
+        conns.append(parent_conn)
+        processes.append(process)
+
+    print("%d ports, %d cores" % (ports, os.cpu_count() or 1))
+    for workers in sorted(set([1, os.cpu_count() or 1])):
+        rate, used = measure(names, conns, workers, duration)
+        print("%2d workers: %8.0f frames/s" % (used, rate))
+    for process in processes:
+        process.terminate()
@@ -0,0 +1,69 @@
+"""
+Batch verification of fixed-size frames that end with two Fletcher-16 check bytes.
+
+Meant for offline analysis of captured frames: the whole buffer is checked in one
+call. When NumPy is available, the sums of all frames are computed at once with
+a matrix product modulo 255. Without NumPy, every frame goes through Fletcher16.
+"""
+from checksum.fletcherNbit import Fletcher16
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def verify_frames(frames, frame_size=19):
+    """
+    Verifies the check bytes of N frames of frame_size bytes each.
+
+    frames can be any contiguous buffer (bytes, bytearray, memoryview, mmap)
+    or a NumPy array of shape (N, frame_size) or (N * frame_size,).
+    Returns (valid, checkbytes): with NumPy a boolean array of N elements and a uint8
+    array of shape (N, 2), otherwise a list of bools and a list of (cb0, cb1) tuples.
+    Raises ValueError when the size is not a multiple of frame_size.
+    """
+    if numpy is not None:
+        return _verify_numpy(frames, frame_size)
+    return _verify_python(frames, frame_size)
+
+
+def _check_size(size, frame_size):
+    if size % frame_size:
+        raise ValueError("Buffer size is not a multiple of the frame size")
+
+
+def _verify_numpy(frames, frame_size):
+    if isinstance(frames, numpy.ndarray):
+        data = frames.astype(numpy.uint8, copy=False)
+    else:
+        data = numpy.frombuffer(frames, dtype=numpy.uint8)
+    _check_size(data.size, frame_size)
+    data = data.reshape(-1, frame_size)
+
+    payload = data[:, :-2].astype(numpy.int64)
+    length = payload.shape[1]
+    # c0 is the plain sum, c1 the sum of the running sums: byte i counts (length - i) times
+    c0 = payload.sum(axis=1) % 255
+    c1 = payload.dot(numpy.arange(length, 0, -1, dtype=numpy.int64)) % 255
+
+    cb0 = 255 - ((c0 + c1) % 255)
+    cb1 = 255 - ((c0 + cb0) % 255)
+    checkbytes = numpy.stack((cb0, cb1), axis=1).astype(numpy.uint8)
+
+    valid = (data[:, -2] == checkbytes[:, 0]) & (data[:, -1] == checkbytes[:, 1])
+    return valid, checkbytes
+
+
+def _verify_python(frames, frame_size):
+    view = memoryview(frames).cast('B')
+    _check_size(len(view), frame_size)
+
+    valid = []
+    checkbytes = []
+    for start in range(0, len(view), frame_size):
+        f = Fletcher16()
+        f.update(view[start:start + frame_size - 2])
+        valid.append(view[start + frame_size - 2] == f.cb0 and view[start + frame_size - 1] == f.cb1)
+        checkbytes.append((f.cb0, f.cb1))
+    return valid, checkbytes
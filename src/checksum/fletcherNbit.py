@@ -1,9 +1,16 @@
+import sys
+from array import array
+from itertools import accumulate
+
+
 class Fletcher:
     """Specifies the general class for the FletcherNbit checksum"""
     
     modulus = 255
     bitshift = 8
     bytes_read = 1
+    word_format = 'B'
+    block_size = 4096
 
     def __init__(self):
         self.c0 = 0
@@ -14,28 +21,45 @@ class Fletcher:
     def update(self, bytestring):
         """Updates the checksum with the data passed in."""
         
-        # prevents unicode or weirdly encoded strings
-        # from being passed in naked
-#         if type(bytestring) != bytes:
-#             bytestring = str.encode(bytestring)
-#         bytestring = bytearray(bytestring)
-
-        # an efficient way of doing math.ceil() without frills
-        iterations = ((len(bytestring) - 1) // self.bytes_read) + 1
-
-        # actually updating the checksum by iterating through the bytes
-        for i in range(0, iterations):
-            start = self.bytes_read*i
-            end = self.bytes_read*(i+1)
-            
-            bytepart = int.from_bytes(bytestring[start:end], byteorder="little")
-            self.c0 = (self.c0 + bytepart) % self.modulus
-            self.c1 = (self.c1 + self.c0) % self.modulus
+        words = self.words(bytestring)
+        c0 = self.c0
+        c1 = self.c1
+        
+        # c0 is the plain sum of the words and c1 the sum of all running c0 values,
+        # so a whole block can be added with sum() and accumulate() in one go.
+        # The modulo is only taken once per block.
+        for start in range(0, len(words), self.block_size):
+            block = words[start:start + self.block_size]
+            c1 += len(block) * c0 + sum(accumulate(block))
+            c0 += sum(block)
+            c0 %= self.modulus
+            c1 %= self.modulus
+        self.c0 = c0
+        self.c1 = c1
 
         # compute check bytes
         self.cb0 = self.modulus - ((self.c0 + self.c1) % self.modulus)
         self.cb1 = self.modulus - ((self.c0 + self.cb0) % self.modulus)
 
+    def words(self, bytestring):
+        """Splits the data in little-endian words of bytes_read bytes, without copying where possible."""
+        
+        if not isinstance(bytestring, (bytes, bytearray, memoryview)):
+            bytestring = bytes(bytestring)
+        view = memoryview(bytestring).cast('B')
+        if self.bytes_read == 1:
+            return view
+        
+        full = len(view) - (len(view) % self.bytes_read)
+        if sys.byteorder == 'little':
+            words = view[:full].cast(self.word_format)
+        else:
+            words = array(self.word_format, bytes(view[:full]))
+            words.byteswap()
+        if full < len(view):
+            # a trailing partial word is read as a shorter little-endian number
+            words = list(words) + [int.from_bytes(view[full:], byteorder="little")]
+        return words
 
     def hexdigest(self):
         """Parses the checksum and returns it in the form of a hex string"""
@@ -66,10 +90,12 @@ class Fletcher32(Fletcher):
     modulus = 65535
     bitshift = 16
     bytes_read = 2
+    word_format = 'H'
     
 
 class Fletcher64(Fletcher):
     """Contains the specification for the 64-bit checksum"""
     modulus = 4294967295
     bitshift = 32
-    bytes_read = 4
\ No newline at end of file
+    bytes_read = 4
+    word_format = 'I'
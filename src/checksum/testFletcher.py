@@ -2,48 +2,166 @@
 Created on 4 nov. 2019
 
 @author: DECRAEMK
+
+Checks the Fletcher checksums against frames captured from the UPS and against a
+straightforward byte-per-byte implementation, then measures the throughput.
+Run from the src directory: python3 -m checksum.testFletcher
 '''
-from checksum.fletcherNbit import Fletcher
+import random
+import time
+from unittest import SkipTest
+from checksum.fletcherNbit import Fletcher, Fletcher16, Fletcher32, Fletcher64
+from checksum import batch
+from checksum.batch import verify_frames
 
-if __name__ == '__main__':
+# 0x7f 0000000019c90013004e000001790000 3190
+# 0x7f 0000000019ca0013004e000001790000 259b
+# 0x7f 0000000019cb0013004e000001790000 19a6
+# 0x7f 0000000019cc0013004e000001790000 0db1
+# 0x7f 0000000019cd0013004e000001790000 01bc
+# 0x7f 0000000019ce0013004e000001790000 f4c7
+# 0x7f 0000000019cf0013004e000001790000 e8d2
+# 0x7f 0000000019d00013004e000001790000 dcdd
+# 0x7f 0000000019d10013004e000001790000 d0e8
+# 0x7f 0000000019d20013004e000001790000 c4f3
+# 0x7f 0000000019d30013004e000001790000 b8fe
+# 0x7f 0000000019d40013004e000001790000 ac0e
+# 0x7f 0000000019d50013004e000001790000 a015
+# 0x7f 000000001c67001500530000017c0000 5eb8
+
+samples = [(bytearray.fromhex("7f0000000019c90013004e000001790000"),0x3190),
+           (bytearray.fromhex("7f0000000019cb0013004e000001790000"),0x19a6),
+           (bytearray.fromhex("7f0000000019cc0013004e000001790000"),0x0db1),
+           (bytearray.fromhex("7f0000000019cd0013004e000001790000"),0x01bc),
+           (bytearray.fromhex("7f0000000019ce0013004e000001790000"),0xf4c7),
+           (bytearray.fromhex("7f0000000019cf0013004e000001790000"),0xe8d2),
+           (bytearray.fromhex("7f0000000019d00013004e000001790000"),0xdcdd),
+           (bytearray.fromhex("7f0000000019d10013004e000001790000"),0xd0e8),
+           (bytearray.fromhex("7f0000000019d20013004e000001790000"),0xc4f3),
+           (bytearray.fromhex("7f0000000019d30013004e000001790000"),0xb8fe),
+           (bytearray.fromhex("7f0000000019d40013004e000001790000"),0xac0a),#Noted as ac0e above, but ac0a follows the sequence
+           (bytearray.fromhex("7f0000000019d50013004e000001790000"),0xa015),
+           (bytearray.fromhex("7f000000001c67001500530000017c0000"),0x5eb8),
+#            (bytearray.fromhex("000a108003ed07090001004000f802fe04"),0x2104),
+#            (bytearray.fromhex("130331fc02fb001fffff03fc0af804fe0e"),0x0c7e)
+           ]
 
-    # 0x7f 0000000019c90013004e000001790000 3190
-    # 0x7f 0000000019ca0013004e000001790000 259b
-    # 0x7f 0000000019cb0013004e000001790000 19a6
-    # 0x7f 0000000019cc0013004e000001790000 0db1
-    # 0x7f 0000000019cd0013004e000001790000 01bc
-    # 0x7f 0000000019ce0013004e000001790000 f4c7
-    # 0x7f 0000000019cf0013004e000001790000 e8d2
-    # 0x7f 0000000019d00013004e000001790000 dcdd
-    # 0x7f 0000000019d10013004e000001790000 d0e8
-    # 0x7f 0000000019d20013004e000001790000 c4f3
-    # 0x7f 0000000019d30013004e000001790000 b8fe
-    # 0x7f 0000000019d40013004e000001790000 ac0e
-    # 0x7f 0000000019d50013004e000001790000 a015
-    # 0x7f 000000001c67001500530000017c0000 5eb8
-
-    samples = [(bytearray.fromhex("7f0000000019c90013004e000001790000"),0x3190),
-               (bytearray.fromhex("7f0000000019cb0013004e000001790000"),0x19a6),
-               (bytearray.fromhex("7f0000000019cc0013004e000001790000"),0x0db1),
-               (bytearray.fromhex("7f0000000019cd0013004e000001790000"),0x01bc),
-               (bytearray.fromhex("7f0000000019ce0013004e000001790000"),0xf4c7),
-               (bytearray.fromhex("7f0000000019cf0013004e000001790000"),0xe8d2),
-               (bytearray.fromhex("7f0000000019d00013004e000001790000"),0xdcdd),
-               (bytearray.fromhex("7f0000000019d10013004e000001790000"),0xd0e8),
-               (bytearray.fromhex("7f0000000019d20013004e000001790000"),0xc4f3),
-               (bytearray.fromhex("7f0000000019d30013004e000001790000"),0xb8fe),
-               (bytearray.fromhex("7f0000000019d40013004e000001790000"),0xac0e),
-               (bytearray.fromhex("7f0000000019d50013004e000001790000"),0xa015),
-               (bytearray.fromhex("7f000000001c67001500530000017c0000"),0x5eb8),
-#                (bytearray.fromhex("000a108003ed07090001004000f802fe04"),0x2104),
-#                (bytearray.fromhex("130331fc02fb001fffff03fc0af804fe0e"),0x0c7e)
-               ]
-         
+def reference(cls, bytestring):
+    ''' The original byte-per-byte loop, returns (c0, c1, cb0, cb1) '''
+    c0 = 0
+    c1 = 0
+    iterations = ((len(bytestring) - 1) // cls.bytes_read) + 1
+    for i in range(0, iterations):
+        bytepart = int.from_bytes(bytestring[cls.bytes_read*i:cls.bytes_read*(i+1)], byteorder="little")
+        c0 = (c0 + bytepart) % cls.modulus
+        c1 = (c1 + c0) % cls.modulus
+    cb0 = cls.modulus - ((c0 + c1) % cls.modulus)
+    cb1 = cls.modulus - ((c0 + cb0) % cls.modulus)
+    return (c0, c1, cb0, cb1)
+
+def test_samples():
     for sample in samples:
         f8 = Fletcher()
         f8.update(sample[0])
         result = (f8.cb0 << 8) + f8.cb1
-        if result == sample[1]:
-            print(sample[0].hex() + " " + hex(result) + " PASS")
+        assert result == sample[1], sample[0].hex() + " " + hex(result) + " FAIL"
+
+def test_reference():
+    random.seed(0)
+    for cls in (Fletcher16, Fletcher32, Fletcher64):
+        for length in list(range(0, 40)) + [1000, 10001, 70001]:
+            data = bytearray(random.randrange(256) for _ in range(length))
+            f = cls()
+            f.update(data)
+            assert (f.c0, f.c1, f.cb0, f.cb1) == reference(cls, data), cls.__name__ + " length " + str(length)
+
+def test_input_types():
+    data = samples[0][0]
+    expected = reference(Fletcher, data)
+    for variant in (bytes(data), memoryview(data), list(data)):
+        f8 = Fletcher()
+        f8.update(variant)
+        assert (f8.c0, f8.c1, f8.cb0, f8.cb1) == expected
+
+def test_incremental():
+    random.seed(1)
+    data = bytearray(random.randrange(256) for _ in range(10000))
+    for cls in (Fletcher16, Fletcher32, Fletcher64):
+        f = cls()
+        step = cls.bytes_read * 333
+        for start in range(0, len(data), step):
+            f.update(data[start:start + step])
+        assert (f.c0, f.c1) == reference(cls, data)[0:2], cls.__name__
+
+def test_batch():
+    capture = bytearray()
+    for sample in samples:
+        capture += sample[0] + sample[1].to_bytes(2, byteorder='big')
+    capture[19*2 + 5] ^= 0x01#Corrupt the third frame
+    valid, checkbytes = verify_frames(bytes(capture))
+    assert [bool(v) for v in valid] == [i != 2 for i in range(len(samples))]
+    assert [(int(cb[0]) << 8) + int(cb[1]) for cb in checkbytes][0:2] == [samples[0][1], samples[1][1]]
+
+def test_batch_size():
+    capture = bytes(19 * 3 + 1)
+    for verify in (batch._verify_python, batch._verify_numpy):
+        if verify is batch._verify_numpy and batch.numpy is None:
+            continue
+        try:
+            verify(capture, 19)
+        except ValueError:
+            pass
         else:
-            print(sample[0].hex() + " " + hex(result) + " FAIL")
+            assert False, verify.__name__ + " accepted a partial frame"
+
+def test_batch_paths():
+    if batch.numpy is None:
+        raise SkipTest("NumPy is not installed")
+    random.seed(3)
+    capture = bytearray()
+    for _ in range(500):
+        frame = bytearray(random.randrange(256) for _ in range(17))
+        f8 = Fletcher()
+        f8.update(frame)
+        capture += frame + bytes([f8.cb0, f8.cb1])
+    for pos in random.sample(range(len(capture)), 50):
+        capture[pos] ^= 1 << random.randrange(8)
+    valid, checkbytes = batch._verify_python(capture, 19)
+    valid_np, checkbytes_np = batch._verify_numpy(capture, 19)
+    assert [bool(v) for v in valid_np] == valid
+    assert [(int(cb[0]), int(cb[1])) for cb in checkbytes_np] == checkbytes
+    valid_np, checkbytes_np = batch._verify_numpy(batch.numpy.frombuffer(bytes(capture), dtype=batch.numpy.uint8).reshape(-1, 19), 19)
+    assert [bool(v) for v in valid_np] == valid
+
+def benchmark(duration=1.0):
+    ''' Print the throughput for 17-byte frames and for a large buffer '''
+    random.seed(2)
+    frame = bytearray(random.randrange(256) for _ in range(17))
+    block = bytearray(random.randrange(256) for _ in range(1 << 20))
+
+    for cls in (Fletcher16, Fletcher32, Fletcher64):
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            for _ in range(1000):
+                f = cls()
+                f.update(frame)
+            count += 1000
+        frame_rate = count / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        f = cls()
+        f.update(block)
+        mb_rate = len(block) / (time.perf_counter() - start) / 1e6
+        print("%-10s %10.0f frames/s %8.1f MB/s" % (cls.__name__, frame_rate, mb_rate))
+
+if __name__ == '__main__':
+
+    for test in (test_samples, test_reference, test_input_types, test_incremental, test_batch, test_batch_size, test_batch_paths):
+        try:
+            test()
+        except SkipTest as e:
+            print(test.__name__ + " SKIP (" + str(e) + ")")
+            continue
+        print(test.__name__ + " PASS")
+    benchmark()
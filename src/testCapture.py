@@ -0,0 +1,58 @@
+'''
+Checks the rotation of the capture files, and that records are on disk before the file is closed.
+Run from the src directory: python3 testCapture.py
+'''
+import os
+import tempfile
+from apccapture import CaptureLog, capture_files, read_records, HEADER, RECORD, TX, RX, VALID
+
+def write_files(base, files, max_files):
+    ''' Write enough records for the given number of files '''
+    capture = CaptureLog(base, max_bytes=HEADER.size + 2 * RECORD.size, max_files=max_files)
+    for i in range(2 * files):
+        capture.write(RX, bytes([0x6d, i]), timestamp=float(i))
+    return capture
+
+def test_rotation():
+    with tempfile.TemporaryDirectory() as tmp:
+        base = os.path.join(tmp, 'cap')
+        capture = write_files(base, 5, max_files=3)
+        capture.close()
+        assert [os.path.basename(path) for path in capture_files(base)] == ['cap.3', 'cap.4', 'cap.5']
+        assert [record[0] for record in read_records(base + '.5')] == [8.0, 9.0]
+
+def test_rotation_max_files_0():
+    with tempfile.TemporaryDirectory() as tmp:
+        base = os.path.join(tmp, 'cap')
+        capture = write_files(base, 4, max_files=0)
+        #The file being written is always kept
+        assert capture_files(base) == [base + '.4']
+        capture.write(TX, bytes([0xfe]), timestamp=8.0)
+        capture.close()
+        assert capture_files(base) == [base + '.5']
+        assert [record[0:2] for record in read_records(base + '.5')] == [(8.0, TX)]
+
+def test_rotation_keep_all():
+    with tempfile.TemporaryDirectory() as tmp:
+        base = os.path.join(tmp, 'cap')
+        write_files(base, 4, max_files=None).close()
+        assert len(capture_files(base)) == 4
+        #A new log continues the numbering
+        CaptureLog(base, max_files=None).close()
+        assert capture_files(base)[-1] == base + '.5'
+
+def test_unbuffered():
+    with tempfile.TemporaryDirectory() as tmp:
+        base = os.path.join(tmp, 'cap')
+        capture = CaptureLog(base)
+        capture.write(RX, bytes(19), timestamp=1.0)
+        #Readable without flush() or close(), as after a crash
+        assert list(read_records(base + '.1')) == [(1.0, RX, VALID, bytes(19))]
+        capture.close()
+
+if __name__ == '__main__':
+    test_rotation()
+    test_rotation_max_files_0()
+    test_rotation_keep_all()
+    test_unbuffered()
+    print("PASS")
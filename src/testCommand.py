@@ -0,0 +1,81 @@
+'''
+Checks the messages of the 'set' command, the read back of a write with a corrupted echo
+and the status bits of the simulated power events.
+Run from the src directory: python3 testCommand.py
+'''
+import os
+from apccommand import make_set_msg, TEST_INTERVAL_CHOICES
+from apcdecode import DECODERS
+from apcprotocol import ApcProtocol, CommState, APC_CMD_BACK, APC_CMD_NEXT
+from apcsim import UpsSimulator, MODE1, make_frame
+
+def test_battery_test_interval():
+    #Written by the simulator like the UPS does, then decoded back through the register map
+    sim = UpsSimulator()
+    try:
+        sim.mode = MODE1
+        for choice in range(len(TEST_INTERVAL_CHOICES)):
+            before = {}
+            DECODERS[0x4a](sim.registers[0x4a], before)
+            sim.handle_write(make_set_msg('battery_test_interval', str(choice)))
+            state = {}
+            DECODERS[0x4a](sim.registers[0x4a], state)
+            assert state['battery_replacetest_interval'] == (TEST_INTERVAL_CHOICES[choice],)
+            del before['battery_replacetest_interval'], state['battery_replacetest_interval']
+            del before['battery_replacetest_interval_raw'], state['battery_replacetest_interval_raw']
+            assert state == before#allowed_operating_mode and the other fields are not touched
+        assert sim.stats['rejected'] == 0
+        sim.handle_write(make_set_msg('battery_test_interval', '99'))
+        state = {}
+        DECODERS[0x4a](sim.registers[0x4a], state)
+        assert state['battery_replacetest_interval'] == ('DISABLED',)
+    finally:
+        os.close(sim.master)
+        os.close(sim.slave)
+
+def write_with_corrupted_echo(sim, raw_msg, applied):
+    ''' Write raw_msg through an engine in MODE1, the echo is corrupted, returns the future '''
+    apc = ApcProtocol()
+    apc.state = apc.prev_state = CommState.MODE1
+    future = apc.submit_apc_msg(raw_msg)
+    assert apc.next_apc_cmd() == raw_msg
+    if applied:
+        sim.handle_write(raw_msg)
+    echo = bytearray(make_frame(raw_msg[0], sim.registers[raw_msg[0]]))
+    echo[7] ^= 0x01
+    apc.handle_reply(echo)
+    assert not future.done()
+    assert apc.next_apc_cmd() == APC_CMD_BACK
+    apc.handle_reply(make_frame(raw_msg[0], sim.registers[raw_msg[0]]))
+    assert apc.next_apc_cmd() == APC_CMD_NEXT
+    return future
+
+def test_corrupted_echo():
+    sim = UpsSimulator()
+    try:
+        sim.mode = MODE1
+        raw_msg = make_set_msg('battery_test_interval', '2')
+        assert write_with_corrupted_echo(sim, raw_msg, applied=True).result(0) is True
+        raw_msg = make_set_msg('battery_test_interval', '3')
+        assert write_with_corrupted_echo(sim, raw_msg, applied=False).result(0) is False
+    finally:
+        os.close(sim.master)
+        os.close(sim.slave)
+
+def test_power_events_keep_output_off():
+    sim = UpsSimulator()
+    try:
+        sim.set_value('ups_status', 2 | 16)#ONLINE, OUTPUT OFF
+        sim.apply_power_event('outage')
+        assert sim.get_raw('ups_status') == 4 | 16 | 64
+        sim.apply_power_event('restore')
+        assert sim.get_raw('ups_status') == 2 | 16
+    finally:
+        os.close(sim.master)
+        os.close(sim.slave)
+
+if __name__ == '__main__':
+    test_battery_test_interval()
+    test_corrupted_echo()
+    test_power_events_keep_output_off()
+    print("PASS")
@@ -0,0 +1,120 @@
+'''
+Checks the compiled decoders against frames captured from the UPS, the frames of the simulator
+and random frames, comparing them with the former if/elif chain from the git history (see benchDecode).
+Run from the src directory: python3 testDecode.py
+'''
+import os
+from unittest import SkipTest
+from apcdecode import FIELDS, DECODERS, Field, INT, BP, ENUM, STR, compile_message, encode_field
+from apcframe import verify_frame
+from apcrecord import UpsState
+from apcsim import UpsSimulator, MSG_IDS, make_frame
+from benchDecode import load_chain, chain_state, make_frames, BASELINE
+
+chain_decode = load_chain()
+
+#0x7f frames captured from a SMC1000i, with their checksum
+CAPTURED = [bytes.fromhex("7f0000000019c90013004e0000017900003190"),
+            bytes.fromhex("7f0000000019d40013004e000001790000ac0a"),
+            bytes.fromhex("7f000000001c67001500530000017c00005eb8")]
+
+#Bitfields the chain decoded wrong: ON_OVERLOAD, INVERTER FAULT and runtime_calibration_status
+FIXED_KEYS = ('loadshed_config', 'powsys_error', 'battery_replacetest_status', 'runtime_calibration_status')
+
+def require_chain():
+    if chain_decode is None:
+        raise SkipTest("Revision " + BASELINE + " is not in the git history")
+
+def check_against_chain(msg_id, msg_data):
+    require_chain()
+    table = chain_state()
+    chain = chain_state()
+    assert DECODERS[msg_id](msg_data, table)
+    record = UpsState(chain_state())
+    assert record.set_frame(msg_id, msg_data)
+    assert record.to_dict() == table, hex(msg_id)
+    chain_decode(msg_id, msg_data, chain)
+    assert set(table) == set(chain), hex(msg_id)
+    for key, value in chain.items():
+        if key in FIXED_KEYS:
+            continue
+        if isinstance(value, list):
+            value = tuple(value)#The table decoder shares label tuples
+        assert table[key] == value, hex(msg_id) + " " + key
+    return table
+
+def simulator_frames(events=()):
+    sim = UpsSimulator()
+    try:
+        for event in events:
+            sim.apply_power_event(event)
+        return [make_frame(msg_id, sim.registers[msg_id]) for msg_id in MSG_IDS]
+    finally:
+        os.close(sim.master)
+        os.close(sim.slave)
+
+def test_captured_frames():
+    for frame in CAPTURED:
+        assert verify_frame(frame)
+        state = check_against_chain(frame[0], frame[1:-2])
+        assert state['challenge_status'] == frame[15:17]
+
+def test_simulator_frames():
+    for events in ((), ('outage',), ('outage', 'low_runtime'), ('fault',)):
+        state = {}
+        for frame in simulator_frames(events):
+            if frame[0] in DECODERS:
+                check_against_chain(frame[0], frame[1:-2])
+                DECODERS[frame[0]](frame[1:-2], state)
+        assert state['ups_type'].strip() == 'Smart-UPS C 1000'
+        assert state['serial_nb'].strip() == '3S1607X00588'
+        assert state['voltage_config'] == 230
+        assert ('ON BATTERY' in state['ups_status']) == ('outage' in events)
+        assert ('FAULT' in state['ups_status']) == ('fault' in events)
+
+def test_random_frames():
+    for msg_id, msg_data in make_frames(5000):
+        check_against_chain(msg_id, msg_data)
+
+def test_fixed_bits():
+    require_chain()
+    for name, raw, label in (('loadshed_config', 32, 'ON_OVERLOAD'), ('powsys_error', 8192, 'INVERTER FAULT')):
+        msg_id, field = FIELDS[name]
+        msg_data = bytearray(16)
+        msg_data[field.offset:field.offset + field.width] = encode_field(field, raw)
+        table = chain_state()
+        chain = chain_state()
+        DECODERS[msg_id](msg_data, table)
+        chain_decode(msg_id, msg_data, chain)
+        assert table[name] == (label,)
+        assert label not in chain[name]
+
+def test_compile_message():
+    decode = compile_message((
+        Field('text', 0, 4, STR),
+        Field('count', 4, 2, INT),
+        Field('offset', 6, 1, INT, signed=True),
+        Field('level', 8, 2, BP, bp=8),
+        Field('mode', 10, 1, ENUM, table={1: 'ON'}),
+    ))
+    state = {}
+    assert not decode(bytes(10), state)
+    assert state == {}
+    assert decode(b'abcd\x01\x02\xff\x00\x01\x80\x01', state)
+    assert state == {'text': 'abcd', 'count': 258, 'offset': -1, 'level': 1.5, 'mode_raw': 1, 'mode': 'ON'}
+    decode(b'abcd\x01\x02\xff\x00\x01\x80\x02', state)
+    assert state['mode_raw'] == 2 and state['mode'] == 'ON'#Unknown values keep the last mapped value
+    try:
+        compile_message((Field('a', 0, 2, INT), Field('b', 1, 2, INT)))
+    except ValueError:
+        pass
+    else:
+        assert False, "Overlapping fields accepted"
+
+if __name__ == '__main__':
+    test_captured_frames()
+    test_simulator_frames()
+    test_random_frames()
+    test_fixed_bits()
+    test_compile_message()
+    print("PASS")
@@ -0,0 +1,86 @@
+'''
+Checks the events of EventDetector for the power events of the simulator.
+Run from the src directory: python3 testEvents.py
+'''
+import os
+from apcevents import EventDetector, EventKind
+from apcsim import UpsSimulator, MSG_IDS
+
+class Script:
+    ''' Simulator register image fed to a detector, one cycle of all message IDs at a time '''
+
+    def __init__(self):
+        self.sim = UpsSimulator()
+        self.time = 0.0
+
+    def cycle(self, detector, event=None):
+        ''' Apply a power event, send all frames once and return the events that fired '''
+        if event is not None:
+            self.sim.apply_power_event(event)
+        fired = []
+        detector.add_listener(fired.append)
+        for msg_id in MSG_IDS:
+            self.time += 0.1
+            detector.frame(msg_id, bytes(self.sim.registers[msg_id]), self.time)
+        detector.remove_listener(fired.append)
+        return fired
+
+    def close(self):
+        os.close(self.sim.master)
+        os.close(self.sim.slave)
+
+def kinds(events):
+    return [event.kind for event in events]
+
+def test_transitions():
+    script = Script()
+    try:
+        detector = EventDetector()
+        assert script.cycle(detector) == []#Inactive conditions do not fire when first seen
+        assert detector.active('on_battery') is False
+        events = script.cycle(detector, 'outage')
+        #input_status (0x70) comes before ups_status and status_chg_cause (0x76)
+        assert kinds(events) == [EventKind.INPUT_LOST, EventKind.ON_BATTERY]
+        assert events[1].msg_id == 0x76 and events[1].cause == 'LowInputVoltage'
+        assert script.cycle(detector) == []#Unchanged frames
+        assert kinds(script.cycle(detector, 'low_runtime')) == [EventKind.LOW_RUNTIME]
+        events = script.cycle(detector, 'restore')
+        #The input stays bad until the INPUT BAD bit of ups_status is cleared as well
+        assert kinds(events) == [EventKind.OFF_BATTERY, EventKind.INPUT_RESTORED]
+        assert events[0].msg_id == 0x76 and events[0].cause == 'AcceptableInput'
+        assert detector.active('on_battery') is False and detector.active('low_runtime') is True
+        assert kinds(script.cycle(detector, 'fault')) == [EventKind.FAULT]
+        assert kinds(script.cycle(detector, 'clear_fault')) == [EventKind.FAULT_CLEARED]
+    finally:
+        script.close()
+
+def test_started_on_battery():
+    script = Script()
+    try:
+        script.sim.apply_power_event('outage')
+        detector = EventDetector()
+        assert kinds(script.cycle(detector)) == [EventKind.INPUT_LOST, EventKind.ON_BATTERY]
+    finally:
+        script.close()
+
+def test_listener_kinds():
+    script = Script()
+    try:
+        detector = EventDetector()
+        events = detector.subscribe(kinds=(EventKind.OFF_BATTERY,))
+        script.cycle(detector, 'outage')
+        assert events.empty()
+        script.cycle(detector, 'restore')
+        assert events.get_nowait().kind == EventKind.OFF_BATTERY
+        assert events.empty()
+        detector.unsubscribe(events)
+        script.cycle(detector, 'outage')
+        assert events.empty()
+    finally:
+        script.close()
+
+if __name__ == '__main__':
+    test_transitions()
+    test_started_on_battery()
+    test_listener_kinds()
+    print("PASS")
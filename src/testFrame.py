@@ -0,0 +1,117 @@
+'''
+Checks that FrameSync finds the frames of the simulator back in a byte stream with
+garbage, corrupted and split frames, and that a bad reply does not stall the transport.
+Run from the src directory: python3 testFrame.py
+'''
+import os
+import random
+import asyncio
+from apcframe import FrameSync, FRAME_SIZE
+from apcasync import AsyncApcComm
+from apcport import FdPort
+from apcprotocol import APC_RCV_TIMEOUT
+from apcsim import UpsSimulator, MSG_IDS, make_frame
+
+def simulator_frames():
+    sim = UpsSimulator()
+    try:
+        return [make_frame(msg_id, sim.registers[msg_id]) for msg_id in MSG_IDS]
+    finally:
+        os.close(sim.master)
+        os.close(sim.slave)
+
+def feed_chunks(sync, stream, rnd):
+    ''' Feed the stream in reads of random size, like the serial port returns them '''
+    found = []
+    pos = 0
+    while pos < len(stream):
+        size = rnd.randrange(1, 2 * FRAME_SIZE)
+        sync.feed(stream[pos:pos + size])
+        pos += size
+        found += [bytes(frame) for frame in sync.frames()]
+    return found
+
+def test_split_frames():
+    frames = simulator_frames()
+    sync = FrameSync()
+    assert sync.needed() == FRAME_SIZE
+    assert feed_chunks(sync, b''.join(frames), random.Random(0)) == frames
+    assert sync.discarded == 0
+    assert sync.frame_count == len(frames)
+    assert len(sync) == 0
+
+def test_resync():
+    frames = simulator_frames()
+    rnd = random.Random(1)
+    stream = bytearray(rnd.randrange(256) for _ in range(7))#Tail of a frame sent before the port was opened
+    expected = []
+    for index, frame in enumerate(frames):
+        if index % 5 == 2:
+            frame = bytearray(frame)
+            frame[rnd.randrange(FRAME_SIZE)] ^= 1 << rnd.randrange(8)
+        elif index % 5 == 4:
+            frame = frame[:rnd.randrange(1, FRAME_SIZE)]#Lost bytes
+        else:
+            expected.append(frame)
+        stream += frame
+    sync = FrameSync()
+    assert feed_chunks(sync, bytes(stream), rnd) == expected
+    assert sync.discarded == len(stream) - len(expected) * FRAME_SIZE
+
+def test_needed_and_flush():
+    frame = simulator_frames()[0]
+    sync = FrameSync()
+    sync.feed(frame[:5])
+    assert sync.needed() == FRAME_SIZE - 5
+    assert list(sync.frames()) == []
+    assert sync.flush() == frame[:5]
+    assert len(sync) == 0 and sync.discarded == 5
+
+def test_buffer_size():
+    sync = FrameSync(buffer_size=4 * FRAME_SIZE)
+    sync.feed(bytes(10 * FRAME_SIZE))
+    assert len(sync) == 4 * FRAME_SIZE
+    assert sync.discarded == 6 * FRAME_SIZE
+    assert sync.received == 10 * FRAME_SIZE
+
+def receive_reply(reply):
+    ''' Let an AsyncApcComm receive the reply from a pipe, returns (leftover, seconds) '''
+    read_fd, write_fd = os.pipe()
+    comm = AsyncApcComm(FdPort(read_fd, timeout=0))
+
+    async def receive():
+        loop = asyncio.get_running_loop()
+        comm.data_event = asyncio.Event()
+        comm.running = True
+        loop.add_reader(read_fd, comm.on_readable)
+        try:
+            os.write(write_fd, reply)
+            begin = loop.time()
+            leftover = await comm.receive_msg()
+            return leftover, loop.time() - begin
+        finally:
+            loop.remove_reader(read_fd)
+
+    try:
+        return asyncio.run(receive())
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+def test_idle_timeout():
+    frame = bytearray(simulator_frames()[0])
+    frame[5] ^= 0x10
+    leftover, seconds = receive_reply(frame)
+    assert leftover == frame[1:]
+    assert seconds < APC_RCV_TIMEOUT / 2
+    leftover, seconds = receive_reply(frame[:12])#Lost bytes
+    assert leftover == frame[:12]
+    assert seconds < APC_RCV_TIMEOUT / 2
+
+if __name__ == '__main__':
+    test_split_frames()
+    test_resync()
+    test_needed_and_flush()
+    test_buffer_size()
+    test_idle_timeout()
+    print("PASS")
@@ -0,0 +1,70 @@
+'''
+Checks that the identity cache skips the MODE0 walk of a known UPS, and that an entry
+the UPS does not accept is invalidated and stored again after a full walk.
+Run from the src directory: python3 testIdentity.py
+'''
+import os
+import asyncio
+import tempfile
+from apcasync import AsyncApcComm
+from apcidentity import IdentityCache
+from apcport import FdPort
+from apcprotocol import CommState
+from apcsim import UpsSimulator
+
+def frames_to_mode1(sim, cache):
+    ''' Connect a new engine, returns the number of frames the simulator sent until MODE1 and the state '''
+    async def connect():
+        port = FdPort(sim.port_name, timeout=0)
+        comm = AsyncApcComm(port)
+        comm.identity_cache = cache
+        start = sim.stats['frames']
+        mode1 = asyncio.get_running_loop().create_future()
+
+        def on_state(snapshot):
+            if comm.state == CommState.MODE1 and not mode1.done():
+                mode1.set_result((sim.stats['frames'] - start, snapshot.values))
+
+        comm.add_listener(on_state)
+        task = asyncio.get_running_loop().create_task(comm.run())
+        try:
+            return await asyncio.wait_for(mode1, 20)
+        finally:
+            comm.stop()
+            await task
+            #Drop the reply to the last message, the next engine would take it for its own
+            await asyncio.sleep(0.05)
+            while port.read(256):
+                pass
+            port.close()
+
+    return asyncio.run(connect())
+
+def test_skip_walk():
+    sim = UpsSimulator()
+    sim.start()
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            cache = IdentityCache(os.path.join(tmp, 'identity.json'))
+            walk, _ = frames_to_mode1(sim, cache)
+            cached, values = frames_to_mode1(sim, cache)
+            assert cache.hits == 1
+            assert walk - cached >= 30, (walk, cached)
+            assert values['ups_sku'].strip() == 'SMC1000I'
+            #New password: the shortcut fails, the entry is replaced after a full walk
+            sim.registers[0x7e][8:12] = bytes([0x12, 0x34, 0x56, 0x78])
+            rejected, _ = frames_to_mode1(sim, cache)
+            assert rejected > walk
+            assert sim.stats['rejected'] == 1
+            frames = cache.lookup(sim.registers[0x00], sim.registers[0x40])
+            assert frames[0x7e][8:12] == bytes([0x12, 0x34, 0x56, 0x78])
+            cached, _ = frames_to_mode1(sim, cache)
+            assert walk - cached >= 30, (walk, cached)
+            cache.flush()
+            assert IdentityCache(cache.path).entries == cache.entries
+        finally:
+            sim.stop()
+
+if __name__ == '__main__':
+    test_skip_walk()
+    print("PASS")
@@ -0,0 +1,46 @@
+'''
+Checks that the published UPS state never holds half of a text that continues over two frames.
+Run from the src directory: python3 testProtocol.py
+'''
+import os
+from apcprotocol import ApcProtocol
+from apcsim import UpsSimulator, MSG_IDS, make_frame
+
+def check_texts(lazy_decode):
+    sim = UpsSimulator()
+    try:
+        apc = ApcProtocol()
+        apc.lazy_decode = lazy_decode
+        seen = []
+        apc.add_listener(lambda snapshot: seen.append((snapshot.values.get('ups_type'), snapshot.values.get('ups_sku'))))
+        for msg_id in MSG_IDS:
+            apc.handle_apc_msg(make_frame(msg_id, sim.registers[msg_id]))
+        old = (apc.ups_state['ups_type'], apc.ups_state['ups_sku'])
+        assert old[0].strip() == 'Smart-UPS C 1000' and old[1].strip() == 'SMC1000I'
+        sim.set_text(0x41, 'Smart-UPS 1500 RM 2U', 32)
+        sim.set_text(0x43, 'SMT1500RMI2U', 20)
+        del seen[:]
+        for msg_id in MSG_IDS:
+            apc.handle_apc_msg(make_frame(msg_id, sim.registers[msg_id]))
+        new = (apc.ups_state['ups_type'], apc.ups_state['ups_sku'])
+        assert new[0].strip() == 'Smart-UPS 1500 RM 2U' and new[1].strip() == 'SMT1500RMI2U'
+        #Every snapshot has the complete old or the complete new texts
+        for ups_type, ups_sku in seen:
+            assert ups_type in (old[0], new[0]) and ups_sku in (old[1], new[1])
+        #A continuation without its first frame (re-read after BACK) keeps the text
+        apc.handle_apc_msg(make_frame(0x42, sim.registers[0x42]))
+        assert apc.ups_state['ups_type'] == new[0]
+    finally:
+        os.close(sim.master)
+        os.close(sim.slave)
+
+def test_texts():
+    check_texts(False)
+
+def test_texts_lazy():
+    check_texts(True)
+
+if __name__ == '__main__':
+    test_texts()
+    test_texts_lazy()
+    print("PASS")
@@ -0,0 +1,62 @@
+'''
+Checks that LazyUpsState reads the same values as UpsState, which decodes every frame,
+over the frames of the simulator and frames with random data.
+Run from the src directory: python3 testRecord.py
+'''
+import os
+import random
+from apcrecord import UpsState, LazyUpsState
+from apcsim import UpsSimulator, MSG_IDS
+
+def cycles():
+    ''' Data of all message IDs per cycle, as the simulator sends them through some power events '''
+    sim = UpsSimulator()
+    try:
+        result = []
+        for event in (None, 'outage', 'low_runtime', 'fault', 'restore', 'clear_fault'):
+            if event is not None:
+                sim.apply_power_event(event)
+            result.append([(msg_id, bytes(sim.registers[msg_id])) for msg_id in MSG_IDS])
+        return result
+    finally:
+        os.close(sim.master)
+        os.close(sim.slave)
+
+def random_cycles(count):
+    rnd = random.Random(0)
+    return [[(msg_id, bytes(rnd.randrange(0x20, 0x7f) for _ in range(16))) for msg_id in MSG_IDS] for _ in range(count)]
+
+def test_agreement():
+    state = UpsState()
+    lazy = LazyUpsState()
+    for cycle in cycles() + random_cycles(5):
+        for msg_id, msg_data in cycle:
+            assert state.set_frame(msg_id, msg_data) == lazy.set_frame(msg_id, msg_data)
+            #Decode part of the keys before the next frame replaces their data
+            assert lazy.get('ups_status_raw') == state.get('ups_status_raw')
+            assert lazy.get('battery_soc') == state.get('battery_soc')
+        assert lazy.to_dict() == state.to_dict()
+        assert lazy.copy().freeze().to_dict() == state.to_dict()
+
+def test_published_lazy_state():
+    data = cycles()
+    lazy = LazyUpsState()
+    for msg_id, msg_data in data[0]:
+        lazy.set_frame(msg_id, msg_data)
+    published = lazy.copy().freeze()
+    for msg_id, msg_data in data[1]:
+        lazy.set_frame(msg_id, msg_data)
+    #The published record keeps the frames it was copied with
+    assert 'ONLINE' in published['ups_status']
+    assert 'ON BATTERY' in lazy['ups_status']
+    try:
+        published.set_frame(0x76, data[1][0][1])
+    except TypeError:
+        pass
+    else:
+        assert False, "Published record accepted a frame"
+
+if __name__ == '__main__':
+    test_agreement()
+    test_published_lazy_state()
+    print("PASS")
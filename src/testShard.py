@@ -0,0 +1,76 @@
+'''
+Checks that the deltas of the sharded collector reach the metrics exporter, removed
+keys included, that a failing listener does not stop the aggregation, and that a
+worker that died is reported and started again.
+Run from the src directory: python3 testShard.py
+'''
+import os
+import time
+import logging
+from apcshard import ShardedCollector, encode_delta
+from apcmetrics import MetricsExporter
+
+def make_collector():
+    collector = ShardedCollector(['/dev/ttyUPS0'], workers=1)
+    exporter = MetricsExporter()
+    collector.add_listener(lambda port, snapshot, changes: exporter.update(port, changes, snapshot.values))
+    return collector, exporter
+
+def test_removed_keys():
+    collector, exporter = make_collector()
+    collector.apply(encode_delta(0, 1, 1.0, {'serial_nb': 'SIM1', 'battery_soc': 99.5, 'ups_status_raw': 2,
+                                            'ups_type': 'Smart-UPS'}))
+    text = exporter.render().decode()
+    assert 'apc_battery_soc{serial="SIM1"} 99.5\n' in text
+    assert 'apc_ups_status{serial="SIM1",flag="ONLINE"} 1\n' in text
+    collector.apply(encode_delta(0, 2, 2.0, {}, ['battery_soc', 'ups_status_raw', 'ups_type']))
+    text = exporter.render().decode()
+    assert 'None' not in text
+    assert 'apc_battery_soc{' not in text and 'apc_ups_status{' not in text
+    assert 'apc_ups_info{serial="SIM1"} 1\n' in text
+    assert 'battery_soc' not in collector.snapshots[0].values
+
+def test_failing_listener():
+    collector, exporter = make_collector()
+    calls = []
+    def failing(port, snapshot, changes):
+        raise RuntimeError("Consumer bug")
+    collector.listeners = (failing,) + collector.listeners
+    collector.add_listener(lambda port, snapshot, changes: calls.append(snapshot.seq))
+    logging.disable(logging.CRITICAL)
+    try:
+        collector.apply(encode_delta(0, 1, 1.0, {'serial_nb': 'SIM1', 'battery_soc': 99.5}))
+    finally:
+        logging.disable(logging.NOTSET)
+    assert calls == [1]
+    assert b'apc_battery_soc{serial="SIM1"} 99.5\n' in exporter.render()
+
+def exit_worker(name):
+    ''' open_port of a worker process that dies '''
+    os._exit(3)
+
+def test_worker_restart():
+    collector = ShardedCollector(['/dev/ttyUPS0', '/dev/ttyUPS1'], workers=1, open_port=exit_worker)
+    collector.restart_delay = 0.1
+    for port_index in range(2):
+        collector.apply(encode_delta(port_index, 5, 1.0, {'comm_state': 'online', 'serial_nb': 'SIM' + str(port_index)}))
+    logging.disable(logging.CRITICAL)
+    collector.start()
+    try:
+        deadline = time.monotonic() + 30
+        while collector.restarts < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        collector.stop()
+        logging.disable(logging.NOTSET)
+    assert collector.restarts >= 2
+    for snapshot in collector.snapshots:
+        assert dict(snapshot.values) == {'comm_state': 'offline'}
+        assert snapshot.seq >= 6
+    assert collector.states() == {}
+
+if __name__ == '__main__':
+    test_removed_keys()
+    test_failing_listener()
+    test_worker_restart()
+    print("PASS")
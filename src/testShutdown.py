@@ -0,0 +1,56 @@
+'''
+Checks the order checks of the shutdown actions, and that run_actions gives up an action
+at its timeout and starts the actions after it anyway.
+Run from the src directory: python3 testShutdown.py
+'''
+import time
+import threading
+from apcshutdown import ShutdownAction, ShutdownOrchestrator, check_order
+
+def check_rejected(actions, message):
+    try:
+        check_order(actions)
+    except ValueError as e:
+        assert message in str(e), str(e)
+    else:
+        assert False, "Accepted: " + message
+
+def test_check_order():
+    check_order([ShutdownAction('app', 'true'), ShutdownAction('db', 'true', after=('app',))])
+    check_rejected([ShutdownAction('app', 'true'), ShutdownAction('app', 'true')], "Duplicate action app")
+    check_rejected([ShutdownAction('db', 'true', after=('app',))], "unknown action app")
+    check_rejected([ShutdownAction('a', 'true', after=('c',)), ShutdownAction('b', 'true', after=('a',)),
+                    ShutdownAction('c', 'true', after=('b',)), ShutdownAction('d', 'true')],
+                   "Dependency cycle between a, b, c")
+
+def run_actions(actions):
+    orchestrator = ShutdownOrchestrator(None, actions)
+    orchestrator.triggered_monotonic = time.monotonic()
+    start = time.monotonic()
+    results = orchestrator.run_actions()
+    return {result.name: result for result in results}, time.monotonic() - start
+
+def test_run_actions_timeouts():
+    release = threading.Event()
+    try:
+        results, duration = run_actions([
+            ShutdownAction('command', 'sleep 5', timeout=0.3),
+            ShutdownAction('hanging', release.wait, timeout=0.5),
+            ShutdownAction('failing', 'false'),
+            ShutdownAction('after', lambda: None, after=('command', 'hanging')),
+        ])
+    finally:
+        release.set()
+    assert duration < 2.0, duration
+    assert results['command'].status == 'timeout'
+    assert results['hanging'].status == 'timeout'
+    assert results['failing'].status == 'failed' and 'Exit status 1' in results['failing'].detail
+    assert results['after'].status == 'ok'
+    #Started once the slowest action it comes after was given up
+    assert results['after'].start >= 0.5
+    assert results['hanging'].duration < 1.0
+
+if __name__ == '__main__':
+    test_check_order()
+    test_run_actions_timeouts()
+    print("PASS")